@@ -0,0 +1,332 @@
+"""
+Benchmarks for the vault prototype.
+
+The import benchmark measures how long it takes to start a fresh interpreter
+and import some module, compared to starting an interpreter that only imports
+click. Read-only commands like "vault info" should stay close to that floor,
+see cli.py.
+
+The planning benchmark plans, crawls, signs, saves, loads and bakes
+(OP_CHECKTEMPLATEVERIFY) vaults of several sizes, with burn transactions and
+sweeps on and off. The vaults are planned with a fixed test key on top of a
+placeholder user transaction, so bitcoind isn't needed. Each phase is
+measured with metrics.PhaseRecorder. The results can be saved as a baseline,
+and later runs are compared to it (see compare_to_baseline and "vault
+bench").
+
+Run with: python -m vaults.benchmarks
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import itertools
+import subprocess
+import tempfile
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from bitcoin.core import COIN
+
+from vaults.config import BENCHMARK_REGRESSION_THRESHOLD
+from vaults.exceptions import VaultException
+from vaults.helpers.formatting import lx
+from vaults.helpers.prototyping import make_parameters
+from vaults.metrics import PhaseRecorder, COUNTERS
+from vaults.models.script_templates import UserScriptTemplate
+from vaults.models.plans import PlannedUTXO, InitialTransaction
+from vaults.planner import setup_vault
+from vaults.signing import sign_transaction_tree
+from vaults.bip119_ctv import make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY
+from vaults.persist import save, load
+
+# (label, python statement) for the import benchmark. The first two are the
+# floors: an empty interpreter, and an interpreter with click.
+IMPORT_BENCHMARKS = (
+    ("python", "pass"),
+    ("click", "import click"),
+    ("vault --help", "import vaults.cli"),
+    ("vault info", "import vaults.cli, vaults.commands.info"),
+    ("vault broadcast", "import vaults.cli, vaults.commands.broadcast"),
+    ("vault graph", "import vaults.cli, vaults.commands.graph"),
+    ("vault init", "import vaults.cli, vaults.commands.initialize"),
+)
+
+# Modules that only "vault init" (and the other planning commands) need.
+HEAVY_MODULES = (
+    "vaults.planner",
+    "vaults.signing",
+    "vaults.bip119_ctv",
+    "vaults.validation",
+    "multiprocessing",
+    "graphviz",
+)
+
+def measure_import_time(statement, repeat=5):
+    """
+    Run the statement in a new python interpreter, repeat times, and return
+    the fastest wall time in seconds.
+    """
+    timings = []
+    for attempt in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+def get_imported_modules(statement):
+    """
+    Run the statement in a new python interpreter and return the names of the
+    modules that it imported.
+    """
+    script = "import sys\n{}\nprint(\"\\n\".join(sorted(sys.modules.keys())))".format(statement)
+    result = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True)
+    return set(result.stdout.split())
+
+def run_import_benchmark(repeat=5):
+    """
+    Measure the import time of each of IMPORT_BENCHMARKS. Returns a list of
+    (label, seconds, heavy modules that got imported) tuples.
+    """
+    results = []
+    for (label, statement) in IMPORT_BENCHMARKS:
+        seconds = measure_import_time(statement, repeat=repeat)
+        heavy_modules = sorted(get_imported_modules(statement).intersection(HEAVY_MODULES))
+        results.append((label, seconds, heavy_modules))
+    return results
+
+def format_import_benchmark(results):
+    """
+    Render the results of run_import_benchmark as a table, with the time
+    above the click floor.
+    """
+    floor = dict([(label, seconds) for (label, seconds, heavy_modules) in results]).get("click", 0)
+    output = "{:<20} {:>10} {:>12}  {}\n".format("command", "seconds", "over click", "heavy modules")
+    for (label, seconds, heavy_modules) in results:
+        output += "{:<20} {:>10.3f} {:>+12.3f}  {}\n".format(label, seconds, seconds - floor, ", ".join(heavy_modules))
+    return output
+
+# The insecure default key of "vault init", used for every key of the
+# benchmarked vaults.
+BENCHMARK_PRIVATE_KEY = "cUB8G5cFtxc4usfgfovqRgCo8qTQUJtctLV8t6YYNfULg3GtehdX"
+
+# placeholder txid for the benchmarked vaults' user transaction
+BENCHMARK_TXID = "cf600e3cfc2cdc01be7563334b33f304ab6466b976e17f66c15228bd81f80007"
+
+BENCHMARK_NUM_SHARDS = (5, 10, 20)
+
+BASELINE_FORMAT_VERSION = 1
+
+# Differences smaller than these are noise, and never count as regressions,
+# however large they are relative to the baseline.
+MINIMUM_REGRESSIONS = {
+    "wall_time": 0.02,
+    "peak_memory": 256 * 1024,
+}
+
+def get_scenario_name(num_shards, burn, sweeps):
+    return "shards={} burn={} sweeps={}".format(num_shards, "on" if burn else "off", "on" if sweeps else "off")
+
+def get_scenarios(num_shards_list=BENCHMARK_NUM_SHARDS, burn_options=(True, False), sweeps_options=(False, True)):
+    """
+    Every combination of the number of shards, burn transactions on or off,
+    and sweeps on or off. Returns a list of (num_shards, burn, sweeps).
+    """
+    return list(itertools.product(num_shards_list, burn_options, sweeps_options))
+
+def run_plan_phases(num_shards, burn, sweeps, trace_memory=False):
+    """
+    Plan, crawl, sign, save, load and bake one vault, each as a phase of a
+    PhaseRecorder. The transaction stores are written to a temporary
+    directory. Returns the recorder.
+    """
+    parameters = make_parameters(BENCHMARK_PRIVATE_KEY, num_shards=num_shards, enable_burn_transactions=burn)
+    parameters["enable_sweeps"] = sweeps
+
+    recorder = PhaseRecorder(trace_memory=trace_memory)
+    recorder.values["scenario"] = get_scenario_name(num_shards, burn, sweeps)
+
+    initial_tx = InitialTransaction(txid=lx(BENCHMARK_TXID))
+    segwit_utxo = PlannedUTXO(
+        name="segwit input coin",
+        transaction=initial_tx,
+        script_template=UserScriptTemplate,
+        amount=2 * COIN,
+    )
+    segwit_utxo._vout_override = 0
+    initial_tx.output_utxos = [segwit_utxo]
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        with recorder.phase("setup_vault"):
+            setup_vault(segwit_utxo, parameters)
+
+        with recorder.phase("crawl") as phase:
+            (utxos, transactions) = segwit_utxo.crawl()
+            phase.values["transactions"] = len(transactions)
+            phase.values["utxos"] = len(utxos)
+        del utxos, transactions
+
+        with recorder.phase("sign_transaction_tree"):
+            sign_transaction_tree(segwit_utxo, parameters)
+
+        path = os.path.join(tempdir, "transaction-store.json")
+        with recorder.phase("save") as phase:
+            save(segwit_utxo, filename=path)
+            phase.values["bytes"] = os.path.getsize(path)
+
+        with recorder.phase("load"):
+            load(path=path)
+
+        with recorder.phase("ctv conversion"):
+            make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=parameters)
+
+        path = os.path.join(tempdir, "transaction-store.ctv.json")
+        with recorder.phase("ctv save") as phase:
+            save(segwit_utxo, filename=path)
+            phase.values["bytes"] = os.path.getsize(path)
+
+    recorder.stop()
+    return recorder
+
+def run_plan_benchmark(scenarios, repeat=3, trace_memory=True):
+    """
+    Run run_plan_phases for each scenario repeat times, and keep the fastest
+    wall time and CPU time of each phase. Memory is measured in one more run,
+    because tracemalloc slows everything down. Returns a dictionary of
+    results by scenario name, then by phase name.
+    """
+    results = {}
+    for (num_shards, burn, sweeps) in scenarios:
+        scenario_results = {}
+
+        for attempt in range(repeat):
+            recorder = run_plan_phases(num_shards, burn, sweeps)
+            for some_phase in recorder.phases:
+                if some_phase.name not in scenario_results:
+                    scenario_results[some_phase.name] = {
+                        "wall_time": some_phase.wall_time,
+                        "cpu_time": some_phase.cpu_time,
+                        "peak_memory": None,
+                        "counts": some_phase.counts,
+                        "values": some_phase.values,
+                    }
+                else:
+                    phase_results = scenario_results[some_phase.name]
+                    phase_results["wall_time"] = min(phase_results["wall_time"], some_phase.wall_time)
+                    phase_results["cpu_time"] = min(phase_results["cpu_time"], some_phase.cpu_time)
+
+        if trace_memory:
+            recorder = run_plan_phases(num_shards, burn, sweeps, trace_memory=True)
+            for some_phase in recorder.phases:
+                scenario_results[some_phase.name]["peak_memory"] = some_phase.peak_memory
+
+        results[get_scenario_name(num_shards, burn, sweeps)] = scenario_results
+    return results
+
+def make_baseline(results, threshold=BENCHMARK_REGRESSION_THRESHOLD):
+    """
+    The baseline file contents: the results, the threshold for
+    compare_to_baseline, and where the results were measured.
+    """
+    return {
+        "version": BASELINE_FORMAT_VERSION,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "threshold": threshold,
+        "results": results,
+    }
+
+def save_baseline(results, path, threshold=None):
+    """
+    Write the results of run_plan_benchmark as the baseline for later runs.
+    Scenarios that are in the old baseline but weren't run are kept, and so
+    is its threshold unless another one is given.
+    """
+    if os.path.exists(path):
+        baseline = load_baseline(path)
+        baseline["results"].update(results)
+        results = baseline["results"]
+        if threshold == None:
+            threshold = baseline["threshold"]
+    if threshold == None:
+        threshold = BENCHMARK_REGRESSION_THRESHOLD
+
+    with open(path, "w") as fd:
+        json.dump(make_baseline(results, threshold=threshold), fd, indent=4, sort_keys=True)
+
+def load_baseline(path):
+    with open(path, "r") as fd:
+        baseline = json.load(fd)
+    if baseline.get("version", None) != BASELINE_FORMAT_VERSION:
+        raise VaultException("Unknown benchmark baseline format in {}".format(path))
+    return baseline
+
+def compare_to_baseline(results, baseline, threshold=None):
+    """
+    Find the phases that got slower or bigger by more than the threshold
+    (relative to the baseline, and by at least MINIMUM_REGRESSIONS), or that
+    did more work (signatures, hashes and RPC calls are counted exactly).
+    Phases and scenarios that aren't in the baseline are skipped. Returns a
+    list of (scenario, phase, metric, baseline value, new value).
+    """
+    if threshold == None:
+        threshold = baseline.get("threshold", BENCHMARK_REGRESSION_THRESHOLD)
+
+    regressions = []
+    for (scenario, scenario_results) in sorted(results.items()):
+        baseline_scenario = baseline["results"].get(scenario, {})
+        for (phase_name, phase_results) in scenario_results.items():
+            baseline_phase = baseline_scenario.get(phase_name, None)
+            if baseline_phase == None:
+                continue
+
+            for (metric, minimum) in MINIMUM_REGRESSIONS.items():
+                old_value = baseline_phase.get(metric, None)
+                new_value = phase_results.get(metric, None)
+                if old_value == None or new_value == None:
+                    continue
+                if new_value > old_value * (1 + threshold) and new_value - old_value > minimum:
+                    regressions.append((scenario, phase_name, metric, old_value, new_value))
+
+            for name in COUNTERS:
+                old_value = baseline_phase.get("counts", {}).get(name, 0)
+                new_value = phase_results["counts"].get(name, 0)
+                if new_value > old_value:
+                    regressions.append((scenario, phase_name, name, old_value, new_value))
+
+    return regressions
+
+def format_plan_benchmark(results, baseline=None):
+    """
+    Render the results of run_plan_benchmark as a table, with the change from
+    the baseline wall time if there is one.
+    """
+    output = "{:<30} {:<22} {:>10} {:>10} {:>10} {:>8} {:>11}\n".format("scenario", "phase", "wall", "cpu", "memory", "change", "signatures")
+    for (scenario, scenario_results) in results.items():
+        for (phase_name, phase_results) in scenario_results.items():
+            memory = "-" if phase_results["peak_memory"] == None else "{:.1f}MB".format(phase_results["peak_memory"] / 1e6)
+
+            change = "-"
+            if baseline != None:
+                baseline_phase = baseline["results"].get(scenario, {}).get(phase_name, None)
+                if baseline_phase != None and baseline_phase["wall_time"] > 0:
+                    change = "{:+.0%}".format(phase_results["wall_time"] / baseline_phase["wall_time"] - 1)
+
+            output += "{:<30} {:<22} {:>9.3f}s {:>9.3f}s {:>10} {:>8} {:>11}\n".format(scenario, phase_name, phase_results["wall_time"], phase_results["cpu_time"], memory, change, phase_results["counts"]["signatures"])
+    return output
+
+def format_regressions(regressions):
+    output = ""
+    for (scenario, phase_name, metric, old_value, new_value) in regressions:
+        output += "regression: {} {} {}: {} -> {}\n".format(scenario, phase_name, metric, old_value, new_value)
+    return output
+
+if __name__ == "__main__":
+    print(format_import_benchmark(run_import_benchmark()))
+    print(format_plan_benchmark(run_plan_benchmark(get_scenarios(), repeat=1)))
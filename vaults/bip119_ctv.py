@@ -14,7 +14,7 @@ hash commitment dependency loop error.
 entrypoint: make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY
 """
 
-import struct
+import multiprocessing
 
 import bitcoin
 
@@ -42,17 +42,33 @@ from bitcoin.core.script import (
     OP_ENDIF,
 )
 
-from vaults.utils import sha256, ser_string
+from vaults.utils import sha256
+from vaults.helpers.formatting import b2x, x
+from vaults.timelocks import get_script_timelocks
 from vaults.loggingconfig import logger
 
 from vaults.models.script_templates import (
+    UserScriptTemplate,
     ColdStorageScriptTemplate,
     ShardScriptTemplate,
     BasicPresignedScriptTemplate,
 )
 
-from vaults.models.plans import InitialTransaction
+# Script templates that get an OP_CHECKTEMPLATEVERIFY script, see
+# bake_ctv_output. The other UTXOs keep their presigned script.
+CTV_SCRIPT_TEMPLATES = (
+    ColdStorageScriptTemplate,
+    ShardScriptTemplate,
+    BasicPresignedScriptTemplate,
+)
+
+from vaults.models.plans import PlannedUTXO, InitialTransaction, RevaultStub
+from vaults.planner import expand_revault_stub
+from vaults.signing import parameterize_planned_utxos
+from vaults.validation import get_standard_template_hash
 from vaults.exceptions import VaultException
+from vaults.metrics import count
+from vaults.context import get_current_plan_context, uses_plan_context
 
 def compute_standard_template_hash(child_transaction, nIn):
     """
@@ -64,51 +80,27 @@ def compute_standard_template_hash(child_transaction, nIn):
     if child_transaction.ctv_baked == False and child_transaction.ctv_bitcoin_transaction == None:
         raise VaultException("Error: child transaction is not baked.")
 
-    bitcoin_transaction = child_transaction.ctv_bitcoin_transaction
-
-    nVersion = 2
-    nLockTime = 0
+    count("ctv_hashes")
+    return get_standard_template_hash(child_transaction.ctv_bitcoin_transaction, nIn)
 
-    r = b""
-    r += struct.pack("<i", nVersion)
-    r += struct.pack("<I", nLockTime)
-    if any(inp.scriptSig for inp in bitcoin_transaction.vin):
-        r += sha256(b"".join(ser_string(inp.scriptSig) for inp in bitcoin_transaction.vin))
-    r += struct.pack("<I", len(bitcoin_transaction.vin))
-    r += sha256(b"".join(struct.pack("<I", inp.nSequence) for inp in bitcoin_transaction.vin))
-    r += struct.pack("<I", len(bitcoin_transaction.vout))
-    r += sha256(b"".join(out.serialize() for out in bitcoin_transaction.vout))
-    r += struct.pack("<I", nIn)
-
-    return sha256(r)
-
-def construct_ctv_script_fragment_and_witness_fragments(child_transactions, parameters=None):
+def get_spending_input_index(child_transaction, planned_utxo):
     """
-    Make a script for the OP_CHECKTEMPLATEVERIFY section.
+    The index of the input of the child transaction that spends the given
+    UTXO. The UTXO's script commits to the child transaction's standard
+    template hash for that input (like the sweep transaction, which spends
+    many shards).
     """
+    for (idx, some_input) in enumerate(child_transaction.inputs):
+        if some_input.utxo == planned_utxo:
+            return idx
+    raise VaultException("Transaction {} doesn't spend UTXO {}".format(child_transaction.name, planned_utxo.name))
 
+def compute_template_hashes(planned_utxo, child_transactions, parameters=None):
     """
-    scriptPubKey: OP_0 sha256(redeemScript)
-    redeemScript: <template0> <template1> <template n-1> (n) OP_ROLL OP_ROLL OP_CTV (and then all the OP_DROPs)
-    witness: x
-    full script when executing:  x <template0> <template1> <template n-1> (n) OP_ROLL OP_ROLL OP_CTV (and then all the OP_DROPs)
-    which template gets selected? template x
+    Compute the standard template hash of each of the given child
+    transactions, in order, for the input that spends planned_utxo.
     """
-
-    # <t1> <tn> <n> OP_ROLL OP_ROLL OP_CTV (some_clever_function(n))* OP_2DROP (another_clever_function(n))*OP_DROP
-    # some_clever_function
-    # another_clever_function
-    # number of 2drops: if n is odd, then do enough 2 drops to leave 1 item on
-    # number of 2drops: If N is even, do enough 2 drops to leave 2 items on, then do 1 drop
-
-    # actually it is just N not N+1
-    # 0 OP_ROLL is just a NOP
-    # 1 is the one one back,
-
-    child_transactions = sorted(child_transactions, key=lambda x: str(x.internal_id))
-
-    some_script = []
-
+    template_hashes = []
     for child_transaction in child_transactions:
         # Bake each of the child transactions: that is, compute standard
         # template hashes on all of the children of the current child. Set
@@ -116,33 +108,39 @@ def construct_ctv_script_fragment_and_witness_fragments(child_transactions, para
         # inputs, that function looks at
         # some_input.utxo.transaction.ctv_bitcoin_transaction which doesn't
         # exist yet. Note that the standard template hash doesn't include
-        # inputs (so the txids referenced by inputs don't modify the standard
-        # template hash result).
+        # the txids of the inputs (so the txids referenced by inputs don't
+        # modify the standard template hash result).
         bake_ctv_transaction(child_transaction, skip_inputs=True, parameters=parameters)
 
         # The transaction is now ready to be convered into a standard template
         # hash for bip119.
-        standard_template_hash = compute_standard_template_hash(child_transaction, nIn=0)
+        nIn = get_spending_input_index(child_transaction, planned_utxo)
+        standard_template_hash = compute_standard_template_hash(child_transaction, nIn=nIn)
+
+        template_hashes.append(standard_template_hash)
 
-        some_script.append(standard_template_hash)
+    return template_hashes
 
-    if len(child_transactions) == 0:
+def make_ctv_script_fragment(template_hashes):
+    """
+    Make the OP_CHECKTEMPLATEVERIFY section of a script, which lets the
+    witness select one of the given standard template hashes.
+    """
+    some_script = list(template_hashes)
+
+    if len(template_hashes) == 0:
         some_script.append(b"\x00")
     else:
-        some_script.append(bitcoin.core._bignum.bn2vch(len(child_transactions)))
+        some_script.append(bitcoin.core._bignum.bn2vch(len(template_hashes)))
     some_script.extend([OP_ROLL, OP_ROLL, OP_NOP4])
 
     # Now append some OP_DROPs....
     # need to satisfy cleanstack for segwit (only one element left on the stack)
-    num_2drops = 0
-    num_1drops = 0
-
-    if len(child_transactions) % 2 == 0:
-        num_2drops = (len(child_transactions) / 2) - 1
-        num_1drops = 1
-    elif len(child_transactions) % 2 == 1:
-        num_2drops = len(child_transactions) - 1
-        num_1drops = 0
+    # After OP_CHECKTEMPLATEVERIFY, all the templates are still on the stack:
+    # drop all but one of them.
+    num_extra_items = max(len(template_hashes) - 1, 0)
+    num_2drops = num_extra_items // 2
+    num_1drops = num_extra_items % 2
 
     if num_2drops > 0:
         some_script.extend([OP_2DROP] * num_2drops)
@@ -152,9 +150,63 @@ def construct_ctv_script_fragment_and_witness_fragments(child_transactions, para
     elif num_1drops > 1:
         raise VaultException("this shouldn't happen.. more than one 1drop required?")
 
+    return some_script
+
+def construct_ctv_script_fragment_and_witness_fragments(planned_utxo, child_transactions, parameters=None, extra_template_hashes=None):
+    """
+    Make a script for the OP_CHECKTEMPLATEVERIFY section of planned_utxo.
+    extra_template_hashes are templates for child transactions that aren't
+    planned yet.
+    """
+
+    """
+    scriptPubKey: OP_0 sha256(redeemScript)
+    redeemScript: <template0> <template1> <template n-1> (n) OP_ROLL OP_ROLL OP_CTV (and then all the OP_DROPs)
+    witness: x
+    full script when executing:  x <template0> <template1> <template n-1> (n) OP_ROLL OP_ROLL OP_CTV (and then all the OP_DROPs)
+    which template gets selected? template n-1-x
+    """
+
+    # <t1> <tn> <n> OP_ROLL OP_ROLL OP_CTV (some_clever_function(n))* OP_2DROP (another_clever_function(n))*OP_DROP
+    # some_clever_function
+    # another_clever_function
+    # number of 2drops: if n is odd, then do enough 2 drops to leave 1 item on
+    # number of 2drops: If N is even, do enough 2 drops to leave 2 items on, then do 1 drop
+
+    # actually it is just N not N+1
+    # 0 OP_ROLL is just a NOP
+    # 1 is the one one back,
+
+    # Keep the planned order of the child transactions, instead of sorting by
+    # the (random) internal ids, so that the script only depends on what the
+    # tree looks like. See planner.expand_revault_stub.
+    child_transactions = list(child_transactions)
+
+    template_hashes = compute_template_hashes(planned_utxo, child_transactions, parameters=parameters)
+
+    # Lazy re-vault subtrees (see planner.expand_revault_stub) come after the
+    # planned child transactions, in the order they will be planned in.
+    if extra_template_hashes != None:
+        template_hashes.extend(extra_template_hashes)
+
+    some_script = make_ctv_script_fragment(template_hashes)
+
+    # <n> OP_ROLL brings the witness value x to the top of the stack, and then
+    # x OP_ROLL picks the template x items down from the top, so the last
+    # template is selected with 0 and the first template with n-1.
+    witness_fragments = make_ctv_witness_fragments(child_transactions, len(template_hashes))
+
+    return (some_script, witness_fragments)
+
+def make_ctv_witness_fragments(child_transactions, num_template_hashes):
+    """
+    Make the witness value that selects each child transaction's template,
+    for a script made by make_ctv_script_fragment with num_template_hashes
+    templates. Returns a dictionary by the child transaction's internal id.
+    """
     witness_fragments = {}
-    for child_transaction in child_transactions:
-        some_index = child_transactions.index(child_transaction)
+    for (idx, child_transaction) in enumerate(child_transactions):
+        some_index = num_template_hashes - 1 - idx
         if some_index == 0:
             wit_frag = int(some_index).to_bytes(1, byteorder="big")
         elif some_index > 0:
@@ -163,7 +215,7 @@ def construct_ctv_script_fragment_and_witness_fragments(child_transactions, para
         #witness_fragments[str(child_transaction.internal_id)] = [some_index]
         #witness_fragments[str(child_transaction.internal_id)] = [] #[child_transactions.index(child_transaction)]
 
-    return (some_script, witness_fragments)
+    return witness_fragments
 
 def bake_ctv_output(some_planned_utxo, parameters=None):
     """
@@ -185,6 +237,11 @@ def bake_ctv_output(some_planned_utxo, parameters=None):
 
     utxo = some_planned_utxo
 
+    # The script only has to be recomputed when this UTXO, or something below
+    # it in the tree, changed since the last time it was baked.
+    if not utxo.ctv_is_dirty and (utxo.ctv_script != None or utxo.ctv_bypass):
+        return
+
     # Note that the CTV fragment of the script isn't the only part. There might
     # be some other branches, like for hot wallet spending or something.
 
@@ -201,27 +258,15 @@ def bake_ctv_output(some_planned_utxo, parameters=None):
 
     script_template_class = utxo.script_template
 
-    has_extra_branch = None
-    if script_template_class in [ColdStorageScriptTemplate, ShardScriptTemplate]:
-        has_extra_branch = True
-    else:
-        has_extra_branch = False
+    # The child transactions that a re-vault stub will plan are committed to
+    # as well.
+    extra_template_hashes = None
+    if utxo.revault_stub != None:
+        extra_template_hashes = get_revault_stub_template_hashes(utxo, parameters=parameters)
 
     # Recurse down the tree and calculate the ScriptTemplateHash values for
     # OP_CHECKTEMPLATEVERIFY.
-    (ctv_script_fragment, witness_fragments) = construct_ctv_script_fragment_and_witness_fragments(utxo.child_transactions, parameters=parameters)
-
-    # The remaining work of the current function is to setup the inputs that
-    # spend the current output, and make sure they have the appropriate witness
-    # values (as determined by the output's script template and output's
-    # script).
-
-    # By convention, the key spends are in the first part of the OP_IF block.
-    if has_extra_branch:
-        for (some_key, witness_fragment) in witness_fragments.items():
-            #witness_fragment.append(OP_0) # OP_FALSE
-            # TODO: Why can't we just use OP_0 ?
-            witness_fragment.append(b"\x00")
+    (ctv_script_fragment, witness_fragments) = construct_ctv_script_fragment_and_witness_fragments(utxo, utxo.child_transactions, parameters=parameters, extra_template_hashes=extra_template_hashes)
 
     # Note that we're not going to construct any witness_fragments for the key
     # spend scenario. It is up to the user to create a valid witness script on
@@ -234,14 +279,15 @@ def bake_ctv_output(some_planned_utxo, parameters=None):
     coldkey2 = parameters["cold_key2"]["public_key"]
     hotkey1 = parameters["hot_wallet_key"]["public_key"]
 
-    # TODO: use a variable for the OP_CSV value. Use the
-    # ScriptTemplate.relative_timelocks.
+    # The key spend branches use the same relative timelocks as the presigned
+    # version of the script template (see timelocks.py).
+    script_timelocks = get_script_timelocks(utxo)
 
     script = None
     if script_template_class == ColdStorageScriptTemplate:
-        script = [OP_IF, coldkey1, OP_CHECKSIGVERIFY, coldkey2, OP_CHECKSIGVERIFY, bitcoin.core._bignum.bn2vch(144*2), OP_NOP3, OP_ELSE] + ctv_script_fragment + [OP_ENDIF]
+        script = [OP_IF, coldkey1, OP_CHECKSIGVERIFY, coldkey2, OP_CHECKSIGVERIFY, bitcoin.core._bignum.bn2vch(script_timelocks["TIMELOCK1"]), OP_NOP3, OP_ELSE] + ctv_script_fragment + [OP_ENDIF]
     elif script_template_class == ShardScriptTemplate:
-        script = [OP_IF, hotkey1, OP_CHECKSIGVERIFY, bitcoin.core._bignum.bn2vch(144*2), OP_NOP3, OP_ELSE] + ctv_script_fragment + [OP_ENDIF]
+        script = [OP_IF, hotkey1, OP_CHECKSIGVERIFY, bitcoin.core._bignum.bn2vch(script_timelocks["TIMELOCK1"]), OP_NOP3, OP_ELSE] + ctv_script_fragment + [OP_ENDIF]
     elif script_template_class == BasicPresignedScriptTemplate:
         script = ctv_script_fragment
     else:
@@ -250,12 +296,28 @@ def bake_ctv_output(some_planned_utxo, parameters=None):
         # transaction in the list (it's based on ordering).
 
         utxo.ctv_bypass = True
+        utxo.ctv_is_dirty = False
 
         if utxo.name == "vault initial UTXO":
             raise VaultException("Should have been processed earlier...")
 
         return
 
+    apply_ctv_script(utxo, script, witness_fragments)
+
+def apply_ctv_script(utxo, script, witness_fragments):
+    """
+    Store a baked OP_CHECKTEMPLATEVERIFY script on the UTXO, and setup the
+    inputs that spend the UTXO with the appropriate witness values (as
+    determined by the output's script template and output's script).
+    """
+    # By convention, the key spends are in the first part of the OP_IF block.
+    if utxo.script_template in [ColdStorageScriptTemplate, ShardScriptTemplate]:
+        for (some_key, witness_fragment) in witness_fragments.items():
+            #witness_fragment.append(OP_0) # OP_FALSE
+            # TODO: Why can't we just use OP_0 ?
+            witness_fragment.append(b"\x00")
+
     # Store this data on the UTXO object. It gets used later.
     utxo.ctv_script = CScript(script)
     utxo.ctv_witness_fragments = witness_fragments
@@ -280,6 +342,8 @@ def bake_ctv_output(some_planned_utxo, parameters=None):
         specific_input.ctv_witness = CScript(appropriate_witness)
         specific_input.ctv_p2wsh_redeem_script = script
 
+    utxo.ctv_is_dirty = False
+
 def bake_ctv_transaction(some_transaction, skip_inputs=False, parameters=None):
     """
     Create a OP_CHECKTEMPLATEVERIFY version transaction for the planned
@@ -298,7 +362,7 @@ def bake_ctv_transaction(some_transaction, skip_inputs=False, parameters=None):
     See the docstring for bake_ctv_output too.
     """
 
-    if hasattr(some_transaction, "ctv_baked") and some_transaction.ctv_baked == True:
+    if some_transaction.ctv_baked == True:
         return some_transaction.ctv_bitcoin_transaction
 
     # Bake each UTXO. Recurse down the tree and compute StandardTemplateHash
@@ -311,45 +375,43 @@ def bake_ctv_transaction(some_transaction, skip_inputs=False, parameters=None):
     # Construct python-bitcoinlib bitcoin transactions and attach them to the
     # PlannedTransaction objects, once all the UTXOs are ready.
 
-    logger.info("Baking a transaction with name {}".format(some_transaction.name))
+    logger.debug("Baking a transaction with name %s", some_transaction.name)
 
     bitcoin_inputs = []
-    if not skip_inputs:
-        for some_input in some_transaction.inputs:
-
-            # When computing the standard template hash for a child transaction,
-            # the child transaction needs to be only "partially" baked. It doesn't
-            # need to have the inputs yet.
-
-            if some_input.utxo.transaction.__class__ == InitialTransaction or some_input.transaction.name == "Burn some UTXO":
-                txid = some_input.utxo.transaction.txid
-            else:
-                logger.info("The parent transaction name is: {}".format(some_input.utxo.transaction.name))
-                logger.info("Name of the UTXO being spent: {}".format(some_input.utxo.name))
-                logger.info("Current transaction name: {}".format(some_input.transaction.name))
-
-                # This shouldn't happen... We should be able to bake transactions
-                # in a certain order and be done with this.
-                #if not hasattr(some_input.utxo.transaction, "ctv_bitcoin_transaction"):
-                #    bake_ctv_transaction(some_input.utxo.transaction, parameters=parameters)
-                # TODO: this creates an infinite loop....
+    for some_input in some_transaction.inputs:
+        # Same nSequence as the presigned version of the transaction.
+        relative_timelock = some_input.relative_timelock
+        if relative_timelock == None:
+            relative_timelock = 0xffffffff
+
+        # When computing the standard template hash for a child transaction,
+        # the child transaction needs to be only "partially" baked. It doesn't
+        # need to have the txids of the inputs yet, but the standard template
+        # hash does commit to the number of inputs and their nSequence
+        # values, so use a null prevout until the parent is baked.
+        if skip_inputs:
+            bitcoin_inputs.append(CTxIn(COutPoint(), nSequence=relative_timelock))
+            continue
+
+        if some_input.utxo.transaction.__class__ == InitialTransaction:
+            txid = some_input.utxo.txid
+        else:
+            logger.debug("The parent transaction name is: %s", some_input.utxo.transaction.name)
+            logger.debug("Name of the UTXO being spent: %s", some_input.utxo.name)
+            logger.debug("Current transaction name: %s", some_input.transaction.name)
 
-                txid = some_input.utxo.transaction.ctv_bitcoin_transaction.GetTxid()
+            # This shouldn't happen... We should be able to bake transactions
+            # in a certain order and be done with this.
+            #if not hasattr(some_input.utxo.transaction, "ctv_bitcoin_transaction"):
+            #    bake_ctv_transaction(some_input.utxo.transaction, parameters=parameters)
+            # TODO: this creates an infinite loop....
 
-            vout = some_input.utxo.transaction.output_utxos.index(some_input.utxo)
+            txid = some_input.utxo.transaction.ctv_bitcoin_transaction.GetTxid()
 
-            relative_timelock = None
-            if some_input.utxo.script_template.__class__ in [ColdStorageScriptTemplate, ShardScriptTemplate]:
-                # TODO: This should be controlled by the template or whole
-                # program parameters.
-                relative_timelock = 144
+        vout = some_input.utxo.vout
 
-            if relative_timelock:
-                bitcoin_input = CTxIn(COutPoint(txid, vout), nSequence=relative_timelock)
-            else:
-                bitcoin_input = CTxIn(COutPoint(txid, vout))
-
-            bitcoin_inputs.append(bitcoin_input)
+        bitcoin_input = CTxIn(COutPoint(txid, vout), nSequence=relative_timelock)
+        bitcoin_inputs.append(bitcoin_input)
 
     bitcoin_outputs = []
     for some_output in some_transaction.output_utxos:
@@ -357,7 +419,7 @@ def bake_ctv_transaction(some_transaction, skip_inputs=False, parameters=None):
 
         # For certain UTXOs, just use the previous UTXO script templates,
         # instead of the CTV version. (utxo.ctv_bypass == True)
-        if hasattr(some_output, "ctv_bypass"):
+        if some_output.ctv_bypass:
             scriptpubkey = some_output.scriptpubkey
         else:
             scriptpubkey = some_output.ctv_scriptpubkey
@@ -370,11 +432,13 @@ def bake_ctv_transaction(some_transaction, skip_inputs=False, parameters=None):
     if not skip_inputs:
         witnesses = []
         for some_input in some_transaction.inputs:
-            logger.info("Transaction name: {}".format(some_transaction.name))
-            logger.info("Spending UTXO with name: {}".format(some_input.utxo.name))
-            logger.info("Parent transaction name: {}".format(some_input.utxo.transaction.name))
+            logger.debug("Transaction name: %s", some_transaction.name)
+            logger.debug("Spending UTXO with name: %s", some_input.utxo.name)
+            logger.debug("Parent transaction name: %s", some_input.utxo.transaction.name)
 
-            if some_transaction.name in ["Burn some UTXO", "Funding commitment transaction"]:
+            # The user's coins (spent by the funding commitment transaction)
+            # keep the user's signature.
+            if some_input.utxo.script_template == UserScriptTemplate:
                 witness = some_input.witness
             else:
                 witness = some_input.ctv_witness
@@ -392,13 +456,373 @@ def bake_ctv_transaction(some_transaction, skip_inputs=False, parameters=None):
 
     if not skip_inputs:
         some_transaction.ctv_baked = True
+        some_transaction.ctv_is_dirty = False
 
     return bitcoin_transaction
 
-def make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=None):
+def propagate_ctv_dirty_state(planned_transactions):
+    """
+    Work out which parts of a previously baked tree have to be baked again,
+    based on the dirty flags of the planned UTXOs and transactions.
+
+    A changed output changes the standard template hash of the transaction
+    that creates it. That hash is committed to by the script of each UTXO that
+    the transaction spends, so the change travels upwards towards the root of
+    the tree. Every transaction below a re-hashed transaction then spends a
+    new txid, so those only need their inputs re-assigned; their own standard
+    template hashes stay the same.
+
+    Returns the number of transactions that will be re-hashed.
+    """
+    stack = []
+    for some_transaction in planned_transactions:
+        if some_transaction.ctv_is_dirty or any([some_utxo.ctv_is_dirty for some_utxo in some_transaction.output_utxos]):
+            stack.append(some_transaction)
+
+    rehashed_transactions = set()
+    while len(stack) > 0:
+        some_transaction = stack.pop()
+        if some_transaction in rehashed_transactions:
+            continue
+        rehashed_transactions.add(some_transaction)
+
+        for some_input in some_transaction.inputs:
+            parent_utxo = some_input.utxo
+            if parent_utxo.transaction.__class__ == InitialTransaction:
+                continue
+
+            parent_utxo.ctv_is_dirty = True
+            stack.append(parent_utxo.transaction)
+
+    stack = list(rehashed_transactions)
+    rebaked_transactions = set()
+    while len(stack) > 0:
+        some_transaction = stack.pop()
+        if some_transaction in rebaked_transactions:
+            continue
+        rebaked_transactions.add(some_transaction)
+
+        some_transaction.ctv_baked = False
+        stack.extend(some_transaction.child_transactions)
+
+    return len(rehashed_transactions)
+
+def make_revault_level_tasks(planned_utxo, parameters=None):
+    """
+    Make one task for each level of the UTXO's re-vault chain, for
+    bake_revault_level_task. The levels with the most shards come first,
+    because they take the longest. Tasks only have the public parameters.
+    """
+    stub = planned_utxo.revault_stub
+
+    tasks = []
+    for num_shards in range(stub.num_shards, 0, -1):
+        level_stub = RevaultStub(
+            per_shard_amount=stub.per_shard_amount,
+            num_shards=num_shards,
+            original_num_shards=stub.original_num_shards,
+            depth=stub.depth + stub.num_shards - num_shards,
+            parameters=parameters,
+        )
+        tasks.append((level_stub.to_dict(), planned_utxo.name, planned_utxo.script_template, planned_utxo.timelock_multiplier))
+
+    return tasks
+
+def bake_revault_level_task(task):
+    """
+    Plan and bake one level of a re-vault chain on a placeholder UTXO. This
+    runs in the worker processes.
+
+    The levels don't depend on each other, except that the re-vault output of
+    each level commits to the level below it. The transaction with that output
+    is baked with a placeholder script, and returned as the serialized
+    transaction, the index of its input that spends the level's UTXO, the
+    vout of the re-vault output, and the template hashes of
+    the re-vault output's planned child transactions. The other transactions
+    are returned as their template hashes. See fold_revault_level_results.
+
+    Returns (number of shards, results).
+    """
+    (stub_data, name, script_template, timelock_multiplier) = task
+    stub = RevaultStub.from_dict(stub_data)
+
+    level_utxo = PlannedUTXO(
+        name=name,
+        script_template=script_template,
+        amount=stub.num_shards * stub.per_shard_amount,
+        timelock_multiplier=timelock_multiplier,
+    )
+    level_utxo.revault_stub = stub
+    level_transactions = expand_revault_stub(level_utxo, parameters=stub.parameters)
+
+    (level_utxos, level_planned_transactions) = level_utxo.crawl()
+    parameterize_planned_utxos(level_utxos, parameters=stub.parameters)
+
+    results = []
+    for level_transaction in level_transactions:
+        revault_vouts = [vout for (vout, some_utxo) in enumerate(level_transaction.output_utxos) if some_utxo.revault_stub != None]
+        if len(revault_vouts) == 0:
+            results.extend(compute_template_hashes(level_utxo, [level_transaction], parameters=stub.parameters))
+            continue
+
+        revault_utxo = level_transaction.output_utxos[revault_vouts[0]]
+        planned_child_hashes = compute_template_hashes(revault_utxo, revault_utxo.child_transactions, parameters=stub.parameters)
+
+        # Skip the rest of the chain (see bake_ctv_output).
+        revault_utxo.ctv_script = CScript()
+        revault_utxo.ctv_scriptpubkey = CScript()
+        revault_utxo.ctv_is_dirty = False
+
+        bitcoin_transaction = bake_ctv_transaction(level_transaction, skip_inputs=True, parameters=stub.parameters)
+        nIn = get_spending_input_index(level_transaction, level_utxo)
+        results.append((bitcoin_transaction.serialize(), nIn, revault_vouts[0], planned_child_hashes))
+
+    return (stub.num_shards, results)
+
+def fold_revault_level_results(level_results):
+    """
+    Combine the results of bake_revault_level_task into the template hashes of
+    a whole re-vault chain. This starts from the deepest level (one shard
+    left), which doesn't re-vault anything, and works upwards: the script of
+    each re-vault output is made from the hashes of the level below it, which
+    finishes the transaction that creates it.
+
+    Returns the template hashes of each level, shallowest first, like
+    RevaultStub.template_hashes.
+    """
+    template_hashes = []
+    for (num_shards, results) in sorted(level_results, key=lambda level_result: level_result[0]):
+        if num_shards != len(template_hashes) + 1:
+            raise VaultException("Missing re-vault level with {} shards".format(len(template_hashes) + 1))
+
+        level_hashes = []
+        for result in results:
+            if isinstance(result, bytes):
+                level_hashes.append(result)
+                continue
+
+            (transaction_bytes, nIn, vout, planned_child_hashes) = result
+
+            # Same script as bake_ctv_output makes for a re-vault UTXO
+            # (BasicPresignedScriptTemplate) with a stub.
+            redeem_script = CScript(make_ctv_script_fragment(planned_child_hashes + template_hashes[0]))
+            scriptpubkey = CScript([OP_0, sha256(bytes(redeem_script))])
+
+            bitcoin_transaction = CMutableTransaction.deserialize(transaction_bytes)
+            bitcoin_transaction.vout[vout] = CTxOut(bitcoin_transaction.vout[vout].nValue, scriptpubkey)
+            count("ctv_hashes")
+            level_hashes.append(get_standard_template_hash(bitcoin_transaction, nIn=nIn))
+
+        template_hashes.insert(0, level_hashes)
+
+    return template_hashes
+
+def get_revault_stub_template_hashes(planned_utxo, parameters=None, processes=None):
+    """
+    Get the standard template hashes of the child transactions that the
+    UTXO's re-vault stub will plan (see planner.expand_revault_stub).
+
+    Each level of the re-vault chain is planned and baked on its own
+    placeholder UTXO by bake_revault_level_task, in a pool of worker
+    processes, and thrown away once its results are known. Only combining the
+    results is done in order (see fold_revault_level_results). The hashes for
+    the whole chain are kept on the stub.
+
+    The number of processes comes from parameters["planning_processes"], or
+    from the number of CPUs. Use processes=1 to skip the process pool.
+    """
+    stub = planned_utxo.revault_stub
+
+    if stub.template_hashes == None:
+        if parameters == None:
+            parameters = stub.parameters
+
+        tasks = make_revault_level_tasks(planned_utxo, parameters=parameters)
+
+        if processes == None:
+            processes = parameters.get("planning_processes", None)
+        if processes == None:
+            processes = min(multiprocessing.cpu_count(), max(1, len(tasks) // 16))
+
+        if processes <= 1:
+            level_results = list(map(bake_revault_level_task, tasks))
+        else:
+            with multiprocessing.Pool(processes=processes) as pool:
+                level_results = list(pool.imap_unordered(bake_revault_level_task, tasks))
+
+        stub.template_hashes = fold_revault_level_results(level_results)
+        logger.info("Computed template hashes for a re-vault stub with {} shards ({} processes)".format(stub.num_shards, processes))
+
+    return stub.template_hashes[0]
+
+@uses_plan_context
+def materialize_revault_stub(planned_utxo, parameters=None):
+    """
+    Plan and bake the next level of a lazy re-vault subtree, such as when the
+    re-vault UTXO gets confirmed and its child transactions are needed. The
+    transaction that creates the UTXO has to be baked already (or loaded from
+    the OP_CHECKTEMPLATEVERIFY transaction store).
+
+    Raises VaultException when the new transactions don't match the script
+    that the UTXO was committed to. Returns the new child transactions.
+    """
+    if planned_utxo.revault_stub == None:
+        raise VaultException("UTXO {} has no re-vault stub".format(planned_utxo.name))
+
+    if parameters == None:
+        parameters = planned_utxo.revault_stub.parameters
+
+    parent_transaction = planned_utxo.transaction
+    if parent_transaction.ctv_bitcoin_transaction == None:
+        raise VaultException("The transaction that creates UTXO {} is not baked".format(planned_utxo.name))
+    committed_scriptpubkey = parent_transaction.ctv_bitcoin_transaction.vout[planned_utxo.vout].scriptPubKey
+
+    # The rest of the chain gets the hashes from this stub.
+    get_revault_stub_template_hashes(planned_utxo, parameters=parameters)
+    depth = planned_utxo.revault_stub.depth
+
+    new_transactions = expand_revault_stub(planned_utxo, parameters=parameters)
+
+    # UTXOs loaded from a transaction store don't have their scripts, only
+    # the baked transactions do.
+    (planned_utxos, planned_transactions) = planned_utxo.crawl()
+    parameterize_planned_utxos([some_utxo for some_utxo in planned_utxos if some_utxo.scriptpubkey == None], parameters=parameters)
+
+    planned_utxo.ctv_is_dirty = True
+    bake_ctv_output(planned_utxo, parameters=parameters)
+    if planned_utxo.ctv_scriptpubkey != committed_scriptpubkey:
+        raise VaultException("The planned subtree of UTXO {} doesn't match its committed script".format(planned_utxo.name))
+
+    planned_transactions = [some_transaction for some_transaction in planned_transactions if some_transaction != None and not some_transaction.ctv_baked]
+    for planned_transaction in sorted(planned_transactions, key=lambda tx: tx.id):
+        bake_ctv_transaction(planned_transaction, parameters=parameters)
+
+    logger.info("Planned and baked {} transactions for the re-vault stub at depth {}".format(len(planned_transactions), depth))
+
+    return new_transactions
+
+def get_script_template_hashes(script):
+    """
+    The standard template hashes that an OP_CHECKTEMPLATEVERIFY script (see
+    make_ctv_script_fragment) commits to, in order. The public keys in the
+    scripts are 33 bytes, so the 32 byte pushes are the template hashes.
+    """
+    return [some_op for some_op in script if type(some_op) == bytes and len(some_op) == 32]
+
+def load_baked_scripts(planned_utxos, plan_cache):
+    """
+    Use the OP_CHECKTEMPLATEVERIFY scripts from a plan cache (see
+    persist.PlanCache) for the UTXOs that have to be baked, instead of
+    computing their standard template hashes again. UTXOs that aren't in the
+    cache, or whose child transactions don't match the cached script, are
+    left alone. Returns the UTXOs that got a cached script, which have to be
+    checked with check_baked_scripts once the tree is baked.
+    """
+    loaded_utxos = []
+    for planned_utxo in planned_utxos:
+        internal_id = str(planned_utxo.internal_id)
+
+        if planned_utxo.revault_stub != None and planned_utxo.revault_stub.template_hashes == None and internal_id in plan_cache.stubs:
+            planned_utxo.revault_stub.template_hashes = [[x(some_hash) for some_hash in level] for level in plan_cache.stubs[internal_id]]
+
+        if not planned_utxo.ctv_is_dirty or internal_id not in plan_cache.scripts:
+            continue
+
+        cached_script = plan_cache.scripts[internal_id]
+        if cached_script == None:
+            # Only UTXOs without an OP_CHECKTEMPLATEVERIFY script template
+            # are bypassed.
+            if planned_utxo.script_template in CTV_SCRIPT_TEMPLATES:
+                continue
+            planned_utxo.ctv_bypass = True
+            planned_utxo.ctv_is_dirty = False
+            loaded_utxos.append(planned_utxo)
+            continue
+
+        (script_hex, num_template_hashes) = cached_script
+
+        num_planned_template_hashes = len(planned_utxo.child_transactions)
+        if planned_utxo.revault_stub != None:
+            num_planned_template_hashes += len(get_revault_stub_template_hashes(planned_utxo))
+        if num_planned_template_hashes != num_template_hashes:
+            continue
+
+        witness_fragments = make_ctv_witness_fragments(planned_utxo.child_transactions, num_template_hashes)
+        apply_ctv_script(planned_utxo, CScript(x(script_hex)), witness_fragments)
+        loaded_utxos.append(planned_utxo)
+
+    return loaded_utxos
+
+def check_baked_scripts(planned_utxos):
+    """
+    Compare the template hashes in the scripts of the given UTXOs (from
+    load_baked_scripts) to the standard template hashes of their baked child
+    transactions. The template hashes of a re-vault stub are not planned
+    again, so they are taken as they are. Returns the UTXOs whose script
+    doesn't match.
+    """
+    mismatched_utxos = []
+    for planned_utxo in planned_utxos:
+        if planned_utxo.ctv_bypass:
+            continue
+
+        template_hashes = [compute_standard_template_hash(child_transaction, nIn=get_spending_input_index(child_transaction, planned_utxo)) for child_transaction in planned_utxo.child_transactions]
+        if planned_utxo.revault_stub != None:
+            template_hashes.extend(get_revault_stub_template_hashes(planned_utxo))
+
+        if get_script_template_hashes(planned_utxo.ctv_script) != template_hashes:
+            mismatched_utxos.append(planned_utxo)
+
+    return mismatched_utxos
+
+def reset_baked_tree(planned_utxos, planned_transactions, plan_cache):
+    """
+    Forget every baked script and transaction (and the cached re-vault stub
+    template hashes), so that the whole tree gets baked from scratch.
+    """
+    for planned_utxo in planned_utxos:
+        if planned_utxo.revault_stub != None and str(planned_utxo.internal_id) in plan_cache.stubs:
+            planned_utxo.revault_stub.template_hashes = None
+        planned_utxo.ctv_script = None
+        planned_utxo.ctv_bypass = False
+        planned_utxo.ctv_is_dirty = True
+
+    for planned_transaction in planned_transactions:
+        planned_transaction.ctv_baked = False
+        planned_transaction.ctv_is_dirty = True
+
+def store_baked_scripts(planned_utxos, plan_cache):
+    """
+    Copy the baked OP_CHECKTEMPLATEVERIFY scripts of the UTXOs into a plan
+    cache. The cache still has to be saved.
+    """
+    for planned_utxo in planned_utxos:
+        internal_id = str(planned_utxo.internal_id)
+
+        if planned_utxo.ctv_bypass:
+            plan_cache.scripts[internal_id] = None
+            continue
+        elif planned_utxo.ctv_script == None:
+            continue
+
+        num_template_hashes = len(planned_utxo.child_transactions)
+        if planned_utxo.revault_stub != None:
+            stub_template_hashes = planned_utxo.revault_stub.template_hashes
+            num_template_hashes += len(stub_template_hashes[0])
+            plan_cache.stubs[internal_id] = [[b2x(some_hash) for some_hash in level] for level in stub_template_hashes]
+
+        plan_cache.scripts[internal_id] = [b2x(planned_utxo.ctv_script), num_template_hashes]
+
+@uses_plan_context
+def make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=None, plan_cache=None):
     """
     Mutate the planned transaction tree in place and convert it to a planned
     transaction tree that uses OP_CHECKTEMPLATEVERIFY.
+
+    With a plan cache (see persist.PlanCache), the scripts of a tree that was
+    baked before with the same parameters are loaded instead of computed, and
+    the cache gets the newly computed scripts. Only the txids, which depend
+    on the coin going into the vault, are always computed.
     """
     assert len(initial_tx.output_utxos[0].child_transactions) == 1
     vault_commitment_transaction = initial_tx.output_utxos[0].child_transactions[0]
@@ -406,13 +830,47 @@ def make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx
     initial_utxo = initial_tx.output_utxos[0]
     (planned_utxos, planned_transactions) = initial_utxo.crawl()
 
+    # Only the parts of the tree that changed since the last bake (if any) are
+    # baked again.
+    rehashed_count = propagate_ctv_dirty_state(planned_transactions)
+    logger.info("Re-hashing {} transactions".format(rehashed_count))
+
+    context = get_current_plan_context()
+    if plan_cache == None and context != None:
+        plan_cache = context.plan_cache
+
+    loaded_utxos = []
+    if plan_cache != None:
+        loaded_utxos = load_baked_scripts(planned_utxos, plan_cache)
+        logger.info("Loaded {} scripts from the plan cache".format(len(loaded_utxos)))
+
     #planned_transactions = reversed(sorted(planned_transactions, key=lambda tx: tx.id))
     planned_transactions = sorted(planned_transactions, key=lambda tx: tx.id)
 
     #bake_ctv_output(initial_utxo, parameters=parameters)
 
     for planned_transaction in planned_transactions:
+        if planned_transaction.ctv_baked == True:
+            continue
         bake_ctv_transaction(planned_transaction, parameters=parameters)
 
+    # A cached script is only kept when it commits to the transactions that
+    # were actually baked. Otherwise the cache is dropped and the tree is
+    # baked again without it.
+    if len(loaded_utxos) > 0:
+        mismatched_utxos = check_baked_scripts(loaded_utxos)
+        if len(mismatched_utxos) > 0:
+            logger.warning("{} scripts from the plan cache don't match the planned tree (like UTXO {}), baking the tree again without the cache".format(len(mismatched_utxos), mismatched_utxos[0].internal_id))
+            reset_baked_tree(planned_utxos, planned_transactions, plan_cache)
+            plan_cache.scripts = {}
+            plan_cache.stubs = {}
+
+            for planned_transaction in planned_transactions:
+                bake_ctv_transaction(planned_transaction, parameters=parameters)
+
+    if plan_cache != None:
+        store_baked_scripts(planned_utxos, plan_cache)
+        plan_cache.save()
+
     # The top level transaction should be fine now.
     return bake_ctv_transaction(vault_commitment_transaction, parameters=parameters)
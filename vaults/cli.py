@@ -1,50 +1,223 @@
 """
 Command line interface for the Vault library.
+
+Each command imports its module from vaults.commands when it runs, so that
+read-only commands like "vault info" don't pay for importing the planner,
+signing and OP_CHECKTEMPLATEVERIFY code that "vault init" needs (see
+vaults/benchmarks.py for measuring this).
 """
 
+import sys
+
 import click
 
-from vaults.commands.initialize import initialize
-from vaults.commands.broadcast import broadcast_next_transaction
-from vaults.commands.info import get_info
+# Options for the shape of the planned transaction tree, see plan_options.
+PLAN_OPTIONS = [
+    click.option("--num-shards", default=5, type=int, help="Number of shards."),
+    click.option("--sharding-mode", default="flat", type=click.Choice(["flat", "hierarchical"]), help="Sharding mode."),
+    click.option("--shard-group-size", default=None, type=int, help="Shards per group, for hierarchical sharding."),
+    click.option("--burn/--no-burn", default=True, help="Plan burn transactions for cold storage UTXOs."),
+    click.option("--sweeps/--no-sweeps", default=False, help="Plan sweep transactions."),
+    click.option("--max-sweep-transactions", default=None, type=int, help="Budget for the sweep (and their burn) transactions."),
+    click.option("--sweep-time-budget", default=None, type=float, help="Seconds to spend on planning sweep transactions."),
+    click.option("--spend-k-shards", multiple=True, type=int, help="Plan spend-k-shards transactions (can be repeated)."),
+    click.option("--max-planned-transactions", default=None, type=int, help="Budget for the whole transaction tree."),
+    click.option("--lazy-revault-depth", default=None, type=int, help="Plan only this many re-vault levels up front (OP_CHECKTEMPLATEVERIFY vault)."),
+    click.option("--timelock-mode", default="blocks", type=click.Choice(["blocks", "time"]), help="Count relative timelocks in blocks or in 512 second units."),
+    click.option("--timelock-base-interval", default=None, type=int, help="Interval between shards, in blocks or seconds depending on the timelock mode."),
+    click.option("--timelock-stage-size", default=None, type=int, help="Shards per stage of the stipend schedule."),
+]
+
+def plan_options(function):
+    """
+    Add the PLAN_OPTIONS to a command. See get_plan_parameters.
+    """
+    for option in reversed(PLAN_OPTIONS):
+        function = option(function)
+    return function
+
+def get_plan_parameters(num_shards, sharding_mode, shard_group_size, burn, sweeps, max_sweep_transactions, sweep_time_budget, spend_k_shards, max_planned_transactions, lazy_revault_depth, timelock_mode, timelock_base_interval, timelock_stage_size):
+    """
+    Convert the PLAN_OPTIONS into the number of shards and a dictionary of
+    extra vault parameters (see helpers.prototyping.make_parameters).
+    """
+    extra_parameters = {
+        "sharding_mode": sharding_mode,
+        "enable_burn_transactions": burn,
+        "enable_sweeps": sweeps,
+    }
+    optional_parameters = {
+        "shard_group_size": shard_group_size,
+        "max_sweep_transactions": max_sweep_transactions,
+        "sweep_time_budget": sweep_time_budget,
+        "max_planned_transactions": max_planned_transactions,
+        "lazy_revault_depth": lazy_revault_depth,
+        "timelock_base_interval": timelock_base_interval,
+        "timelock_stage_size": timelock_stage_size,
+    }
+    for (some_name, some_value) in optional_parameters.items():
+        if some_value != None:
+            extra_parameters[some_name] = some_value
+    if len(spend_k_shards) > 0:
+        extra_parameters["spend_k_shards"] = list(spend_k_shards)
+    if timelock_mode != "blocks":
+        extra_parameters["timelock_mode"] = timelock_mode
+    return (num_shards, extra_parameters)
 
 @click.group()
-def cli():
-    pass
+@click.option("--log-level", default="info", type=click.Choice(["debug", "info", "warning", "error"]), help="Log verbosity. The per-transaction signing and baking messages are logged at debug.")
+def cli(log_level):
+    from vaults.loggingconfig import set_log_level
+    set_log_level(log_level)
 
 @cli.command()
 @click.option("--private-key", default="cUB8G5cFtxc4usfgfovqRgCo8qTQUJtctLV8t6YYNfULg3GtehdX", help="Override insecure default bitcoin private key.")
-def init(private_key):
+@click.option("--pipeline/--no-pipeline", default=False, help="Journal signed transactions so that an interrupted init can be resumed.")
+@click.option("--processes", default=None, type=int, help="Worker processes for planning and baking (default: one per CPU).")
+@click.option("--plan-cache/--no-plan-cache", default=True, help="Reuse baked OP_CHECKTEMPLATEVERIFY scripts from vaults with the same parameters.")
+@click.option("--num-coins", default=1, type=int, help="Number of coins from the wallet to put into the vault.")
+@click.option("--graphviz/--no-graphviz", default=False, help="Also write a graphviz dotfile of the planned transaction tree.")
+@click.option("--profile/--no-profile", default=False, help="Measure peak memory too, and show the time and counters of each phase.")
+@plan_options
+def init(private_key, pipeline, processes, plan_cache, num_coins, graphviz, profile, **options):
     """
     Create a new vault in the current working directory.
 
     **Note**: The default --private-key value is insecure, it's the famous
     "correct horse battery staple" key.
+
+    With --pipeline, an interrupted init can be resumed by running the same
+    command again in the same directory.
+
+    The measurements of each phase are written to profile.json, and the
+    vault parameters (without the keys) to parameters.json.
     """
-    initialize(private_key=private_key)
+    (num_shards, extra_parameters) = get_plan_parameters(**options)
+
+    from vaults.commands.initialize import initialize
+    recorder = initialize(private_key=private_key, pipeline=pipeline, processes=processes, plan_cache=plan_cache, num_coins=num_coins, graphviz=graphviz, profile=profile, num_shards=num_shards, extra_parameters=extra_parameters)
+    if profile:
+        print(recorder.format_report())
 
 @cli.command()
-def info():
+@click.option("--private-key", default="cUB8G5cFtxc4usfgfovqRgCo8qTQUJtctLV8t6YYNfULg3GtehdX", help="Override insecure default bitcoin private key.")
+@click.option("--num-vaults", default=2, type=int, help="Number of vaults.")
+@click.option("--processes", default=None, type=int, help="Worker processes for planning the vaults (default: one per CPU).")
+@plan_options
+def farm(private_key, num_vaults, processes, **options):
+    """
+    Create many vaults in the current working directory, all funded by one
+    transaction.
+
+    **Note**: The default --private-key value is insecure, it's the famous
+    "correct horse battery staple" key.
+    """
+    (num_shards, extra_parameters) = get_plan_parameters(**options)
+
+    from vaults.commands.farm import initialize_farm
+    initialize_farm(private_key=private_key, num_vaults=num_vaults, num_shards=num_shards, processes=processes, extra_parameters=extra_parameters)
+
+@cli.command()
+@click.option("--private-key", default="cUB8G5cFtxc4usfgfovqRgCo8qTQUJtctLV8t6YYNfULg3GtehdX", help="Override insecure default bitcoin private key.")
+@click.option("--num-coins", default=1, type=int, help="Number of coins from the wallet to add to the vault.")
+def topup(private_key, num_coins):
+    """
+    Add more coins to the vault in the current working directory, before its
+    funding commitment transaction is broadcasted.
+    """
+    from vaults.commands.topup import top_up
+    top_up(private_key=private_key, num_coins=num_coins)
+
+@cli.command()
+@click.option("--ctv/--no-ctv", default=False, help="Use the OP_CHECKTEMPLATEVERIFY version of the vault.")
+def info(ctv):
     """
     Display vault state information, including last sync time.
     """
-    output = get_info()
+    from vaults.commands.info import get_info
+    output = get_info(ctv=ctv)
     print(output) # TODO: switch to logger?
 
 @cli.command()
-def status():
+@click.option("--ctv/--no-ctv", default=False, help="Use the OP_CHECKTEMPLATEVERIFY version of the vault.")
+def status(ctv):
     """
     same as info
     """
-    output = get_info()
+    from vaults.commands.info import get_info
+    output = get_info(ctv=ctv)
     print(output) # TODO: switch to logger?
 
 @cli.command()
+@click.option("--ctv/--no-ctv", default=False, help="Use the OP_CHECKTEMPLATEVERIFY version of the vault.")
+@click.option("--output", default="output.gv", help="Filename of the graphviz dotfile.")
+@click.option("--max-depth", default=None, type=int, help="Don't expand nodes deeper than this.")
+@click.option("--focus", default=None, help="Internal id of the transaction or UTXO to start from.")
+@click.option("--collapse/--no-collapse", default=True, help="Draw repeating subtrees as summary nodes.")
+@click.option("--view/--no-view", default=False, help="Open the rendered graph (requires graphviz).")
+def graph(ctv, output, max_depth, focus, collapse, view):
+    """
+    Write a graphviz dotfile of the planned transaction tree.
+    """
+    from vaults.commands.graph import make_graph
+    make_graph(output_filename=output, max_depth=max_depth, focus=focus, collapse=collapse, view=view, ctv=ctv)
+
+@cli.command()
+@click.option("--num-shards", multiple=True, type=int, help="Number of shards to benchmark (can be repeated, default: 5, 10 and 20).")
+@click.option("--burn", default="both", type=click.Choice(["on", "off", "both"]), help="Benchmark with burn transactions on, off or both.")
+@click.option("--sweeps", default="both", type=click.Choice(["on", "off", "both"]), help="Benchmark with sweeps on, off or both.")
+@click.option("--repeat", default=3, type=int, help="Keep the fastest of this many runs of each scenario.")
+@click.option("--memory/--no-memory", default=True, help="Measure peak memory in one more run of each scenario.")
+@click.option("--baseline", default="benchmark-baseline.json", help="Baseline file to compare to (created if missing).")
+@click.option("--update-baseline/--no-update-baseline", default=False, help="Save the results as the new baseline.")
+@click.option("--threshold", default=None, type=float, help="Fail when a phase is this much slower or bigger than the baseline (0.25 is 25%).")
+def bench(num_shards, burn, sweeps, repeat, memory, baseline, update_baseline, threshold):
+    """
+    Benchmark planning, signing, OP_CHECKTEMPLATEVERIFY baking and saving and
+    loading the transaction store, for several vault sizes. Doesn't need
+    bitcoind. Exits with an error if a phase regressed compared to the
+    baseline.
+    """
+    options = {"on": (True,), "off": (False,), "both": (True, False)}
+
+    from vaults.commands.bench import run_bench
+    (output, regressions) = run_bench(
+        num_shards_list=num_shards or None,
+        burn_options=options[burn],
+        sweeps_options=tuple(reversed(options[sweeps])),
+        repeat=repeat,
+        trace_memory=memory,
+        baseline_filename=baseline,
+        update_baseline=update_baseline,
+        threshold=threshold,
+    )
+    print(output)
+    if len(regressions) > 0:
+        sys.exit(1)
+
+@cli.command()
+@click.option("--ctv/--no-ctv", default=False, help="Use the OP_CHECKTEMPLATEVERIFY version of the vault.")
 @click.argument("internal_id")
-def broadcast(internal_id):
+def broadcast(ctv, internal_id):
     """
     Broadcast a specific transaction. Only if the transaction is one of the
     next possible transactions.
     """
-    broadcast_next_transaction(internal_id)
+    from vaults.commands.broadcast import broadcast_next_transaction
+    broadcast_next_transaction(internal_id, ctv=ctv)
+
+@cli.command()
+@click.option("--private-key", default="cUB8G5cFtxc4usfgfovqRgCo8qTQUJtctLV8t6YYNfULg3GtehdX", help="Override insecure default bitcoin private key.")
+@click.option("--calibrate/--no-calibrate", default=True, help="Predict sizes and times with a small benchmark.")
+@plan_options
+def estimate(private_key, calibrate, **options):
+    """
+    Estimate the size of the planned transaction tree, the size of the
+    transaction stores and the time to plan, sign and bake a vault, without
+    planning it.
+    """
+    (num_shards, extra_parameters) = get_plan_parameters(**options)
 
+    from vaults.commands.estimate import estimate_vault
+    output = estimate_vault(private_key, num_shards=num_shards, extra_parameters=extra_parameters, calibrate=calibrate)
+    print(output)
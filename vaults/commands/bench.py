@@ -0,0 +1,51 @@
+"""
+run_bench - Benchmark planning, signing, OP_CHECKTEMPLATEVERIFY baking and
+persistence for several vault sizes, and compare the results to a baseline.
+No vault or bitcoind is needed, see benchmarks.py.
+"""
+
+import os
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from vaults.config import BENCHMARK_BASELINE_FILENAME
+from vaults.loggingconfig import logger
+from vaults.benchmarks import (
+    BENCHMARK_NUM_SHARDS,
+    get_scenarios,
+    run_plan_benchmark,
+    format_plan_benchmark,
+    load_baseline,
+    save_baseline,
+    compare_to_baseline,
+    format_regressions,
+)
+
+def run_bench(num_shards_list=None, burn_options=(True, False), sweeps_options=(False, True), repeat=3, trace_memory=True, baseline_filename=BENCHMARK_BASELINE_FILENAME, update_baseline=False, threshold=None):
+    """
+    Run the planning benchmark for every scenario. Without a baseline file
+    (or with update_baseline), the results are saved as the baseline.
+    Otherwise they are compared to it. Returns the report as text, and the
+    list of regressions (see benchmarks.compare_to_baseline).
+    """
+    if num_shards_list == None:
+        num_shards_list = BENCHMARK_NUM_SHARDS
+    scenarios = get_scenarios(num_shards_list, burn_options=burn_options, sweeps_options=sweeps_options)
+    results = run_plan_benchmark(scenarios, repeat=repeat, trace_memory=trace_memory)
+
+    path = os.path.join(os.getcwd(), baseline_filename)
+    baseline = None
+    regressions = []
+    if os.path.exists(path):
+        baseline = load_baseline(path)
+        regressions = compare_to_baseline(results, baseline, threshold=threshold)
+
+    output = format_plan_benchmark(results, baseline=baseline)
+    output += format_regressions(regressions)
+
+    if baseline == None or update_baseline:
+        save_baseline(results, path, threshold=threshold)
+        logger.info(f"Wrote benchmark baseline to {baseline_filename}")
+
+    return (output, regressions)
@@ -6,23 +6,26 @@ transaction to the bitcoin p2p network.
 
 import sys
 
+from bitcoin import SelectParams
+SelectParams("regtest")
+
 from vaults.helpers.formatting import b2x, x, b2lx, lx
 
 from vaults.loggingconfig import logger
-from vaults.config import TRANSACTION_STORE_FILENAME
 
-from vaults.persist import load
 from vaults.rpc import get_bitcoin_rpc_connection
-from vaults.state import get_current_confirmed_transaction
+from vaults.state import load_current_state
 
-def broadcast_next_transaction(internal_id):
+def broadcast_next_transaction(internal_id, ctv=False):
     """
     Broadcast a transaction, but only if it is one of the valid next
     transactions.
+
+    With ctv=True, the OP_CHECKTEMPLATEVERIFY version of the transaction is
+    broadcasted, from the OP_CHECKTEMPLATEVERIFY transaction store. Lazy
+    re-vault subtrees are planned (and saved) when the vault reaches them.
     """
-    transaction_store_filename = TRANSACTION_STORE_FILENAME
-    initial_tx = load(transaction_store_filename=transaction_store_filename)
-    recentdata = get_current_confirmed_transaction(initial_tx)
+    recentdata = load_current_state(ctv=ctv)
 
     internal_id = str(internal_id)
     internal_ids = [str(blah.internal_id) for blah in recentdata["next"]]
@@ -33,7 +36,10 @@ def broadcast_next_transaction(internal_id):
 
     internal_map = dict([(str(blah.internal_id), blah) for blah in recentdata["next"]])
     requested_tx = internal_map[str(internal_id)]
-    bitcoin_transaction = requested_tx.bitcoin_transaction
+    if ctv:
+        bitcoin_transaction = requested_tx.ctv_bitcoin_transaction
+    else:
+        bitcoin_transaction = requested_tx.bitcoin_transaction
 
     connection = get_bitcoin_rpc_connection()
     result = connection.sendrawtransaction(bitcoin_transaction)
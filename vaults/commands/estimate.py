@@ -0,0 +1,54 @@
+"""
+estimate_vault - Estimate how large a planned transaction tree would be, and
+how long it would take to plan, sign and bake, for some vault parameters,
+without planning the vault.
+"""
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from bitcoin.core import COIN
+
+from vaults.helpers.prototyping import make_parameters
+from vaults.estimator import estimate
+
+def format_bytes(num_bytes):
+    """
+    Render a number of bytes for humans.
+    """
+    if num_bytes < 1024:
+        return "{} bytes".format(int(num_bytes))
+    for unit in ["KB", "MB", "GB"]:
+        num_bytes /= 1024
+        if num_bytes < 1024:
+            break
+    return "{:.1f} {}".format(num_bytes, unit)
+
+def estimate_vault(private_key, num_shards=5, amount=2 * COIN, extra_parameters=None, calibrate=True):
+    """
+    Estimate the planned transaction tree for a vault with the same parameters
+    that "vault init" would use, plus some extra parameters. Returns the
+    estimate as text.
+    """
+    parameters = make_parameters(private_key, num_shards=num_shards, amount=amount)
+    if extra_parameters != None:
+        parameters.update(extra_parameters)
+
+    result = estimate(parameters, calibrate=calibrate)
+
+    qualifier = "" if result["exact"] else "at most "
+
+    output_text  = "Vault estimate ({} shards, {} sharding):\n".format(num_shards, parameters.get("sharding_mode", "flat"))
+    output_text += "\ttransactions: {}{}\n".format(qualifier, result["transactions"])
+    output_text += "\tUTXOs: {}{}\n".format(qualifier, result["utxos"])
+    if parameters.get("enable_sweeps", False) == True:
+        output_text += "\tsweep transactions: {}{}\n".format(qualifier, result["sweep_transactions"])
+
+    if calibrate:
+        output_text += "\ttransaction store: ~{}\n".format(format_bytes(result["transaction_store_bytes"]))
+        output_text += "\tCTV transaction store: ~{}\n".format(format_bytes(result["ctv_transaction_store_bytes"]))
+        output_text += "\tplanning: ~{:.1f} seconds\n".format(result["planning_seconds"])
+        output_text += "\tsigning: ~{:.1f} seconds\n".format(result["signing_seconds"])
+        output_text += "\tCTV baking: ~{:.1f} seconds\n".format(result["ctv_baking_seconds"])
+
+    return output_text
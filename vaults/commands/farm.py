@@ -0,0 +1,181 @@
+"""
+initialize_farm - Open many vaults at once, from one funding transaction.
+
+The user's coin is split by a single funding transaction with one output per
+vault. Each output is the "segwit input coin" of its own vault, so every
+vault gets its own planned transaction tree (see setup_vault). The trees
+don't depend on each other, so they are planned, signed and baked in a pool
+of worker processes, and then written into one farm store (see
+persist.save_farm).
+
+A farm isn't a vault directory: no vaultfile is written, and the commands
+that read transaction-store.json (info, broadcast, topup, ...) don't apply to
+it. The farm store is read with persist.load_farm, which gives each vault's
+InitialTransaction by its vout in the funding transaction.
+"""
+
+import os
+import multiprocessing
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from bitcoin.core import COIN, CTxIn, CTxOut, COutPoint, CMutableTransaction, CTransaction
+from bitcoin.core.script import CScript, OP_0, Hash160
+
+from vaults.config import FARM_FUNDING_FEE_RATE, FARM_STORE_FILENAME
+from vaults.loggingconfig import logger
+from vaults.exceptions import VaultException
+from vaults.helpers.formatting import b2x, x, b2lx, lx
+from vaults.helpers.prototyping import make_parameters
+from vaults.vaultfile import check_vaultfile_existence
+from vaults.rpc import get_bitcoin_rpc_connection
+from vaults.persist import to_dict, save_farm
+from vaults.context import PlanContext
+from vaults.models.script_templates import UserScriptTemplate
+from vaults.models.plans import PlannedUTXO, InitialTransaction, make_root_internal_id
+from vaults.planner import setup_vault, safety_check
+from vaults.signing import sign_transaction_tree
+from vaults.validation import validate_transaction_tree, check_ctv_transaction_tree
+from vaults.bip119_ctv import make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY
+from vaults.commands.initialize import check_private_key_is_conformant, find_user_utxos
+
+def estimate_funding_transaction_fee(num_vaults, fee_rate=FARM_FUNDING_FEE_RATE):
+    """
+    The fee for a funding transaction that spends one P2WPKH coin into
+    num_vaults P2WPKH outputs, from its approximate virtual size.
+    """
+    vsize = 11 + 68 + (31 * num_vaults)
+    return vsize * fee_rate
+
+def make_funding_transaction(txid, vout, amount, scriptpubkey, num_vaults, fee_rate=FARM_FUNDING_FEE_RATE):
+    """
+    Make the (unsigned) funding transaction for a farm: spend the coin at
+    txid:vout into num_vaults outputs with the same scriptpubkey. Every output
+    gets the same amount; any remainder goes to the fee.
+    """
+    if num_vaults < 1:
+        raise VaultException("A farm needs at least one vault")
+
+    fee = estimate_funding_transaction_fee(num_vaults, fee_rate=fee_rate)
+    vault_amount = (amount - fee) // num_vaults
+    if vault_amount <= 0:
+        raise VaultException("Can't split {} satoshis into {} vaults".format(amount, num_vaults))
+
+    bitcoin_input = CTxIn(COutPoint(txid, vout))
+    bitcoin_outputs = [CTxOut(vault_amount, scriptpubkey) for idx in range(num_vaults)]
+    return CMutableTransaction([bitcoin_input], bitcoin_outputs, nLockTime=0, nVersion=2)
+
+def build_farm_vault(task):
+    """
+    Plan, sign and bake the vault for one output of the funding transaction.
+    This runs in the worker processes. Returns (vout, transaction
+    dictionaries, number of failed inputs of the presigned tree). An input
+    that fails in the OP_CHECKTEMPLATEVERIFY tree raises a VaultException.
+    """
+    (private_key, num_shards, funding_txid, vout, amount, extra_parameters) = task
+
+    parameters = make_parameters(private_key, num_shards=num_shards, amount=amount)
+    parameters.update(extra_parameters)
+
+    # The worker processes of a pool can't have their own pools.
+    parameters["planning_processes"] = 1
+
+    context = PlanContext(parameters=parameters)
+
+    initial_tx = InitialTransaction(txid=funding_txid)
+    with context.activate():
+        segwit_utxo = PlannedUTXO(
+            name="segwit input coin",
+            transaction=initial_tx,
+            script_template=UserScriptTemplate,
+            amount=amount,
+        )
+    segwit_utxo._vout_override = vout
+    # Vaults with the same parameters would otherwise get the same internal
+    # ids, so each vault's ids are derived from its funding outpoint.
+    segwit_utxo.internal_id = make_root_internal_id("{}:{}".format(b2lx(funding_txid), vout))
+    initial_tx.output_utxos = [segwit_utxo] # for establishing vout
+
+    setup_vault(segwit_utxo, context=context)
+    safety_check(initial_tx)
+
+    sign_transaction_tree(segwit_utxo, context=context)
+    failures = validate_transaction_tree(segwit_utxo, processes=1)
+
+    make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, context=context)
+    check_ctv_transaction_tree(segwit_utxo, processes=1)
+
+    return (vout, to_dict(segwit_utxo), len(failures))
+
+def build_farm_vaults(tasks, processes=None):
+    """
+    Run build_farm_vault for every task, in a pool of worker processes. Use
+    processes=1 to skip the process pool. Returns the results in the order
+    of the tasks.
+    """
+    if processes == None:
+        processes = min(multiprocessing.cpu_count(), len(tasks))
+
+    if processes <= 1:
+        return list(map(build_farm_vault, tasks))
+
+    with multiprocessing.Pool(processes=processes) as pool:
+        return list(pool.imap(build_farm_vault, tasks, chunksize=1))
+
+def initialize_farm(private_key=None, num_vaults=2, num_shards=5, processes=None, extra_parameters=None):
+    """
+    Setup and initialize num_vaults new vaults in the current working
+    directory, funded by one transaction that splits one of the user's coins
+    into one output per vault. The funding transaction is broadcasted; each
+    vault's funding commitment transaction spends one of its outputs.
+    """
+    check_vaultfile_existence()
+    if os.path.exists(os.path.join(os.getcwd(), FARM_STORE_FILENAME)):
+        raise VaultException("{} already exists. Is this an active farm? Don't re-initialize.".format(FARM_STORE_FILENAME))
+    check_private_key_is_conformant(private_key)
+
+    if extra_parameters == None:
+        extra_parameters = {}
+
+    minimum_amount = num_vaults * (2 * COIN)
+    parameters = make_parameters(private_key, num_shards=num_shards, amount=minimum_amount)
+
+    # connect to bitcoind (ideally, regtest)
+    connection = get_bitcoin_rpc_connection()
+    utxo_details = find_user_utxos(connection, parameters, minimum_amount)[0]
+
+    user_scriptpubkey = CScript([OP_0, Hash160(parameters["user_key"]["public_key"])])
+    funding_transaction = make_funding_transaction(
+        txid=lx(utxo_details["txid"]),
+        vout=utxo_details["vout"],
+        amount=int(utxo_details["amount"] * COIN),
+        scriptpubkey=user_scriptpubkey,
+        num_vaults=num_vaults,
+    )
+
+    # The user's key was imported into bitcoind by find_user_utxos.
+    signed = connection._call("signrawtransactionwithwallet", b2x(funding_transaction.serialize()))
+    if not signed["complete"]:
+        raise VaultException("Couldn't sign the funding transaction: {}".format(signed.get("errors", None)))
+    funding_transaction = CTransaction.deserialize(x(signed["hex"]))
+    funding_txid = funding_transaction.GetTxid()
+
+    tasks = []
+    for (vout, some_output) in enumerate(funding_transaction.vout):
+        tasks.append((private_key, num_shards, funding_txid, vout, some_output.nValue, extra_parameters))
+
+    logger.info("Planning {} vaults with {} shards each".format(num_vaults, num_shards))
+    results = build_farm_vaults(tasks, processes=processes)
+
+    failure_count = sum([result[2] for result in results])
+    if failure_count > 0:
+        raise VaultException("{} inputs in the transaction trees failed validation, not broadcasting the funding transaction".format(failure_count))
+
+    save_farm(funding_txid, [(vout, transaction_dicts) for (vout, transaction_dicts, num_failures) in results])
+
+    # The vaults are planned, so the coin can be split now.
+    connection._call("sendrawtransaction", signed["hex"])
+    logger.info("Broadcasted funding transaction {}".format(b2lx(funding_txid)))
+
+    return funding_txid
@@ -0,0 +1,28 @@
+"""
+make_graph - Write a graphviz dotfile for the vault in the current working
+directory, from its transaction store.
+"""
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from vaults.config import TRANSACTION_STORE_FILENAME, CTV_TRANSACTION_STORE_FILENAME, GRAPHVIZ_FILENAME
+from vaults.loggingconfig import logger
+from vaults.persist import load
+from vaults.graphics import generate_graphviz
+
+def make_graph(output_filename=GRAPHVIZ_FILENAME, max_depth=None, focus=None, collapse=True, view=False, ctv=False):
+    """
+    Write the dotfile for the saved planned transaction tree, starting at the
+    node with the internal id focus (or at the InitialTransaction), down to
+    max_depth. Returns the filename.
+    """
+    if ctv:
+        initial_tx = load(transaction_store_filename=CTV_TRANSACTION_STORE_FILENAME)
+    else:
+        initial_tx = load(transaction_store_filename=TRANSACTION_STORE_FILENAME)
+
+    parameters = {"enable_graphviz_popup": view}
+    generate_graphviz(initial_tx, parameters, output_filename=output_filename, max_depth=max_depth, focus=focus, collapse=collapse)
+    logger.info(f"Wrote to {output_filename}")
+    return output_filename
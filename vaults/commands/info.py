@@ -3,10 +3,11 @@ get_info - A function for displaying information about the vault and checking
 the current state of the vault on the blockchain.
 """
 
+from bitcoin import SelectParams
+SelectParams("regtest")
+
 from vaults.helpers.formatting import b2x, x, b2lx, lx
-from vaults.config import TRANSACTION_STORE_FILENAME
-from vaults.persist import load
-from vaults.state import get_current_confirmed_transaction
+from vaults.state import load_current_state, get_txid
 
 def render_planned_output(planned_output, depth=0):
     """
@@ -18,9 +19,12 @@ def render_planned_output(planned_output, depth=0):
     output_text += prefix + "\tname: {}\n".format(planned_output.name)
     output_text += prefix + "\tinternal id: {}\n".format(planned_output.internal_id)
 
+    if planned_output.revault_stub != None:
+        output_text += prefix + "\tre-vault subtree: {} shards (planned when needed)\n".format(planned_output.revault_stub.num_shards)
+
     return output_text
 
-def render_planned_transaction(planned_transaction, depth=0):
+def render_planned_transaction(planned_transaction, depth=0, ctv=False):
     """
     Render a planned transaction into text for use in the get_info command.
     """
@@ -29,7 +33,7 @@ def render_planned_transaction(planned_transaction, depth=0):
     output_text  = prefix + "Transaction:\n"
     output_text += prefix + "\tname: {}\n".format(planned_transaction.name)
     output_text += prefix + "\tinternal id: {}\n".format(planned_transaction.internal_id)
-    output_text += prefix + "\ttxid: {}\n".format(b2lx(planned_transaction.txid))
+    output_text += prefix + "\ttxid: {}\n".format(b2lx(get_txid(planned_transaction, ctv=ctv)))
     output_text += prefix + "\tnum inputs: {}\n".format(len(planned_transaction.inputs))
     output_text += prefix + "\tnum outputs: {}\n".format(len(planned_transaction.output_utxos))
 
@@ -41,27 +45,30 @@ def render_planned_transaction(planned_transaction, depth=0):
 
     return output_text
 
-def get_info(transaction_store_filename=TRANSACTION_STORE_FILENAME, connection=None):
+def get_info(transaction_store_filename=None, connection=None, ctv=False):
     """
     Render information about the state of the vault based on (1) pre-computed
     vault data and (2) the current state of the blockchain and most recently
     broadcasted transaction from the vault.
-    """
-    initial_tx = load(transaction_store_filename=transaction_store_filename)
 
-    latest_info = get_current_confirmed_transaction(initial_tx)
+    With ctv=True, the OP_CHECKTEMPLATEVERIFY version of the vault is used,
+    and lazy re-vault subtrees are planned (and saved) when the vault reaches
+    them.
+    """
+    latest_info = load_current_state(transaction_store_filename=transaction_store_filename, connection=connection, ctv=ctv)
     current_tx = latest_info["current"]
 
     output_text = "\n\nLatest transaction:\n"
-    output_text += render_planned_transaction(current_tx, depth=1)
+    output_text += render_planned_transaction(current_tx, depth=1, ctv=ctv)
 
     output_text += "\n\nPossible transactions:\n\n"
 
     for some_tx in latest_info["next"]:
-        output_text += render_planned_transaction(some_tx, depth=1)
+        output_text += render_planned_transaction(some_tx, depth=1, ctv=ctv)
         output_text += "\n"
 
-    output_text += "\nTo broadcast the next transaction, run:\n\tvault broadcast <internal_id>\n"
+    broadcast_command = "vault broadcast --ctv" if ctv else "vault broadcast"
+    output_text += "\nTo broadcast the next transaction, run:\n\t{} <internal_id>\n".format(broadcast_command)
 
     return output_text
 
@@ -18,16 +18,18 @@ import bitcoin
 from bitcoin import SelectParams
 SelectParams("regtest")
 
-from vaults.config import TEXT_RENDERING_FILENAME
+from vaults.config import TEXT_RENDERING_FILENAME, TRANSACTION_JOURNAL_FILENAME, CTV_TRANSACTION_STORE_FILENAME, GRAPHVIZ_FILENAME, PROFILE_FILENAME
 from vaults.loggingconfig import logger
 from vaults.exceptions import VaultException
 from vaults.helpers.formatting import b2x, x, b2lx, lx
 from vaults.utils import sha256
+from vaults.helpers.prototyping import make_private_keys, make_parameters
 from vaults.vaultfile import check_vaultfile_existence, make_vaultfile
-from vaults.graphics import generate_graphviz
 
 from vaults.rpc import get_bitcoin_rpc_connection
-from vaults.persist import save
+from vaults.metrics import PhaseRecorder
+from vaults.context import PlanContext
+from vaults.persist import save, save_transaction_dicts, to_dict, save_from_journal, save_parameters, fingerprint_parameters, fingerprint_plan, TransactionJournal, PlanCache
 
 from vaults.models.script_templates import (
     ScriptTemplate,
@@ -49,6 +51,8 @@ from vaults.models.plans import (
 from vaults.planner import setup_vault, safety_check, render_planned_tree_to_text_file
 from vaults.bip119_ctv import make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY
 from vaults.signing import sign_transaction_tree
+from vaults.validation import validate_transaction_tree, check_ctv_transaction_tree
+from vaults.estimator import estimate_tree_size
 from vaults.state import get_current_confirmed_transaction
 
 from bitcoin.core import COIN
@@ -62,10 +66,79 @@ def check_private_key_is_conformant(private_key):
     """
     CBitcoinSecret(private_key)
 
-def initialize(private_key=None):
+def find_user_utxos(connection, parameters, amount, num_coins=1, exclude=None):
+    """
+    Import the user's private key into bitcoind, mine some coins to the
+    user's P2WPKH address if the chain is still short, and pick num_coins
+    unspent UTXOs worth at least the given amount in total. UTXOs in exclude
+    (a list of (txid, vout) tuples, like the coins already in a planned vault)
+    are skipped. Returns a list of the listunspent details of each UTXO.
+    """
+    # setup the user private key (for P2WPKH)
+    connection._call("importprivkey", str(parameters["user_key"]["private_key"]), "user")
+
+    # Mine some coins into the "user_key" P2WPKH address
+    #user_address = "bcrt1qrnwea7zc93l5wh77y832wzg3cllmcquqeal7f5"
+    # parsed_address = P2WPKHBitcoinAddress(user_address)
+    user_address = P2WPKHBitcoinAddress.from_scriptPubKey(CScript([OP_0, Hash160(parameters["user_key"]["public_key"])]))
+    blocks = 110
+    if connection._call("getblockchaininfo")["blocks"] < blocks:
+        try:
+            connection._call("sendtoaddress", user_address, 50)
+        except Exception:
+            pass
+        connection._call("generatetoaddress", blocks, str(user_address))
+
+    # Now find some unspent UTXOs. A single coin has to cover the whole amount.
+    if num_coins == 1:
+        unspent = connection._call("listunspent", 6, 9999, [str(user_address)], True, {"minimumAmount": amount / COIN})
+    else:
+        unspent = connection._call("listunspent", 6, 9999, [str(user_address)], True)
+
+    if exclude != None:
+        unspent = [utxo_details for utxo_details in unspent if (lx(utxo_details["txid"]), utxo_details["vout"]) not in exclude]
+
+    # pick the first UTXOs
+    utxos_details = unspent[0:num_coins]
+    if len(utxos_details) < num_coins or sum([int(utxo_details["amount"] * COIN) for utxo_details in utxos_details]) < amount:
+        raise VaultException("can't find {} good UTXOs for amount {}".format(num_coins, amount))
+
+    return utxos_details
+
+def initialize(private_key=None, pipeline=False, processes=None, plan_cache=True, num_coins=1, graphviz=False, profile=False, num_shards=5, extra_parameters=None):
     """
     Setup and initialize a new vault in the current working directory. This is
     the primary entrypoint for the prototype.
+
+    In pipeline mode, signed transactions are streamed into an append-only
+    journal as soon as they are signed, and the transaction store is written
+    from the journal. If the process dies part of the way through signing,
+    running the same command again resumes from the journal. This makes init
+    resumable, but it doesn't bound memory: the whole tree is still planned
+    up front, and every signed transaction stays in the tree for validation
+    and OP_CHECKTEMPLATEVERIFY baking. Only writing the transaction store
+    avoids building the whole json document in memory.
+
+    processes is the number of worker processes for baking the lazy re-vault
+    subtrees of the OP_CHECKTEMPLATEVERIFY vault (default: one per CPU).
+
+    With plan_cache, the OP_CHECKTEMPLATEVERIFY scripts are loaded from (and
+    saved to) a cache shared by every vault with the same parameters and
+    amount, see persist.PlanCache.
+
+    num_coins is the number of the user's coins that go into the vault. They
+    are all spent by the funding commitment transaction, one input per coin.
+
+    With graphviz, a graphviz dotfile of the planned transaction tree is
+    written as well (see graphics.generate_graphviz).
+
+    extra_parameters are added to the vault parameters (like sharding_mode,
+    see "vault init --help"). The parameters, without the keys, are saved
+    with the vault (see persist.save_parameters).
+
+    The time, CPU time and counters (RPC calls, signatures, ...) of each phase
+    are written to profile.json, see metrics.PhaseRecorder. With profile, the
+    peak memory of each phase is measured too. Returns the PhaseRecorder.
     """
 
     check_vaultfile_existence()
@@ -76,33 +149,15 @@ def initialize(private_key=None):
     amount = 2 * COIN
 
     # TODO: A more sophisticated private key system is required, for any real
-    # production use.
-    some_private_keys = [CBitcoinSecret(private_key)] * 6
-
-    parameter_names = [
-        "user_key",
-        "ephemeral_key_1",
-        "ephemeral_key_2",
-        "cold_key1",
-        "cold_key2",
-        "hot_wallet_key",
-    ]
-
-    parameters = {
-        "num_shards": 5,
-        "enable_burn_transactions": True,
-        "enable_graphviz": True,
-        "enable_graphviz_popup": False,
-        "amount": amount,
-        "unspendable_key_1": CPubKey(x("0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798")),
-    }
-
-    for some_name in parameter_names:
-        private_key = some_private_keys.pop()
-        public_key = private_key.pub
-        parameters[some_name] = {"private_key": private_key, "public_key": public_key}
-
-    parameters["user_key_hash160"] = b2x(Hash160(parameters["user_key"]["public_key"]))
+    # production use. Note that make_parameters uses the same private key for
+    # every key in the vault.
+    parameters = make_parameters(private_key, num_shards=num_shards, amount=amount)
+    if extra_parameters != None:
+        parameters.update(extra_parameters)
+    if processes != None:
+        parameters["planning_processes"] = processes
+    if graphviz:
+        parameters["enable_graphviz"] = True
 
     # consistency check against required parameters
     required_parameters = ScriptTemplate.get_required_parameters()
@@ -116,86 +171,135 @@ def initialize(private_key=None):
         logger.error("Missing parameters!")
         sys.exit(1)
 
-    # connect to bitcoind (ideally, regtest)
-    connection = get_bitcoin_rpc_connection()
-
-    # setup the user private key (for P2WPKH)
-    connection._call("importprivkey", str(parameters["user_key"]["private_key"]), "user")
-
-    # Mine some coins into the "user_key" P2WPKH address
-    #user_address = "bcrt1qrnwea7zc93l5wh77y832wzg3cllmcquqeal7f5"
-    # parsed_address = P2WPKHBitcoinAddress(user_address)
-    user_address = P2WPKHBitcoinAddress.from_scriptPubKey(CScript([OP_0, Hash160(parameters["user_key"]["public_key"])]))
-    blocks = 110
-    if connection._call("getblockchaininfo")["blocks"] < blocks:
-        try:
-            connection._call("sendtoaddress", user_address, 50)
-        except Exception:
-            pass
-        connection._call("generatetoaddress", blocks, str(user_address))
+    recorder = PhaseRecorder(trace_memory=profile)
+    recorder.values["num_shards"] = parameters["num_shards"]
+    recorder.values["num_coins"] = num_coins
 
-    # Now find an unspent UTXO.
-    unspent = connection._call("listunspent", 6, 9999, [str(user_address)], True, {"minimumAmount": amount / COIN})
-    if len(unspent) == 0:
-        raise VaultException("can't find a good UTXO for amount {}".format(amount))
+    with recorder.phase("rpc setup"):
+        # connect to bitcoind (ideally, regtest)
+        connection = get_bitcoin_rpc_connection()
 
-    # pick the first UTXO
-    utxo_details = unspent[0]
-    txid = utxo_details["txid"]
+        utxos_details = find_user_utxos(connection, parameters, amount, num_coins=num_coins)
 
-    # have to consume the whole UTXO
-    amount = int(utxo_details["amount"] * COIN)
+    # have to consume the whole UTXOs
+    amount = sum([int(utxo_details["amount"] * COIN) for utxo_details in utxos_details])
+    recorder.values["amount"] = amount
 
-    initial_tx_txid = lx(utxo_details["txid"])
+    initial_tx_txid = lx(utxos_details[0]["txid"])
     initial_tx = InitialTransaction(txid=initial_tx_txid)
 
-    segwit_utxo = PlannedUTXO(
-        name="segwit input coin",
-        transaction=initial_tx,
-        script_template=UserScriptTemplate,
-        amount=amount,
-    )
-    segwit_utxo._vout_override = utxo_details["vout"]
-    initial_tx.output_utxos = [segwit_utxo] # for establishing vout
-
-    # ===============
-    # Here's where the magic happens.
-    vault_initial_utxo = setup_vault(segwit_utxo, parameters)
-    # ===============
+    context = PlanContext(parameters=parameters)
+    if plan_cache:
+        context.plan_cache = PlanCache(fingerprint_plan(parameters, amount=amount))
+
+    segwit_utxos = []
+    for utxo_details in utxos_details:
+        with context.activate():
+            segwit_utxo = PlannedUTXO(
+                name="segwit input coin",
+                transaction=initial_tx,
+                script_template=UserScriptTemplate,
+                amount=int(utxo_details["amount"] * COIN),
+            )
+        segwit_utxo._vout_override = utxo_details["vout"]
+        if lx(utxo_details["txid"]) != initial_tx_txid:
+            segwit_utxo._txid_override = lx(utxo_details["txid"])
+        segwit_utxos.append(segwit_utxo)
+    initial_tx.output_utxos = segwit_utxos # for establishing vout
+    segwit_utxo = segwit_utxos[0]
+
+    estimated_size = estimate_tree_size(parameters)
+    logger.info("Planning about {} transactions and {} UTXOs".format(estimated_size["transactions"], estimated_size["utxos"]))
+
+    with recorder.phase("setup_vault") as phase:
+        # ===============
+        # Here's where the magic happens.
+        vault_initial_utxo = setup_vault(segwit_utxos, context=context)
+        # ===============
+        phase.values["transactions"] = context.count("PlannedTransaction")
+        phase.values["utxos"] = context.count("PlannedUTXO")
 
     # Check that the tree is conforming to applicable rules.
-    safety_check(segwit_utxo.transaction)
+    with recorder.phase("safety_check") as phase:
+        for (rule_name, bad_nodes, seconds) in safety_check(segwit_utxo.transaction):
+            phase.values["{}_seconds".format(rule_name)] = seconds
 
     # To test that the sharded UTXOs have the right amounts, do the following:
     # assert (second_utxo_amount * 99) + first_utxo_amount == amount
 
     # Display all UTXOs and transactions-- render the tree of possible
     # transactions. Mostly helpful for debugging purposes.
-    render_planned_tree_to_text_file(segwit_utxo, filename=TEXT_RENDERING_FILENAME)
+    with recorder.phase("text rendering"):
+        render_planned_tree_to_text_file(segwit_utxo, filename=TEXT_RENDERING_FILENAME)
 
     # stats
     logger.info("*** Stats and numbers")
-    logger.info(f"{PlannedUTXO.__counter__} UTXOs, {PlannedTransaction.__counter__} transactions")
-
-    sign_transaction_tree(segwit_utxo, parameters)
-
-    save(segwit_utxo)
+    logger.info(f"{context.count('PlannedUTXO')} UTXOs, {context.count('PlannedTransaction')} transactions")
+
+    if pipeline:
+        journal = TransactionJournal(
+            path=os.path.join(os.getcwd(), TRANSACTION_JOURNAL_FILENAME),
+            fingerprint=fingerprint_parameters(parameters, segwit_utxo=segwit_utxo),
+        )
+        with recorder.phase("sign_transaction_tree"):
+            sign_transaction_tree(segwit_utxo, journal=journal, context=context)
+    else:
+        with recorder.phase("sign_transaction_tree"):
+            sign_transaction_tree(segwit_utxo, context=context)
+        # The OP_CHECKTEMPLATEVERIFY conversion adds to the transactions, so
+        # the transaction store is serialized now, and written once the
+        # whole tree is validated.
+        with recorder.phase("serialize"):
+            transaction_dicts = to_dict(segwit_utxo)
+
+    # Check every witness against the output that it spends, while it is still
+    # possible to sign again.
+    with recorder.phase("validation") as phase:
+        failures = validate_transaction_tree(segwit_utxo)
+        phase.values["failures"] = len(failures)
+    if len(failures) > 0:
+        raise VaultException("{} inputs in the transaction tree failed validation, the ephemeral keys must not be deleted".format(len(failures)))
 
     # TODO: Delete the ephemeral keys.
 
     # (graph generation can wait until after key deletion)
     if parameters["enable_graphviz"] == True:
-        generate_graphviz(segwit_utxo, parameters, output_filename="output.gv")
+        with recorder.phase("graphviz"):
+            from vaults.graphics import generate_graphviz
+            generate_graphviz(segwit_utxo, parameters, output_filename=GRAPHVIZ_FILENAME)
 
     # Create another planned transaction tree this time using
     # OP_CHECKTEMPLATEVERIFY from bip119. This can be performed after key
     # deletion because OP_CTV standard template hashes are not based on keys
     # and signatures.
-    make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=parameters)
-    save(segwit_utxo, filename="transaction-store.ctv.json")
+    with recorder.phase("ctv conversion") as phase:
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, context=context)
+        phase.values["transactions"] = context.count("PlannedTransaction")
+        phase.values["utxos"] = context.count("PlannedUTXO")
+    with recorder.phase("ctv validation"):
+        check_ctv_transaction_tree(segwit_utxo)
+
+    # Nothing is written until both versions of the tree are valid.
+    with recorder.phase("save"):
+        if pipeline:
+            save_from_journal(journal)
+        else:
+            save_transaction_dicts(transaction_dicts)
+    with recorder.phase("ctv save"):
+        save(segwit_utxo, filename=CTV_TRANSACTION_STORE_FILENAME)
 
     # A vault has been established. Write the vaultfile.
+    save_parameters(parameters)
     make_vaultfile()
 
+    # The transaction store is complete, so the journal is no longer needed.
+    if pipeline:
+        journal.close(remove=True)
+
+    recorder.stop()
+    recorder.save(filename=PROFILE_FILENAME)
+
+    return recorder
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,103 @@
+"""
+top_up - Put more of the user's coins into the vault in the current working
+directory, while its funding commitment transaction hasn't been broadcasted
+yet. The planned transaction tree is reused (see planner.top_up_vault), and
+only the parts of it with new amounts are signed and baked again.
+"""
+
+import sys
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from bitcoin.core import COIN
+
+from vaults.config import TRANSACTION_STORE_FILENAME, CTV_TRANSACTION_STORE_FILENAME
+from vaults.loggingconfig import logger
+from vaults.exceptions import VaultException
+from vaults.helpers.formatting import b2lx, lx
+from vaults.helpers.prototyping import make_parameters
+from vaults.vaultfile import check_vaultfile_existence
+from vaults.rpc import get_bitcoin_rpc_connection, check_blockchain_has_transaction
+from vaults.persist import load, save, save_parameters, load_parameters
+from vaults.context import PlanContext
+from vaults.models.script_templates import UserScriptTemplate
+from vaults.models.plans import PlannedUTXO
+from vaults.planner import top_up_vault, safety_check
+from vaults.signing import sign_transaction_tree
+from vaults.validation import validate_transaction_tree, check_ctv_transaction_tree
+from vaults.bip119_ctv import make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY
+from vaults.commands.initialize import check_private_key_is_conformant, find_user_utxos
+
+def get_vault_parameters(private_key, amount, path=None):
+    """
+    Make the same parameters that initialize used for the vault, from the
+    saved parameters (see persist.save_parameters). Vaults from before the
+    parameters were saved used the defaults.
+    """
+    saved_parameters = load_parameters(path=path)
+    if saved_parameters == None:
+        logger.warning("No saved vault parameters, using the defaults")
+        saved_parameters = {"num_shards": 5}
+
+    parameters = make_parameters(private_key, num_shards=saved_parameters["num_shards"], amount=amount)
+    parameters.update(saved_parameters)
+    parameters["amount"] = amount
+    return parameters
+
+def top_up(private_key=None, num_coins=1):
+    """
+    Add num_coins of the user's coins to the vault in the current working
+    directory. The transaction stores are written again.
+    """
+    if not check_vaultfile_existence(die=False):
+        logger.error("Error: there is no vaultfile here. Use init to create a new vault.")
+        sys.exit(1)
+
+    check_private_key_is_conformant(private_key)
+
+    # Both versions of every transaction are in the OP_CHECKTEMPLATEVERIFY
+    # transaction store.
+    initial_tx = load(transaction_store_filename=CTV_TRANSACTION_STORE_FILENAME)
+    segwit_utxo = initial_tx.output_utxos[0]
+    funding_transaction = segwit_utxo.child_transactions[0]
+
+    connection = get_bitcoin_rpc_connection()
+    if check_blockchain_has_transaction(funding_transaction.txid, connection=connection):
+        raise VaultException("The funding commitment transaction {} was already broadcasted, so the vault can't be topped up".format(b2lx(funding_transaction.txid)))
+
+    amount = sum([some_utxo.amount for some_utxo in initial_tx.output_utxos])
+    parameters = get_vault_parameters(private_key, amount)
+
+    vaulted_coins = [(some_utxo.txid, some_utxo.vout) for some_utxo in initial_tx.output_utxos]
+    utxos_details = find_user_utxos(connection, parameters, 1, num_coins=num_coins, exclude=vaulted_coins)
+
+    new_coins = []
+    for utxo_details in utxos_details:
+        new_coin = PlannedUTXO(
+            name="segwit input coin",
+            transaction=initial_tx,
+            script_template=UserScriptTemplate,
+            amount=int(utxo_details["amount"] * COIN),
+        )
+        new_coin._vout_override = utxo_details["vout"]
+        if lx(utxo_details["txid"]) != initial_tx.txid:
+            new_coin._txid_override = lx(utxo_details["txid"])
+        new_coins.append(new_coin)
+
+    context = PlanContext(parameters=parameters)
+    top_up_vault(segwit_utxo, new_coins, context=context)
+    safety_check(initial_tx)
+
+    signed_count = sign_transaction_tree(segwit_utxo, context=context)
+    logger.info("Signed {} transactions again".format(signed_count))
+
+    failures = validate_transaction_tree(segwit_utxo)
+    if len(failures) > 0:
+        logger.error("{} inputs in the transaction tree failed validation, the ephemeral keys must not be deleted".format(len(failures)))
+    save(segwit_utxo, filename=TRANSACTION_STORE_FILENAME)
+
+    make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, context=context)
+    check_ctv_transaction_tree(segwit_utxo)
+    save(segwit_utxo, filename=CTV_TRANSACTION_STORE_FILENAME)
+    save_parameters(parameters)
@@ -3,8 +3,34 @@ Basic config variables for the project. In the future this could be dynamically
 loaded from a config file.
 """
 
+import os
+
 TRANSACTION_STORE_FILENAME ="transaction-store.json"
+CTV_TRANSACTION_STORE_FILENAME = "transaction-store.ctv.json"
+TRANSACTION_JOURNAL_FILENAME = "transaction-store.journal"
+FARM_STORE_FILENAME = "farm-store.json"
 TEXT_RENDERING_FILENAME = "text-rendering.txt"
+GRAPHVIZ_FILENAME = "output.gv"
+PROFILE_FILENAME = "profile.json"
+PARAMETERS_FILENAME = "parameters.json"
+BENCHMARK_BASELINE_FILENAME = "benchmark-baseline.json"
 VAULTFILE_FILENAME = "vaultfile"
 
 VAULT_FILE_FORMAT_VERSION = "0.0.1"
+
+# Fee rate (satoshis per vbyte) for the transaction that funds every vault of a
+# farm, see commands/farm.py.
+FARM_FUNDING_FEE_RATE = 2
+
+# How many signed transactions to append to the journal between each fsync.
+TRANSACTION_JOURNAL_FSYNC_INTERVAL = 64
+
+# Baked OP_CHECKTEMPLATEVERIFY scripts are cached here, by a fingerprint of the
+# vault parameters (see persist.PlanCache). The VAULT_PLAN_CACHE_DIR environment
+# variable overrides this.
+PLAN_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "python-vaults")
+PLAN_CACHE_FORMAT_VERSION = 1
+
+# "vault bench" fails when a phase got this much slower or bigger (0.25 is 25%)
+# than in the baseline, see benchmarks.compare_to_baseline.
+BENCHMARK_REGRESSION_THRESHOLD = 0.25
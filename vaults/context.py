@@ -0,0 +1,96 @@
+"""
+Plan contexts
+
+A PlanContext holds the state for planning one vault: the parameters, the
+counters that give planned UTXOs and transactions their ids (which are used
+for ordering, when signing, baking and saving). Without a context, ids come
+from counters that are shared by everything in the process.
+
+Several vaults can be planned at the same time in one process (in threads, or
+in asyncio tasks) by giving each vault its own context. The context is only
+active for the code that runs inside PlanContext.activate, and each thread or
+task has its own active context.
+"""
+
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+_current_context = contextvars.ContextVar("plan_context", default=None)
+
+class PlanContext(object):
+    """
+    The state for planning one vault. Pass the same context to every entry
+    point (setup_vault, sign_transaction_tree and so on) for the vault, so
+    that everything made for the vault gets its ids from the same counters.
+
+    plan_cache is an optional persist.PlanCache for baking.
+    """
+
+    def __init__(self, parameters=None, plan_cache=None):
+        self.parameters = parameters
+        self.plan_cache = plan_cache
+
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def allocate_id(self, kind):
+        """
+        Get the next id for some kind of planned object ("PlannedUTXO" or
+        "PlannedTransaction"). Ids start at 0 in each context.
+        """
+        with self._lock:
+            value = self._counters.get(kind, 0)
+            self._counters[kind] = value + 1
+        return value
+
+    def count(self, kind):
+        """
+        The number of ids that were given out for some kind of planned object.
+        """
+        with self._lock:
+            return self._counters.get(kind, 0)
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this the active context for the current thread (or asyncio task)
+        until the with block ends.
+        """
+        token = _current_context.set(self)
+        try:
+            yield self
+        finally:
+            _current_context.reset(token)
+
+def get_current_plan_context():
+    """
+    The active PlanContext, or None.
+    """
+    return _current_context.get()
+
+def uses_plan_context(function):
+    """
+    Decorator for entry points that take an optional "context" keyword
+    argument. The function runs with that PlanContext active, and its
+    "parameters" argument defaults to the context's parameters.
+    """
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, context=None, **kwargs):
+        if context == None:
+            return function(*args, **kwargs)
+
+        if "parameters" in signature.parameters:
+            bound_arguments = signature.bind_partial(*args, **kwargs)
+            if bound_arguments.arguments.get("parameters", None) == None:
+                bound_arguments.arguments["parameters"] = context.parameters
+                (args, kwargs) = (bound_arguments.args, bound_arguments.kwargs)
+
+        with context.activate():
+            return function(*args, **kwargs)
+
+    return wrapper
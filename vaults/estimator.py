@@ -0,0 +1,282 @@
+"""
+Estimate the size and the cost of a planned transaction tree from the vault
+parameters, without planning it.
+
+The node counts come from the planner's count_*_nodes helpers (see
+vaults/planner.py), so they are exact for the flat and hierarchical sharding
+modes, for staged timelock schedules, burn transactions, sweeps and
+spend-k-shards paths, including the transaction budgets. The only exception
+is sweep_time_budget, which depends on how fast the machine is; then the
+counts are upper bounds.
+
+Node counts are (utxos, transactions) pairs, counted the same way as
+PlannedUTXO.count_nodes: the InitialTransaction and the user's coin are
+included, and every planned transaction has a CPFP hook output.
+
+Serialized sizes and running times are predicted by planning, signing,
+serializing and baking a small vault with the same settings, and scaling the
+cost per transaction up to the estimated number of transactions.
+"""
+
+import json
+import time
+import heapq
+
+from bitcoin.core import COIN
+
+from vaults.loggingconfig import logger
+from vaults.exceptions import VaultException
+from vaults.helpers.formatting import lx
+from vaults.timelocks import get_timelock_schedule
+from vaults.planner import (
+    get_shard_group_size,
+    setup_vault,
+    add_node_counts,
+    multiply_node_counts,
+    count_push_to_cold_storage_nodes,
+    count_sharding_nodes,
+    count_spend_shards_nodes,
+    count_eager_vault_utxos,
+    count_one_shard_possible_spend_nodes,
+)
+from vaults.signing import sign_transaction_tree
+from vaults.bip119_ctv import make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY
+from vaults.persist import to_dict
+from vaults.models.script_templates import UserScriptTemplate
+from vaults.models.plans import PlannedUTXO, InitialTransaction
+
+# number of shards for the calibration micro-benchmark
+CALIBRATION_NUM_SHARDS = 4
+
+# placeholder txid for the calibration vault's user transaction
+CALIBRATION_TXID = "cf600e3cfc2cdc01be7563334b33f304ab6466b976e17f66c15228bd81f80007"
+
+# calibration results, by settings (see get_calibration_key)
+_calibrations = {}
+
+def estimate_hierarchical_sharding(num_shards, parameters, make_sweeps=False, depth=0, vault_utxos=None):
+    """
+    make_hierarchical_sharding. The (depth, num_shards) of each vault UTXO on
+    the re-vault paths are appended to vault_utxos, in the same order as the
+    planner makes them.
+    """
+    group_size = get_shard_group_size(num_shards, parameters=parameters)
+
+    if num_shards <= group_size:
+        if vault_utxos != None:
+            vault_utxos.extend([(depth + idx, num_shards - idx) for idx in range(count_eager_vault_utxos(num_shards, parameters))])
+        return add_node_counts(
+            count_sharding_nodes(num_shards, parameters, make_sweeps=make_sweeps),
+            count_one_shard_possible_spend_nodes(num_shards, parameters, make_sweeps=make_sweeps),
+        )
+
+    group_capacity = 1
+    while group_capacity * group_size < num_shards:
+        group_capacity *= group_size
+
+    # the split transaction and its CPFP hook
+    node_count = (1, 1)
+    for group_start in range(0, num_shards, group_capacity):
+        group_num_shards = min(group_capacity, num_shards - group_start)
+        node_count = add_node_counts(
+            node_count,
+            (1, 0),
+            count_push_to_cold_storage_nodes(parameters),
+            estimate_hierarchical_sharding(group_num_shards, parameters, make_sweeps=make_sweeps, depth=depth + 1, vault_utxos=vault_utxos),
+        )
+    return node_count
+
+def estimate_spend_k_shards_paths(vault_utxos, planned_transaction_count, parameters):
+    """
+    Replay make_spend_k_shards_paths on the numbers. Returns the list of
+    (num_shards, spend_num_shards) for each spend-k-shards transaction that
+    the planner would make.
+    """
+    spend_k_shards = sorted(set(parameters.get("spend_k_shards", None) or []))
+    budget = parameters.get("max_planned_transactions", None)
+
+    if budget != None and planned_transaction_count > budget:
+        raise VaultException("Planned transaction tree has {} transactions, over the budget of {}".format(planned_transaction_count, budget))
+
+    candidates = [(depth, sequence, num_shards, spend_k_shards) for (sequence, (depth, num_shards)) in enumerate(vault_utxos)]
+    heapq.heapify(candidates)
+    sequence = len(candidates)
+
+    branches = []
+    while len(candidates) > 0:
+        (depth, _, num_shards, k_values) = heapq.heappop(candidates)
+
+        for spend_num_shards in k_values:
+            if spend_num_shards >= num_shards:
+                continue
+
+            cost = count_spend_shards_nodes(num_shards, spend_num_shards=spend_num_shards, parameters=parameters)[1]
+            if budget != None and planned_transaction_count + cost > budget:
+                continue
+
+            branches.append((num_shards, spend_num_shards))
+            planned_transaction_count += cost
+
+            if budget != None:
+                heapq.heappush(candidates, (depth + 1, sequence, num_shards - spend_num_shards, [1] + spend_k_shards))
+                sequence += 1
+
+    return branches
+
+def estimate_tree_size(parameters):
+    """
+    Compute the number of transactions and UTXOs that setup_vault would plan
+    for the given parameters. Returns a dictionary with "transactions",
+    "utxos", "sweep_transactions" and "exact".
+    """
+    num_shards = parameters["num_shards"]
+    sharding_mode = parameters.get("sharding_mode", "flat")
+    make_sweeps = parameters.get("enable_sweeps", False) == True
+    exact = True
+
+    # the InitialTransaction, the user's coin, the funding commitment
+    # transaction (with its CPFP hook), the vault initial UTXO and its
+    # push-to-cold-storage transaction
+    base_node_count = add_node_counts((2, 2), (1, 0), count_push_to_cold_storage_nodes(parameters))
+    sweep_node_count = (0, 0)
+
+    vault_utxos = []
+    if sharding_mode == "flat":
+        vault_utxos = [(idx, num_shards - idx) for idx in range(count_eager_vault_utxos(num_shards, parameters))]
+        estimate_sharding_mode = lambda some_make_sweeps: add_node_counts(
+            count_sharding_nodes(num_shards, parameters, make_sweeps=some_make_sweeps),
+            count_one_shard_possible_spend_nodes(num_shards, parameters, make_sweeps=some_make_sweeps),
+        )
+    elif sharding_mode == "hierarchical":
+        estimate_hierarchical_sharding(num_shards, parameters, vault_utxos=vault_utxos)
+        estimate_sharding_mode = lambda some_make_sweeps: estimate_hierarchical_sharding(num_shards, parameters, make_sweeps=some_make_sweeps)
+    else:
+        raise VaultException("Unknown sharding mode {}".format(sharding_mode))
+
+    sharding_node_count = estimate_sharding_mode(False)
+    base_node_count = add_node_counts(base_node_count, sharding_node_count)
+    if make_sweeps:
+        sweep_node_count = add_node_counts(estimate_sharding_mode(True), multiply_node_counts(sharding_node_count, -1))
+
+    if parameters.get("spend_k_shards", None) or parameters.get("max_planned_transactions", None) != None:
+        branches = estimate_spend_k_shards_paths(vault_utxos, base_node_count[1], parameters)
+        for (some_num_shards, spend_num_shards) in branches:
+            branch_node_count = count_spend_shards_nodes(some_num_shards, spend_num_shards=spend_num_shards, parameters=parameters)
+            base_node_count = add_node_counts(base_node_count, branch_node_count)
+            if make_sweeps:
+                branch_sweep_node_count = count_spend_shards_nodes(some_num_shards, spend_num_shards=spend_num_shards, parameters=parameters, make_sweeps=True)
+                sweep_node_count = add_node_counts(sweep_node_count, branch_sweep_node_count, multiply_node_counts(branch_node_count, -1))
+
+    if make_sweeps:
+        # make_sweeps_paths adds whole sweeps (a sweep and maybe a burn
+        # transaction) until one of the budgets runs out.
+        push_node_count = count_push_to_cold_storage_nodes(parameters)
+        num_sweeps = sweep_node_count[1] // push_node_count[1]
+
+        max_sweep_transactions = parameters.get("max_sweep_transactions", None)
+        if max_sweep_transactions != None:
+            num_sweeps = min(num_sweeps, max(max_sweep_transactions // push_node_count[1], 0))
+
+        budget = parameters.get("max_planned_transactions", None)
+        if budget != None:
+            num_sweeps = min(num_sweeps, max((budget - base_node_count[1]) // push_node_count[1], 0))
+
+        if parameters.get("sweep_time_budget", None) != None:
+            exact = False
+
+        sweep_node_count = multiply_node_counts(push_node_count, num_sweeps)
+
+    (num_utxos, num_transactions) = add_node_counts(base_node_count, sweep_node_count)
+    return {
+        "transactions": num_transactions,
+        "utxos": num_utxos,
+        "sweep_transactions": sweep_node_count[1],
+        "exact": exact,
+    }
+
+def get_calibration_key(parameters):
+    """
+    The settings that change the mix of transactions in the tree, and so the
+    average cost per transaction.
+    """
+    schedule = get_timelock_schedule(parameters)
+    return (
+        parameters.get("enable_burn_transactions", False) == True,
+        parameters.get("enable_sweeps", False) == True,
+        parameters.get("sharding_mode", "flat"),
+        schedule.mode,
+        schedule.stage_size,
+        tuple(sorted(set(parameters.get("spend_k_shards", None) or []))),
+    )
+
+def run_calibration(parameters, num_shards=CALIBRATION_NUM_SHARDS):
+    """
+    Plan, sign, serialize and bake a small vault with the same settings, and
+    measure the cost per planned transaction. The vault is planned on top of
+    a placeholder user transaction, so bitcoind isn't needed.
+    """
+    calibration_parameters = dict(parameters)
+    calibration_parameters["num_shards"] = num_shards
+    for some_name in ["max_planned_transactions", "max_sweep_transactions", "sweep_time_budget", "shard_group_size"]:
+        calibration_parameters.pop(some_name, None)
+    if calibration_parameters.get("sharding_mode", "flat") == "hierarchical":
+        calibration_parameters["shard_group_size"] = 2
+
+    initial_tx = InitialTransaction(txid=lx(CALIBRATION_TXID))
+    segwit_utxo = PlannedUTXO(
+        name="segwit input coin",
+        transaction=initial_tx,
+        script_template=UserScriptTemplate,
+        amount=2 * COIN,
+    )
+    segwit_utxo._vout_override = 0
+    initial_tx.output_utxos = [segwit_utxo]
+
+    start_time = time.time()
+    setup_vault(segwit_utxo, calibration_parameters)
+    planning_seconds = time.time() - start_time
+    num_transactions = len(segwit_utxo.crawl()[1])
+
+    start_time = time.time()
+    sign_transaction_tree(segwit_utxo, calibration_parameters)
+    signing_seconds = time.time() - start_time
+    store_bytes = len(json.dumps(to_dict(segwit_utxo), sort_keys=True, indent=4))
+
+    start_time = time.time()
+    make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=calibration_parameters)
+    ctv_baking_seconds = time.time() - start_time
+    ctv_store_bytes = len(json.dumps(to_dict(segwit_utxo), sort_keys=True, indent=4))
+
+    return {
+        "num_transactions": num_transactions,
+        "planning_seconds": planning_seconds / num_transactions,
+        "signing_seconds": signing_seconds / num_transactions,
+        "ctv_baking_seconds": ctv_baking_seconds / num_transactions,
+        "transaction_store_bytes": store_bytes / num_transactions,
+        "ctv_transaction_store_bytes": ctv_store_bytes / num_transactions,
+    }
+
+def get_calibration(parameters):
+    """
+    Get the (cached) calibration for the given settings.
+    """
+    key = get_calibration_key(parameters)
+    if key not in _calibrations:
+        _calibrations[key] = run_calibration(parameters)
+        logger.info("Calibrated estimates with a {}-transaction vault".format(_calibrations[key]["num_transactions"]))
+    return _calibrations[key]
+
+def estimate(parameters, calibrate=True):
+    """
+    Estimate the tree size for the given parameters and, with calibrate=True,
+    the serialized sizes of the transaction stores (in bytes) and the time for
+    planning, signing and baking (in seconds).
+    """
+    result = estimate_tree_size(parameters)
+
+    if calibrate:
+        calibration = get_calibration(parameters)
+        for some_name in ["planning_seconds", "signing_seconds", "ctv_baking_seconds", "transaction_store_bytes", "ctv_transaction_store_bytes"]:
+            result[some_name] = calibration[some_name] * result["transactions"]
+
+    return result
@@ -1,37 +1,155 @@
 """
 Generate a graphviz rendering of the planned transaction tree.
+
+The DOT file is written directly, one line per node or edge, so that large
+trees don't have to be built into a graphviz.Digraph first. Repeating parts
+of the tree are collapsed into summary nodes, because graphviz layout of the
+whole tree is slow and unreadable. The graphviz package (pip3 install
+graphviz) is only needed for viewing the result.
 """
 
-# pip3 install graphviz
-from graphviz import Digraph
+from vaults.config import GRAPHVIZ_FILENAME
+from vaults.exceptions import VaultException
+from vaults.models.script_templates import CPFPHookScriptTemplate
+from vaults.models.plans import PlannedUTXO
+
+# The subtrees of transactions with these names (the push to cold storage, and
+# the burn transaction after it) are drawn as one summary node.
+COLLAPSED_TRANSACTION_NAMES = (
+    "push-to-cold-storage",
+    "Sharded UTXO sweep transaction",
+)
 
-def generate_graphviz(some_utxo, parameters, output_filename="output.gv"):
+def quote(value):
     """
-    Generate a graphviz dotfile, which can be used to create a
-    pictorial/graphical representation of the planned transaction tree.
+    Quote a string for use as a DOT id or label. Escape sequences like \\n
+    are left alone, graphviz uses them for line breaks in labels.
+    """
+    return '"' + str(value).replace('"', '\\"') + '"'
+
+def count_subtree(some_transaction):
+    """
+    Count the UTXOs and transactions in the subtree of a planned transaction
+    (including itself).
+    """
+    num_utxos = 0
+    num_transactions = 0
+    seen = set()
+    stack = [some_transaction]
+    while len(stack) > 0:
+        some_transaction = stack.pop()
+        if id(some_transaction) in seen:
+            continue
+        seen.add(id(some_transaction))
+
+        num_transactions += 1
+        num_utxos += len(some_transaction.output_utxos)
+        for some_utxo in some_transaction.output_utxos:
+            stack.extend(some_utxo.child_transactions)
+    return (num_utxos, num_transactions)
+
+def find_focus(some_object, focus):
+    """
+    Find the planned UTXO or transaction with the given internal id below
+    some_object.
+    """
+    seen = set()
+    stack = [some_object]
+    while len(stack) > 0:
+        some_object = stack.pop()
+        if id(some_object) in seen:
+            continue
+        seen.add(id(some_object))
+
+        if str(some_object.internal_id) == str(focus):
+            return some_object
+
+        if isinstance(some_object, PlannedUTXO):
+            stack.extend(some_object.child_transactions)
+        else:
+            stack.extend(some_object.output_utxos)
+
+    raise VaultException("Can't find {} in the planned transaction tree".format(focus))
+
+def iter_dot_lines(some_object, max_depth=None, focus=None, collapse=True):
+    """
+    Generate the lines of a graphviz dotfile for the planned transaction tree
+    below some_object (a planned UTXO or transaction, or the
+    InitialTransaction), or below the node with the internal id given by
+    focus.
 
     legend:
         squares: transactions
         circles: outputs because coins are circular
+        3d boxes: collapsed subtrees
+        dashed: nodes that are deeper than max_depth, and not expanded
+
+    With collapse, CPFP hook outputs are left out (every transaction has
+    one), and push-to-cold-storage and sweep subtrees are drawn as a single
+    node.
     """
-    (utxos, transactions) = some_utxo.crawl()
+    if focus != None:
+        some_object = find_focus(some_object, focus)
+
+    yield "digraph output {\n"
+
+    seen = set()
+    stack = [(some_object, 0)]
+    while len(stack) > 0:
+        (some_object, depth) = stack.pop()
+        if id(some_object) in seen:
+            continue
+        seen.add(id(some_object))
 
-    diagram = Digraph("output", filename=output_filename)
+        node_id = quote(some_object.internal_id)
+        expand = max_depth == None or depth < max_depth
 
-    diagram.attr("node", shape="square")
-    for transaction in transactions:
-        diagram.node(str(transaction.internal_id), transaction.name)
+        if isinstance(some_object, PlannedUTXO):
+            some_utxo = some_object
+            child_transactions = some_utxo.child_transactions
+            if not expand and len(child_transactions) > 0:
+                yield "\t{} [label={}, shape=circle, style=dashed];\n".format(node_id, quote(some_utxo.name))
+                continue
+            yield "\t{} [label={}, shape=circle];\n".format(node_id, quote(some_utxo.name))
 
-    diagram.attr("node", shape="circle")
-    for utxo in utxos:
-        diagram.node(str(utxo.internal_id), utxo.name)
+            for child_transaction in child_transactions:
+                yield "\t{} -> {};\n".format(node_id, quote(child_transaction.internal_id))
+                stack.append((child_transaction, depth + 1))
 
-        diagram.edge(str(utxo.transaction.internal_id), str(utxo.internal_id))
+        else:
+            some_transaction = some_object
+            output_utxos = some_transaction.output_utxos
+            if collapse:
+                output_utxos = [some_utxo for some_utxo in output_utxos if some_utxo.script_template != CPFPHookScriptTemplate]
 
-        for child_transaction in utxo.child_transactions:
-            diagram.edge(str(utxo.internal_id), str(child_transaction.internal_id))
+            if collapse and depth > 0 and some_transaction.name in COLLAPSED_TRANSACTION_NAMES:
+                (num_utxos, num_transactions) = count_subtree(some_transaction)
+                label = "{}\\n({} transactions, {} UTXOs)".format(some_transaction.name, num_transactions, num_utxos)
+                yield "\t{} [label={}, shape=box3d];\n".format(node_id, quote(label))
+                continue
+            elif not expand and len(output_utxos) > 0:
+                yield "\t{} [label={}, shape=square, style=dashed];\n".format(node_id, quote(some_transaction.name))
+                continue
+            yield "\t{} [label={}, shape=square];\n".format(node_id, quote(some_transaction.name))
+
+            for some_utxo in output_utxos:
+                yield "\t{} -> {};\n".format(node_id, quote(some_utxo.internal_id))
+            stack.extend([(some_utxo, depth + 1) for some_utxo in reversed(output_utxos)])
+
+    yield "}\n"
+
+def generate_graphviz(some_utxo, parameters, output_filename=GRAPHVIZ_FILENAME, max_depth=None, focus=None, collapse=True):
+    """
+    Generate a graphviz dotfile, which can be used to create a
+    pictorial/graphical representation of the planned transaction tree. See
+    iter_dot_lines. Returns the filename.
+    """
+    with open(output_filename, "w") as fd:
+        fd.writelines(iter_dot_lines(some_utxo, max_depth=max_depth, focus=focus, collapse=collapse))
 
-    if parameters["enable_graphviz_popup"] == True:
-        diagram.view()
+    if parameters.get("enable_graphviz_popup", False) == True:
+        # pip3 install graphviz
+        import graphviz
+        graphviz.Source.from_file(output_filename).view()
 
-    return diagram
+    return output_filename
@@ -3,8 +3,12 @@ Functions in this file should only be used during prototype, and not for any
 sort of real-world use.
 """
 
+from bitcoin.core import COIN
+from bitcoin.core.key import CPubKey
+from bitcoin.core.script import Hash160
 from bitcoin.wallet import CBitcoinSecret
 
+from vaults.helpers.formatting import b2x, x
 from vaults.utils import sha256
 
 def make_private_keys():
@@ -39,3 +43,37 @@ def make_private_keys():
         private_keys.append(private_key)
 
     return private_keys
+
+def make_parameters(private_key, num_shards=5, amount=2 * COIN, enable_burn_transactions=True):
+    """
+    Make a bag of vault parameters where every key is the given private key.
+    This mirrors what the "vault init" command does, and it is handy for tests
+    and for planning vaults without talking to bitcoind.
+    """
+    if type(private_key) == str:
+        private_key = CBitcoinSecret(private_key)
+
+    parameters = {
+        "num_shards": num_shards,
+        "enable_burn_transactions": enable_burn_transactions,
+        "enable_graphviz": False,
+        "enable_graphviz_popup": False,
+        "amount": amount,
+        "unspendable_key_1": CPubKey(x("0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798")),
+    }
+
+    parameter_names = [
+        "user_key",
+        "ephemeral_key_1",
+        "ephemeral_key_2",
+        "cold_key1",
+        "cold_key2",
+        "hot_wallet_key",
+    ]
+
+    for some_name in parameter_names:
+        parameters[some_name] = {"private_key": private_key, "public_key": private_key.pub}
+
+    parameters["user_key_hash160"] = b2x(Hash160(parameters["user_key"]["public_key"]))
+
+    return parameters
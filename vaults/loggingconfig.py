@@ -1,24 +1,85 @@
 """
 Setup python logging system- log to a file in the current working directory
-(for each vault), and also log to console stdout and stderr.
+(for each vault), and also log to console stdout and stderr. The log file is
+only created when the first message is logged.
+
+The "vault" logger only puts records on a queue (QueueHandler). A background
+thread (QueueListener) formats them and writes them to the console and the
+log file, so that logging doesn't block planning and signing on I/O. The
+per-transaction messages of the signing and baking loops are logged at DEBUG,
+which is off by default (see set_log_level and "vault --log-level").
 """
 
 import os
+import queue
+import atexit
 import logging
+import logging.handlers
 
-logger = logging.getLogger("vault")
-logger.setLevel(logging.DEBUG)
+DEFAULT_LOG_LEVEL = logging.INFO
 
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
+LOG_LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
 
-fh = logging.FileHandler(os.path.join(os.getcwd(), "log.txt"))
-fh.setLevel(logging.DEBUG)
+logger = logging.getLogger("vault")
+logger.setLevel(DEFAULT_LOG_LEVEL)
 
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
-ch.setFormatter(formatter)
-fh.setFormatter(formatter)
+_listener = None
+
+def start_logging():
+    """
+    Connect the logger to a new queue, and start the listener thread that
+    writes the queued records to the console and to log.txt.
+    """
+    global _listener
+
+    ch = logging.StreamHandler()
+    ch.setFormatter(formatter)
+
+    fh = logging.FileHandler(os.path.join(os.getcwd(), "log.txt"), delay=True)
+    fh.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, ch, fh)
+    _listener.start()
+
+def stop_logging():
+    """
+    Write out the records that are still in the queue, and stop the listener
+    thread.
+    """
+    global _listener
+    if _listener != None:
+        _listener.stop()
+        _listener = None
+
+def set_log_level(level):
+    """
+    Set the level of the "vault" logger, either a logging level or one of the
+    names in LOG_LEVELS.
+    """
+    if type(level) == str:
+        level = LOG_LEVELS[level.lower()]
+    logger.setLevel(level)
+
+def _restart_logging_in_child():
+    # The listener thread doesn't exist in a forked worker process, so the
+    # worker needs its own.
+    global _listener
+    _listener = None
+    start_logging()
 
-logger.addHandler(ch)
-logger.addHandler(fh)
+start_logging()
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_logging_in_child)
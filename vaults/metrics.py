@@ -0,0 +1,169 @@
+"""
+Per-phase timing and counting for the vault commands.
+
+A PhaseRecorder measures each phase of a command (see
+commands/initialize.py): wall time, CPU time, optionally the peak memory
+allocated by python (tracemalloc), and how much some counters went up. The
+counters are incremented by the code that does the work, with count():
+
+    rpc_calls: calls to bitcoind (see rpc.MeteredProxy)
+    sighashes: signature hashes computed for signing (see signing.py)
+    signatures: signatures made (see signing.py)
+    ctv_hashes: OP_CHECKTEMPLATEVERIFY standard template hashes (see
+        bip119_ctv.py)
+
+Counting is a dictionary increment, so it is always on. Work done in worker
+processes (like baking lazy re-vault subtrees with planning_processes > 1) is
+timed with the phase, but it isn't counted.
+"""
+
+import os
+import json
+import time
+import platform
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from vaults.config import PROFILE_FILENAME
+
+COUNTERS = ("rpc_calls", "sighashes", "signatures", "ctv_hashes")
+
+PROFILE_FORMAT_VERSION = 1
+
+_counts = Counter()
+
+def count(name, value=1):
+    """
+    Increment one of the COUNTERS.
+    """
+    _counts[name] += value
+
+def get_counts():
+    return dict([(name, _counts[name]) for name in COUNTERS])
+
+class Phase(object):
+    """
+    The measurements of one phase. values holds other numbers about the
+    phase, like the number of planned nodes.
+    """
+
+    __slots__ = ("name", "wall_time", "cpu_time", "peak_memory", "counts", "values")
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_memory = None
+        self.counts = {}
+        self.values = {}
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "peak_memory": self.peak_memory,
+            "counts": self.counts,
+            "values": self.values,
+        }
+
+class PhaseRecorder(object):
+    """
+    Records a list of phases. With trace_memory, tracemalloc is started (if it
+    isn't running yet) to measure the peak memory of each phase, which makes
+    everything slower.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = []
+        self.values = {}
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measure the code in the with block as a phase. Yields the Phase, so
+        that the block can add values to it.
+        """
+        some_phase = Phase(name)
+        self.phases.append(some_phase)
+
+        counts = get_counts()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start_cpu_time = time.process_time()
+        start_wall_time = time.perf_counter()
+        try:
+            yield some_phase
+        finally:
+            some_phase.wall_time = time.perf_counter() - start_wall_time
+            some_phase.cpu_time = time.process_time() - start_cpu_time
+            if self.trace_memory:
+                some_phase.peak_memory = tracemalloc.get_traced_memory()[1]
+            some_phase.counts = dict([(name, value - counts[name]) for (name, value) in get_counts().items()])
+
+    def stop(self):
+        """
+        Stop tracemalloc, if it was started for this recorder.
+        """
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def to_dict(self):
+        totals = {
+            "wall_time": sum([some_phase.wall_time for some_phase in self.phases]),
+            "cpu_time": sum([some_phase.cpu_time for some_phase in self.phases]),
+            "counts": dict([(name, sum([some_phase.counts.get(name, 0) for some_phase in self.phases])) for name in COUNTERS]),
+        }
+        if self.trace_memory:
+            totals["peak_memory"] = max([some_phase.peak_memory for some_phase in self.phases] + [0])
+
+        return {
+            "version": PROFILE_FORMAT_VERSION,
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "values": self.values,
+            "phases": [some_phase.to_dict() for some_phase in self.phases],
+            "totals": totals,
+        }
+
+    def save(self, filename=PROFILE_FILENAME):
+        """
+        Write the report as json, into the current working directory unless
+        the filename is a path.
+        """
+        with open(os.path.join(os.getcwd(), filename), "w") as fd:
+            json.dump(self.to_dict(), fd, indent=4)
+
+    def format_report(self):
+        """
+        Render the phases as a table for humans.
+        """
+        header = ["phase", "wall", "cpu", "memory"] + list(COUNTERS)
+        rows = []
+        for some_phase in self.phases:
+            memory = "-" if some_phase.peak_memory == None else "{:.1f}MB".format(some_phase.peak_memory / 1e6)
+            row = [some_phase.name, "{:.3f}s".format(some_phase.wall_time), "{:.3f}s".format(some_phase.cpu_time), memory]
+            row.extend([str(some_phase.counts.get(name, 0)) for name in COUNTERS])
+            rows.append(row)
+
+        widths = [max([len(row[idx]) for row in rows + [header]]) for idx in range(len(header))]
+        output = ""
+        for row in [header] + rows:
+            cells = [row[0].ljust(widths[0])] + [cell.rjust(width) for (cell, width) in zip(row[1:], widths[1:])]
+            output += "  ".join(cells) + "\n"
+
+        for (name, value) in sorted(self.values.items()):
+            output += "{}: {}\n".format(name, value)
+        for some_phase in self.phases:
+            for (name, value) in sorted(some_phase.values.items()):
+                output += "{} {}: {}\n".format(some_phase.name, name, value)
+
+        return output
@@ -0,0 +1,559 @@
+"""
+A columnar (struct-of-arrays) representation of the planned transaction tree.
+
+The object graph in plans.py is convenient for planning and signing, but every
+node is a python object. For analytics, simulation and bulk persistence, the
+same tree can be converted into a ColumnarTree, where each node (transaction or
+UTXO) is an index into a set of typed arrays. Adjacency is stored CSR-style: the
+children of node i are child_indices[child_offsets[i]:child_offsets[i+1]].
+
+For a transaction, the children are its output UTXOs (in vout order). For a
+UTXO, the children are the possible child transactions that spend it. Inputs
+are stored the same way, as a list of spent UTXOs per transaction, along with
+the witness template selection for each input.
+
+The planner's safety rules (planner.safety_check) run over this form as well:
+each rule is a few passes over whole columns, which produce one flag byte per
+node, see ColumnarTree.run_safety_checks.
+
+Only the plan is represented here. Scripts, signatures and bitcoin
+transactions are not part of the columnar form.
+"""
+
+import sys
+import json
+import time
+import struct
+from array import array
+from bisect import bisect_right
+from collections import deque
+from functools import reduce
+from itertools import accumulate
+from operator import and_, or_, xor, eq, gt, ne, not_, sub
+
+from vaults.exceptions import VaultException
+from vaults.helpers.formatting import b2lx, lx
+from vaults.timelocks import DEFAULT_TIMELOCK_SCHEDULE, SEQUENCE_LOCKTIME_MASK
+
+from vaults.models.script_templates import (
+    ScriptTemplate,
+    UserScriptTemplate,
+    ColdStorageScriptTemplate,
+    BurnUnspendableScriptTemplate,
+    BasicPresignedScriptTemplate,
+    ShardScriptTemplate,
+    CPFPHookScriptTemplate,
+)
+
+from vaults.models.plans import (
+    PlannedUTXO,
+    PlannedInput,
+    PlannedTransaction,
+    InitialTransaction,
+)
+
+# node kinds
+KIND_INITIAL_TRANSACTION = 0
+KIND_TRANSACTION = 1
+KIND_UTXO = 2
+
+# Script templates are stored by id. The names are also written into saved
+# files, so that adding a new template doesn't break old files.
+SCRIPT_TEMPLATES = (
+    UserScriptTemplate,
+    ColdStorageScriptTemplate,
+    BurnUnspendableScriptTemplate,
+    BasicPresignedScriptTemplate,
+    ShardScriptTemplate,
+    CPFPHookScriptTemplate,
+)
+
+# UTXOs with these script templates are never spent by a planned
+# transaction.
+UNSPENT_SCRIPT_TEMPLATES = (
+    BurnUnspendableScriptTemplate,
+    CPFPHookScriptTemplate,
+)
+
+# Rules for ColumnarTree.run_safety_checks: (rule name, method name). Each
+# method returns a list of the nodes that break the rule.
+SAFETY_RULES = (
+    ("outputs", "check_outputs"),
+    ("amounts", "check_amounts"),
+    ("children", "check_children"),
+    ("timelocks", "check_timelocks"),
+    ("templates", "check_templates"),
+)
+
+COLUMNAR_FILE_MAGIC = b"VAULTCOL"
+COLUMNAR_FILE_VERSION = 1
+
+# column name -> array typecode
+COLUMNS = (
+    ("kind", "b"),
+    ("counter", "q"),
+    ("parent", "q"),
+    ("amount", "q"),
+    ("template", "b"),
+    ("timelock_multiplier", "i"),
+    ("name", "i"),
+    ("child_offsets", "q"),
+    ("child_indices", "q"),
+    ("input_offsets", "q"),
+    ("input_indices", "q"),
+    ("input_selections", "i"),
+)
+
+_INVERT_TABLE = bytes([1] + [0] * 255)
+
+def _make_byte_table(values):
+    """
+    A translation table (for bytes.translate) that maps each of the given
+    signed byte values to 1, and every other value to 0.
+    """
+    table = bytearray(256)
+    for value in values:
+        table[value & 0xff] = 1
+    return bytes(table)
+
+def _invert_mask(mask):
+    return mask.translate(_INVERT_TABLE)
+
+def _combine_masks(operation, *masks):
+    """
+    Combine masks (bytes with a 0 or 1 for each node) with a bitwise
+    operation, like operator.and_, by treating each mask as one integer.
+    """
+    result = reduce(operation, [int.from_bytes(mask, "little") for mask in masks])
+    return result.to_bytes(len(masks[0]), "little")
+
+def _get_mask_positions(mask):
+    """
+    Get the positions of the set bytes of a mask.
+    """
+    positions = []
+    position = mask.find(1)
+    while position != -1:
+        positions.append(position)
+        position = mask.find(1, position + 1)
+    return positions
+
+class ColumnarTree(object):
+    """
+    Struct-of-arrays form of a planned transaction tree. Node 0 is always the
+    InitialTransaction.
+    """
+
+    def __init__(self):
+        # per-node columns
+        self.kind = array("b")
+        self.counter = array("q")
+        # For a UTXO, the index of the transaction that creates it. -1 for
+        # transactions.
+        self.parent = array("q")
+        self.amount = array("q")
+        # index into SCRIPT_TEMPLATES, -1 for transactions
+        self.template = array("b")
+        self.timelock_multiplier = array("i")
+        # index into the string table
+        self.name = array("i")
+
+        # CSR adjacency: outputs of a transaction, or child transactions of a
+        # UTXO.
+        self.child_offsets = array("q", [0])
+        self.child_indices = array("q")
+
+        # CSR inputs: the UTXOs spent by each transaction, with the witness
+        # template selection (string table index) of each input.
+        self.input_offsets = array("q", [0])
+        self.input_indices = array("q")
+        self.input_selections = array("i")
+
+        self.strings = []
+        self._string_lookup = {}
+
+        # Data that only applies to the user's coins.
+        self.initial_txid = None
+        self.vout_overrides = {}
+        self.txid_overrides = {}
+
+    def __len__(self):
+        return len(self.kind)
+
+    def intern_string(self, value):
+        """
+        Get the string table index for the given string (or None).
+        """
+        if value == None:
+            return -1
+        if value not in self._string_lookup:
+            self._string_lookup[value] = len(self.strings)
+            self.strings.append(value)
+        return self._string_lookup[value]
+
+    def get_string(self, index):
+        if index == -1:
+            return None
+        return self.strings[index]
+
+    def get_children(self, node):
+        return self.child_indices[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def get_inputs(self, node):
+        return self.input_indices[self.input_offsets[node]:self.input_offsets[node + 1]]
+
+    @classmethod
+    def from_tree(cls, initial_tx):
+        """
+        Build a columnar tree from the object form, starting at the
+        InitialTransaction.
+        """
+        tree = cls()
+
+        # Assign an index to every node, in depth-first order.
+        nodes = []
+        index = {}
+        stack = [initial_tx]
+        while len(stack) > 0:
+            node = stack.pop()
+            if id(node) in index:
+                continue
+            index[id(node)] = len(nodes)
+            nodes.append(node)
+
+            if isinstance(node, PlannedUTXO):
+                stack.extend(reversed(node.child_transactions))
+            else:
+                stack.extend(reversed(node.output_utxos))
+
+        template_ids = dict([(template, idx) for (idx, template) in enumerate(SCRIPT_TEMPLATES)])
+
+        for node in nodes:
+            tree.counter.append(node.id)
+            tree.name.append(tree.intern_string(node.name))
+
+            if isinstance(node, PlannedUTXO):
+                tree.kind.append(KIND_UTXO)
+                tree.parent.append(index[id(node.transaction)])
+                tree.amount.append(node.amount)
+                tree.template.append(template_ids[node.script_template])
+                tree.timelock_multiplier.append(node.timelock_multiplier)
+                children = node.child_transactions
+                if node._vout_override != None:
+                    tree.vout_overrides[index[id(node)]] = node._vout_override
+                if node._txid_override != None:
+                    tree.txid_overrides[index[id(node)]] = node._txid_override
+            else:
+                if node.__class__ == InitialTransaction:
+                    tree.kind.append(KIND_INITIAL_TRANSACTION)
+                    tree.initial_txid = node.txid
+                else:
+                    tree.kind.append(KIND_TRANSACTION)
+                tree.parent.append(-1)
+                tree.amount.append(0)
+                tree.template.append(-1)
+                tree.timelock_multiplier.append(0)
+                children = node.output_utxos
+
+                for some_input in node.inputs:
+                    tree.input_indices.append(index[id(some_input.utxo)])
+                    tree.input_selections.append(tree.intern_string(some_input.witness_template_selection))
+
+            tree.child_indices.extend([index[id(child)] for child in children])
+            tree.child_offsets.append(len(tree.child_indices))
+            tree.input_offsets.append(len(tree.input_indices))
+
+        return tree
+
+    def to_tree(self):
+        """
+        Rebuild the object form of the planned transaction tree. Returns the
+        InitialTransaction. The rebuilt objects are dirty, so they get signed
+        (and baked) from scratch.
+        """
+        if len(self) == 0 or self.kind[0] != KIND_INITIAL_TRANSACTION:
+            raise VaultException("Columnar tree doesn't start with an initial transaction")
+
+        nodes = [None] * len(self)
+
+        # Make every transaction first, then the UTXOs (which point at their
+        # transaction), then connect everything.
+        for node in range(len(self)):
+            kind = self.kind[node]
+            if kind == KIND_INITIAL_TRANSACTION:
+                some_transaction = InitialTransaction(txid=self.initial_txid)
+            elif kind == KIND_TRANSACTION:
+                some_transaction = PlannedTransaction(name=self.get_string(self.name[node]), enable_cpfp_hook=False)
+                some_transaction.id = self.counter[node]
+            else:
+                continue
+            nodes[node] = some_transaction
+
+        for node in range(len(self)):
+            if self.kind[node] != KIND_UTXO:
+                continue
+            some_utxo = PlannedUTXO(
+                name=self.get_string(self.name[node]),
+                transaction=nodes[self.parent[node]],
+                script_template=SCRIPT_TEMPLATES[self.template[node]],
+                amount=self.amount[node],
+                timelock_multiplier=self.timelock_multiplier[node],
+            )
+            some_utxo.id = self.counter[node]
+            some_utxo._vout_override = self.vout_overrides.get(node, None)
+            some_utxo._txid_override = self.txid_overrides.get(node, None)
+            nodes[node] = some_utxo
+
+        for node in range(len(self)):
+            children = [nodes[child] for child in self.get_children(node)]
+            if self.kind[node] == KIND_UTXO:
+                nodes[node].child_transactions = children
+                continue
+
+            some_transaction = nodes[node]
+            some_transaction.output_utxos = children
+            for position in range(self.input_offsets[node], self.input_offsets[node + 1]):
+                some_input = PlannedInput(
+                    utxo=nodes[self.input_indices[position]],
+                    witness_template_selection=self.get_string(self.input_selections[position]),
+                    transaction=some_transaction,
+                )
+                some_transaction.inputs.append(some_input)
+
+        return nodes[0]
+
+    def get_depths(self):
+        """
+        Compute the depth of every node, counting from the InitialTransaction
+        at depth 0, with a breadth-first walk over the child adjacency.
+        """
+        depths = array("l", [-1]) * len(self)
+        depths[0] = 0
+        queue = deque([0])
+        while len(queue) > 0:
+            node = queue.popleft()
+            depth = depths[node] + 1
+            for position in range(self.child_offsets[node], self.child_offsets[node + 1]):
+                child = self.child_indices[position]
+                if depths[child] == -1:
+                    depths[child] = depth
+                    queue.append(child)
+        return depths
+
+    def _get_kind_mask(self, kinds):
+        return self.kind.tobytes().translate(_make_byte_table(kinds))
+
+    def _get_node_prefix_sums(self, offsets, indices):
+        """
+        For every node, the sum of the amounts of the nodes in the CSR rows
+        (offsets, indices) of all of the nodes before it. The sum for node i
+        alone is the difference between the entries for i + 1 and i.
+        """
+        prefix = list(accumulate(map(self.amount.__getitem__, indices), initial=0))
+        return map(prefix.__getitem__, offsets)
+
+    def _get_childless_mask(self):
+        offsets = self.child_offsets
+        return bytes(map(eq, offsets[1:], offsets[:-1]))
+
+    def check_amounts(self):
+        """
+        Check that every transaction spends exactly the amount that it takes.
+        Returns a list of the nodes that don't, which is empty when the whole
+        tree balances.
+        """
+        # A transaction balances when the running difference between the
+        # input and output prefix sums doesn't change over its rows.
+        input_prefix = self._get_node_prefix_sums(self.input_offsets, self.input_indices)
+        output_prefix = self._get_node_prefix_sums(self.child_offsets, self.child_indices)
+        difference = list(map(sub, input_prefix, output_prefix))
+        unbalanced = bytes(map(ne, difference[1:], difference[:-1]))
+        return _get_mask_positions(_combine_masks(and_, self._get_kind_mask([KIND_TRANSACTION]), unbalanced))
+
+    def check_outputs(self):
+        """
+        Check that every transaction has at least one output, including the
+        burner transactions. Returns a list of the transactions that don't.
+        """
+        return _get_mask_positions(_combine_masks(and_, self._get_kind_mask([KIND_TRANSACTION]), self._get_childless_mask()))
+
+    def check_children(self):
+        """
+        Check that every UTXO can be spent by at least one planned
+        transaction, except for the UTXOs that are never spent by the vault
+        (the CPFP hooks and the burned UTXOs). Returns a list of the UTXOs
+        that have no child transactions.
+        """
+        spent_template_ids = [idx for (idx, template) in enumerate(SCRIPT_TEMPLATES) if template not in UNSPENT_SCRIPT_TEMPLATES]
+        needs_children = self.template.tobytes().translate(_make_byte_table(spent_template_ids))
+        return _get_mask_positions(_combine_masks(and_, needs_children, self._get_childless_mask()))
+
+    def check_timelocks(self, schedule=None):
+        """
+        Check that the timelock multiplier of every UTXO is in bounds: at
+        least 0, and small enough that each of the relative timelocks of its
+        script template can still be encoded by the given TimelockSchedule.
+        Returns a list of the UTXOs that are out of bounds.
+        """
+        if schedule == None:
+            schedule = DEFAULT_TIMELOCK_SCHEDULE
+        # The column doesn't say which UTXOs are on the shard schedule and
+        # which have windows (see TimelockSchedule.get_window_schedule), so
+        # the bound is the smaller of the two.
+        schedules = [schedule.get_shard_schedule(), schedule.get_window_schedule()]
+
+        # The largest multiplier for each script template id, and for -1
+        # (transactions, which don't have timelocks).
+        max_multipliers = []
+        for template in SCRIPT_TEMPLATES:
+            timelock_data = template.relative_timelocks
+            if timelock_data in [None, {}]:
+                max_multipliers.append(SEQUENCE_LOCKTIME_MASK)
+            else:
+                max_multipliers.append(min([some_schedule.get_max_multiplier(value) for value in timelock_data["replacements"].values() for some_schedule in schedules]))
+        max_multipliers.append(SEQUENCE_LOCKTIME_MASK)
+
+        multipliers = self.timelock_multiplier
+        if len(multipliers) == 0:
+            return []
+
+        # Usually every multiplier is below the smallest bound of the script
+        # templates, which only takes two passes over the column.
+        if min(multipliers) >= 0 and max(multipliers) <= min(max_multipliers):
+            return []
+
+        too_large = bytes(map(gt, multipliers, map(max_multipliers.__getitem__, self.template)))
+        negative = bytes(map((0).__gt__, multipliers))
+        return _get_mask_positions(_combine_masks(or_, too_large, negative))
+
+    def check_templates(self):
+        """
+        Check that the script templates are consistent with the tree: every
+        UTXO has a script template and is created by a transaction, every
+        transaction has no script template and is created by nothing, and
+        every input spends a UTXO with a witness template that the UTXO's
+        script template has. Returns a list of the bad nodes (for a bad
+        input, that is the transaction that has it).
+        """
+        is_utxo = self._get_kind_mask([KIND_UTXO])
+        is_not_utxo = _invert_mask(is_utxo)
+        has_template = self.template.tobytes().translate(_make_byte_table(range(len(SCRIPT_TEMPLATES))))
+
+        # The kind of the parent of every node, where parent -1 picks the -1
+        # at the end.
+        kind = self.kind + array("b", [-1])
+        parent_kind = array("b", map(kind.__getitem__, self.parent)).tobytes()
+        parent_is_transaction = parent_kind.translate(_make_byte_table([KIND_INITIAL_TRANSACTION, KIND_TRANSACTION]))
+        parent_is_missing = parent_kind.translate(_make_byte_table([-1]))
+
+        bad_nodes = set(_get_mask_positions(_combine_masks(or_,
+            _combine_masks(xor, is_utxo, has_template),
+            _combine_masks(and_, is_utxo, _invert_mask(parent_is_transaction)),
+            _combine_masks(and_, is_not_utxo, _invert_mask(parent_is_missing)),
+        )))
+
+        # Every allowed (script template id, witness template selection)
+        # pair. The spent node of an input must be a UTXO as well, which
+        # holds for every allowed pair since transactions have no template.
+        allowed = set()
+        for (template_id, template) in enumerate(SCRIPT_TEMPLATES):
+            for selection in template.witness_templates.keys():
+                if selection in self._string_lookup:
+                    allowed.add((template_id, self._string_lookup[selection]))
+        spent_templates = map(self.template.__getitem__, self.input_indices)
+        bad_inputs = bytes(map(not_, map(allowed.__contains__, zip(spent_templates, self.input_selections))))
+        for position in _get_mask_positions(bad_inputs):
+            bad_nodes.add(bisect_right(self.input_offsets, position) - 1)
+
+        return sorted(bad_nodes)
+
+    def run_safety_checks(self, schedule=None):
+        """
+        Run every rule in SAFETY_RULES over the tree. schedule is the
+        TimelockSchedule for the timelock rule. Returns a list of (rule name,
+        bad nodes, seconds) tuples, in the order that the rules ran.
+        """
+        results = []
+        for (rule_name, method_name) in SAFETY_RULES:
+            method = getattr(self, method_name)
+            start_time = time.perf_counter()
+            if rule_name == "timelocks":
+                bad_nodes = method(schedule=schedule)
+            else:
+                bad_nodes = method()
+            results.append((rule_name, bad_nodes, time.perf_counter() - start_time))
+        return results
+
+    def describe_node(self, node):
+        """
+        A short description of a node for error messages.
+        """
+        return "{} (node {}, counter {})".format(self.get_string(self.name[node]), node, self.counter[node])
+
+    def save(self, path):
+        """
+        Write the columnar tree to a binary file: a magic string, a json
+        header, and then the raw contents of each array.
+        """
+        header = {
+            "version": COLUMNAR_FILE_VERSION,
+            "byteorder": sys.byteorder,
+            "script_templates": [template.__name__ for template in SCRIPT_TEMPLATES],
+            "strings": self.strings,
+            "initial_txid": b2lx(self.initial_txid) if self.initial_txid != None else None,
+            "vout_overrides": dict([(str(node), vout) for (node, vout) in self.vout_overrides.items()]),
+            "txid_overrides": dict([(str(node), b2lx(txid)) for (node, txid) in self.txid_overrides.items()]),
+            "columns": [(column_name, typecode, getattr(self, column_name).itemsize, len(getattr(self, column_name))) for (column_name, typecode) in COLUMNS],
+        }
+        header = bytes(json.dumps(header), "utf-8")
+
+        with open(path, "wb") as fd:
+            fd.write(COLUMNAR_FILE_MAGIC)
+            fd.write(struct.pack("<I", len(header)))
+            fd.write(header)
+            for (column_name, typecode) in COLUMNS:
+                getattr(self, column_name).tofile(fd)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a columnar tree that was written by ColumnarTree.save.
+        """
+        tree = cls()
+
+        with open(path, "rb") as fd:
+            if fd.read(len(COLUMNAR_FILE_MAGIC)) != COLUMNAR_FILE_MAGIC:
+                raise VaultException("{} is not a columnar tree file".format(path))
+
+            (header_length,) = struct.unpack("<I", fd.read(4))
+            header = json.loads(fd.read(header_length))
+
+            if header["version"] != COLUMNAR_FILE_VERSION:
+                raise VaultException("Unsupported columnar tree file version {}".format(header["version"]))
+
+            template_lookup = dict([(klass.__name__, klass) for klass in ScriptTemplate.__subclasses__()])
+            saved_templates = [template_lookup[name] for name in header["script_templates"]]
+
+            for (column_name, typecode, itemsize, length) in header["columns"]:
+                column = array(typecode)
+                if column.itemsize != itemsize:
+                    raise VaultException("Column {} was saved with a different item size".format(column_name))
+                column.fromfile(fd, length)
+                if header["byteorder"] != sys.byteorder:
+                    column.byteswap()
+                setattr(tree, column_name, column)
+
+        # Remap template ids in case the template list changed since saving.
+        template_ids = dict([(template, idx) for (idx, template) in enumerate(SCRIPT_TEMPLATES)])
+        remap = [template_ids[template] for template in saved_templates]
+        tree.template = array("b", [remap[value] if value != -1 else -1 for value in tree.template])
+
+        tree.strings = header["strings"]
+        tree._string_lookup = dict([(value, idx) for (idx, value) in enumerate(tree.strings)])
+
+        if header["initial_txid"] != None:
+            tree.initial_txid = lx(header["initial_txid"])
+        tree.vout_overrides = dict([(int(node), vout) for (node, vout) in header["vout_overrides"].items()])
+        tree.txid_overrides = dict([(int(node), lx(txid)) for (node, txid) in header.get("txid_overrides", {}).items()])
+
+        return tree
@@ -4,15 +4,16 @@ outputs.
 """
 
 import uuid
-from copy import copy
+import threading
 
 from bitcoin.core import CMutableTransaction
 from bitcoin.core.script import CScript, OP_0, SignatureHash, SIGHASH_ALL, SIGVERSION_WITNESS_V0, Hash160
 
 from vaults.helpers.formatting import b2x, x, b2lx, lx
 from vaults.loggingconfig import logger
-from vaults.rpc import get_bitcoin_rpc_connection
 from vaults.exceptions import VaultException
+from vaults.timelocks import TimelockSchedule, DEFAULT_TIMELOCK_SCHEDULE, get_relative_timelock
+from vaults.context import get_current_plan_context
 
 from vaults.models.script_templates import (
     ScriptTemplate,
@@ -20,6 +21,107 @@ from vaults.models.script_templates import (
     UserScriptTemplate,
 )
 
+_counter_lock = threading.Lock()
+
+def allocate_id(cls):
+    """
+    Get the next id for a new PlannedUTXO or PlannedTransaction, from the
+    active PlanContext (see vaults/context.py), or else from the counter on
+    the class, which is shared by everything in the process.
+    """
+    context = get_current_plan_context()
+    if context != None:
+        return context.allocate_id(cls.__name__)
+
+    with _counter_lock:
+        value = cls.__counter__
+        cls.__counter__ += 1
+    return value
+
+class RevaultStub(object):
+    """
+    A re-vault subtree that hasn't been planned yet. It has enough information
+    to plan the subtree later (see planner.expand_revault_stub): the subtree
+    is the sharding transaction for the remaining shards, and the transaction
+    that spends one of them and re-vaults the rest into another stub.
+
+    template_hashes is a list with the OP_CHECKTEMPLATEVERIFY standard
+    template hashes of the planned child transactions for each level of the
+    re-vault chain, starting with this one, or None if they weren't computed
+    yet (see bip119_ctv.get_revault_stub_template_hashes).
+    """
+
+    __slots__ = (
+        "per_shard_amount",
+        "num_shards",
+        "original_num_shards",
+        "depth",
+        "parameters",
+        "template_hashes",
+    )
+
+    def __init__(self, per_shard_amount=None, num_shards=None, original_num_shards=None, depth=0, parameters=None, template_hashes=None):
+        self.per_shard_amount = per_shard_amount
+        self.num_shards = num_shards
+        self.original_num_shards = original_num_shards
+        self.depth = depth
+        self.parameters = parameters
+        self.template_hashes = template_hashes
+
+    def to_dict(self):
+        """
+        Convert the stub to a formatted dictionary. Only the public parts of
+        the parameters are kept, which is all that planning and baking the
+        subtree needs.
+        """
+        public_parameters = {}
+        for (some_name, some_value) in (self.parameters or {}).items():
+            if type(some_value) == dict and "public_key" in some_value.keys():
+                public_parameters[some_name] = {"public_key": b2x(some_value["public_key"])}
+            elif isinstance(some_value, bytes):
+                public_parameters[some_name] = {"bytes": b2x(some_value)}
+            elif some_value == None or type(some_value) in [str, int, float, bool, list]:
+                public_parameters[some_name] = some_value
+
+        template_hashes = None
+        if self.template_hashes != None:
+            template_hashes = [[b2x(some_hash) for some_hash in level] for level in self.template_hashes]
+
+        return {
+            "per_shard_amount": self.per_shard_amount,
+            "num_shards": self.num_shards,
+            "original_num_shards": self.original_num_shards,
+            "depth": self.depth,
+            "parameters": public_parameters,
+            "template_hashes": template_hashes,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Instantiate a stub from a formatted dictionary.
+        """
+        parameters = {}
+        for (some_name, some_value) in data["parameters"].items():
+            if type(some_value) == dict and "public_key" in some_value.keys():
+                some_value = {"public_key": x(some_value["public_key"])}
+            elif type(some_value) == dict and "bytes" in some_value.keys():
+                some_value = x(some_value["bytes"])
+            parameters[some_name] = some_value
+
+        template_hashes = None
+        if data["template_hashes"] != None:
+            template_hashes = [[x(some_hash) for some_hash in level] for level in data["template_hashes"]]
+
+        return cls(
+            per_shard_amount=data["per_shard_amount"],
+            num_shards=data["num_shards"],
+            original_num_shards=data["original_num_shards"],
+            depth=data["depth"],
+            parameters=parameters,
+            template_hashes=template_hashes,
+        )
+
 class PlannedUTXO(object):
     """
     Represents a planned transaction output (txout), and connects to the rest
@@ -29,6 +131,43 @@ class PlannedUTXO(object):
 
     __counter__ = 0
 
+    # Trees grow quadratically with the number of shards, so every attribute
+    # is declared up front to avoid a per-instance __dict__.
+    __slots__ = (
+        "name",
+        "script_template",
+        "transaction",
+        "child_transactions",
+        "revault_stub",
+        "amount",
+        "timelock_multiplier",
+        "timelock_schedule",
+        "id",
+        "_internal_id",
+        "is_finalized",
+        "_vout_override",
+        "_txid_override",
+        "is_dirty",
+        "ctv_is_dirty",
+
+        # set by signing.parameterize_planned_utxo
+        "scriptpubkey",
+        "p2wsh_redeem_script",
+        "p2wsh_address",
+        "bitcoin_output",
+
+        # set by bip119_ctv.bake_ctv_output
+        "ctv_script",
+        "ctv_witness_fragments",
+        "ctv_p2wsh_redeem_script",
+        "ctv_scriptpubkey",
+        "ctv_bypass",
+
+        # only used while deserializing
+        "_transaction_internal_id",
+        "_child_transaction_internal_ids",
+    )
+
     def __init__(self, name=None, transaction=None, script_template=None, amount=None, timelock_multiplier=1):
         self.name = name
         self.script_template = script_template
@@ -40,16 +179,84 @@ class PlannedUTXO(object):
         # this UTXO.
         self.child_transactions = []
 
+        # A RevaultStub for the child transactions that aren't planned yet,
+        # see planner.expand_revault_stub.
+        self.revault_stub = None
+
         self.amount = amount
 
         self.timelock_multiplier = timelock_multiplier
 
-        self.id = copy(self.__class__.__counter__)
-        self.__class__.__counter__ += 1
-        self.internal_id = uuid.uuid4()
+        # None means DEFAULT_TIMELOCK_SCHEDULE. The planner sets this for
+        # every UTXO in the tree, see planner.apply_timelock_schedule.
+        self.timelock_schedule = None
+
+        self.id = allocate_id(PlannedUTXO)
+        self._internal_id = None
 
         self.is_finalized = False
         self._vout_override = None
+        self._txid_override = None
+
+        self.scriptpubkey = None
+        self.p2wsh_redeem_script = None
+        self.p2wsh_address = None
+        self.bitcoin_output = None
+
+        self.ctv_script = None
+        self.ctv_witness_fragments = None
+        self.ctv_p2wsh_redeem_script = None
+        self.ctv_scriptpubkey = None
+        self.ctv_bypass = False
+
+        self._transaction_internal_id = None
+        self._child_transaction_internal_ids = None
+
+        # Dirty state. is_dirty means the script has to be (re)parameterized,
+        # and ctv_is_dirty means the OP_CHECKTEMPLATEVERIFY script has to be
+        # recomputed. New objects are dirty until they are signed or baked.
+        self.is_dirty = True
+        self.ctv_is_dirty = True
+
+    def mark_dirty(self):
+        """
+        Mark this UTXO as needing a new script, such as after a key rotation.
+        The transaction that creates this UTXO and every descendant will get
+        new txids; the signing and baking entrypoints work out which other
+        planned objects are affected, based on the dirty flags.
+        """
+        self.is_dirty = True
+        self.ctv_is_dirty = True
+
+    def add_child_transaction(self, child_transaction):
+        """
+        Add a possible child transaction.
+        """
+        self.child_transactions.append(child_transaction)
+
+    @property
+    def internal_id(self):
+        """
+        A UUID for identifying this UTXO in the transaction store. It is only
+        generated when something asks for it, like when serializing, and it
+        is derived from the UTXO's position in the tree (see
+        assign_internal_ids).
+        """
+        if self._internal_id == None:
+            assign_internal_ids(self)
+        return self._internal_id
+
+    @internal_id.setter
+    def internal_id(self, value):
+        self._internal_id = value
+
+    def get_timelock_schedule(self):
+        """
+        The TimelockSchedule used for encoding this UTXO's relative timelocks.
+        """
+        if self.timelock_schedule == None:
+            return DEFAULT_TIMELOCK_SCHEDULE
+        return self.timelock_schedule
 
     @property
     def vout(self):
@@ -64,54 +271,77 @@ class PlannedUTXO(object):
         else:
             return self._vout_override
 
+    @property
+    def txid(self):
+        """
+        The txid of the transaction that created this output coin. The user's
+        coins going into the vault all hang off of one InitialTransaction
+        placeholder, but they can come from different wallet transactions, so
+        those coins have a _txid_override.
+        """
+        if self._txid_override == None:
+            return self.transaction.txid
+        else:
+            return self._txid_override
+
     def crawl(self):
         """
         Return a tuple that contains two items: a list of UTXOs and a list of
         transactions. Crawl the entire planned transaction tree starting from
         "self", and return a list of all the UTXOs and all the transactions.
         """
-        utxos = [self]
-        transactions = [self.transaction]
-
-        for child_transaction in self.child_transactions:
-            transactions.append(child_transaction)
-
-            for child_utxo in child_transaction.output_utxos:
-                utxos.append(child_utxo)
-
-                (more_utxos, more_transactions) = child_utxo.crawl()
-                utxos.extend(more_utxos)
-                transactions.extend(more_transactions)
-
-        utxos = list(set(utxos))
-        transactions = list(set(transactions))
+        utxos = set([self])
+        transactions = set([self.transaction])
+
+        # Use a stack instead of recursion, because the tree can be deeper
+        # than the recursion limit when there are many shards.
+        stack = [self]
+        while len(stack) > 0:
+            some_utxo = stack.pop()
+            for child_transaction in some_utxo.child_transactions:
+                if child_transaction in transactions:
+                    continue
+                transactions.add(child_transaction)
+
+                for child_utxo in child_transaction.output_utxos:
+                    if child_utxo not in utxos:
+                        utxos.add(child_utxo)
+                        stack.append(child_utxo)
+
+        utxos = list(utxos)
+        transactions = list(transactions)
 
         return (utxos, transactions)
 
-    def to_text(self, depth=0, cache=[]):
+    def count_nodes(self):
         """
-        Make a text representation of this UTXO suitable for human reading.
+        Count the UTXOs and transactions that crawl would return, without
+        building the lists. Returns a tuple of the number of UTXOs and the
+        number of transactions.
         """
-        output = ""
-        prefix = "-" * depth
-
-        output += f"{prefix} UTXO {self.name} amount = {self.amount}\n"
+        num_utxos = 1
+        transactions = set([self.transaction])
 
-        possible_children = len(self.child_transactions)
-
-        if possible_children == 0:
-            output += f"{prefix} UTXO {self.name} has no children.\n"
-        else:
-            output += f"{prefix} UTXO {self.name} has {possible_children} possible child transactions. They are:\n\n"
+        stack = [self]
+        while len(stack) > 0:
+            some_utxo = stack.pop()
+            for child_transaction in some_utxo.child_transactions:
+                if child_transaction in transactions:
+                    continue
+                transactions.add(child_transaction)
 
-            for child_transaction in self.child_transactions:
-                output += f"{prefix} UTXO {self.name} -> {child_transaction.name} (start)\n"
-                output += child_transaction.to_text(depth=depth+1, cache=cache)
-                output += f"{prefix} UTXO {self.name} -> {child_transaction.name} (end)\n"
+                # Each UTXO is created by exactly one transaction.
+                num_utxos += len(child_transaction.output_utxos)
+                stack.extend(child_transaction.output_utxos)
 
-            output += f"{prefix} UTXO {self.name} (end)\n\n"
+        return (num_utxos, len(transactions))
 
-        return output
+    def to_text(self, depth=0, max_depth=None):
+        """
+        Make a text representation of this UTXO suitable for human reading.
+        See iter_text_lines.
+        """
+        return "".join(iter_text_lines(self, depth=depth, max_depth=max_depth))
 
     def to_dict(self):
         """
@@ -131,6 +361,15 @@ class PlannedUTXO(object):
         if self._vout_override != None:
             data["_vout_override"] = self._vout_override
 
+        if self._txid_override != None:
+            data["_txid_override"] = b2lx(self._txid_override)
+
+        if self.timelock_schedule != None and not self.timelock_schedule.is_default:
+            data["timelock_schedule"] = self.timelock_schedule.to_dict()
+
+        if self.revault_stub != None:
+            data["revault_stub"] = self.revault_stub.to_dict()
+
         return data
 
     def to_json(self):
@@ -149,6 +388,7 @@ class PlannedUTXO(object):
         planned_utxo.id = data["counter"]
         planned_utxo.name = data["name"]
         planned_utxo.is_finalized = True
+        planned_utxo.is_dirty = False
 
         script_template_lookup = dict([(klass.__name__, klass) for klass in ScriptTemplate.__subclasses__()])
         planned_utxo.script_template = script_template_lookup[data["script_template_name"]]
@@ -162,6 +402,15 @@ class PlannedUTXO(object):
         if "_vout_override" in data.keys():
             planned_utxo._vout_override = data["_vout_override"]
 
+        if "_txid_override" in data.keys():
+            planned_utxo._txid_override = lx(data["_txid_override"])
+
+        if "timelock_schedule" in data.keys():
+            planned_utxo.timelock_schedule = TimelockSchedule.from_dict(data["timelock_schedule"])
+
+        if "revault_stub" in data.keys():
+            planned_utxo.revault_stub = RevaultStub.from_dict(data["revault_stub"])
+
         return planned_utxo
 
     @classmethod
@@ -176,22 +425,21 @@ class PlannedUTXO(object):
     def reconnect_deserialized_objects(self, inputs, outputs, transactions):
         """
         Upgrades _transaction_internal_id to self.transaction association.
+        The inputs, outputs and transactions are dictionaries keyed by
+        str(internal_id).
         """
-        internal_id_requirement = False
-        child_count = 0
-        for transaction in transactions:
-            if str(transaction.internal_id) == self._transaction_internal_id:
-                self.transaction = transaction
-                internal_id_requirement = True
-
-            if str(transaction.internal_id) in self._child_transaction_internal_ids:
-                self.child_transactions.append(transaction)
-                child_count += 1
-
-            if internal_id_requirement and child_count==len(self._child_transaction_internal_ids):
-                break
-        else:
-            raise VaultException("Failed to break")
+        if self._transaction_internal_id not in transactions:
+            raise VaultException("can't find transaction {}".format(self._transaction_internal_id))
+        self.transaction = transactions[self._transaction_internal_id]
+
+        # Keep the saved order of the child transactions. This can be called
+        # more than once for the same UTXO.
+        child_transactions = []
+        for child_transaction_internal_id in self._child_transaction_internal_ids:
+            if child_transaction_internal_id not in transactions:
+                raise VaultException("can't find transaction {}".format(child_transaction_internal_id))
+            child_transactions.append(transactions[child_transaction_internal_id])
+        self.child_transactions = child_transactions
 
 class PlannedInput(object):
     """
@@ -199,13 +447,44 @@ class PlannedInput(object):
     the coin that the input is consuming.
     """
 
+    __slots__ = (
+        "utxo",
+        "witness_template_selection",
+        "transaction",
+        "_internal_id",
+        "is_finalized",
+
+        # set by signing.sign_planned_transaction
+        "bitcoin_input",
+        "witness",
+
+        # set by bip119_ctv.bake_ctv_output
+        "ctv_witness",
+        "ctv_p2wsh_redeem_script",
+
+        # only used while deserializing
+        "_transaction_internal_id",
+        "_utxo_name",
+        "_utxo_internal_id",
+    )
+
     def __init__(self, utxo=None, witness_template_selection=None, transaction=None):
         self.utxo = utxo
         self.witness_template_selection = witness_template_selection
         self.transaction = transaction
-        self.internal_id = uuid.uuid4()
+        self._internal_id = None
         self.is_finalized = False
 
+        self.bitcoin_input = None
+        self.witness = None
+
+        self.ctv_witness = None
+        self.ctv_p2wsh_redeem_script = None
+
+        self._transaction_internal_id = None
+        self._utxo_name = None
+        self._utxo_internal_id = None
+
         if not utxo:
             return
 
@@ -213,32 +492,31 @@ class PlannedInput(object):
         if witness_template_selection not in utxo.script_template.witness_templates.keys():
             raise VaultException("Invalid witness selection")
 
-        # There might be multiple separate relative timelocks specified for
-        # this UTXO. There are different routes for spending. Some of them have
-        # different timelocks. The spending path was put on the PlannedUTXO
-        # object.
-        self.relative_timelock = None
-        timelock_multiplier = utxo.timelock_multiplier
-        if self.utxo.script_template.relative_timelocks != None:
-            timelock_data = self.utxo.script_template.relative_timelocks
-
-            # Some script templates don't have any timelocks.
-            if len(timelock_data.keys()) == 0:
-                pass
-            elif witness_template_selection in timelock_data["selections"].keys():
-                var_name = timelock_data["selections"][witness_template_selection]
-                relative_timelock_value = timelock_data["replacements"][var_name]
-
-                # Some PlannedUTXO objects have a "timelock multiplier", like
-                # if they are a sharded UTXO and have a variable-rate timelock.
-                relative_timelock_value = relative_timelock_value * timelock_multiplier
-                self.relative_timelock = relative_timelock_value
-
-                if relative_timelock_value > 0xfff:
-                    raise VaultException("Timelock {} exceeds max timelock {}".format(relative_timelock_value, 0xfff))
-
-                # Note that timelock_multiplier should appear again in another
-                # place, when inserting the timelocks into the script itself.
+    @property
+    def relative_timelock(self):
+        """
+        The encoded relative timelock (for nSequence) required by the spending
+        path selected for this input, or None. There might be multiple
+        separate relative timelocks specified for the UTXO, because different
+        routes for spending have different timelocks.
+        """
+        return get_relative_timelock(self.utxo, self.witness_template_selection)
+
+    @property
+    def internal_id(self):
+        """
+        A UUID for identifying this input in the transaction store. It is only
+        generated when something asks for it, like when serializing, and it
+        is derived from the input's position in the tree (see
+        assign_internal_ids).
+        """
+        if self._internal_id == None:
+            assign_internal_ids(self)
+        return self._internal_id
+
+    @internal_id.setter
+    def internal_id(self, value):
+        self._internal_id = value
 
     def to_dict(self):
         """
@@ -288,18 +566,14 @@ class PlannedInput(object):
     def reconnect_deserialized_objects(self, inputs, outputs, transactions):
         """
         Upgrades _transaction_internal_id to self.transaction association.
+        The inputs, outputs and transactions are dictionaries keyed by
+        str(internal_id).
         """
-        for transaction in transactions:
-            if transaction.internal_id == self._transaction_internal_id:
-                self.transaction = transaction
-                break
+        self.transaction = transactions.get(str(self._transaction_internal_id), self.transaction)
 
-        for some_utxo in outputs:
-            if some_utxo.internal_id == self._utxo_internal_id:
-                self.utxo = some_utxo
-                break
-        else:
+        if str(self._utxo_internal_id) not in outputs:
             raise VaultException("can't find UTXO {}".format(self._utxo_internal_id))
+        self.utxo = outputs[str(self._utxo_internal_id)]
 
 class PlannedTransaction(object):
     """
@@ -314,12 +588,35 @@ class PlannedTransaction(object):
 
     __counter__ = 0
 
+    __slots__ = (
+        "name",
+        "inputs",
+        "output_utxos",
+        "id",
+        "_internal_id",
+        "is_finalized",
+        "is_dirty",
+        "ctv_is_dirty",
+
+        # set by signing.sign_planned_transaction
+        "bitcoin_inputs",
+        "bitcoin_outputs",
+        "bitcoin_transaction",
+
+        # set by bip119_ctv.bake_ctv_transaction
+        "ctv_baked",
+        "ctv_bitcoin_transaction",
+    )
+
     def __init__(self, name=None, enable_cpfp_hook=True):
         self.name = name
 
         self.inputs = []
         self.output_utxos = []
 
+        self.id = allocate_id(PlannedTransaction)
+        self._internal_id = None
+
         if enable_cpfp_hook:
             cpfp_hook_utxo = PlannedUTXO(
                 name="CPFP hook",
@@ -329,15 +626,42 @@ class PlannedTransaction(object):
             )
             self.output_utxos.append(cpfp_hook_utxo)
 
-        self.id = copy(self.__class__.__counter__)
-        self.__class__.__counter__ += 1
-        self.internal_id = uuid.uuid4()
-
         self.ctv_baked = False
+        self.ctv_bitcoin_transaction = None
 
+        self.bitcoin_inputs = None
+        self.bitcoin_outputs = None
         self.bitcoin_transaction = None
         self.is_finalized = False
 
+        # A dirty transaction has to be re-signed (and re-baked), such as
+        # after its list of inputs or outputs was changed.
+        self.is_dirty = True
+        self.ctv_is_dirty = True
+
+    def mark_dirty(self):
+        """
+        Mark this transaction as structurally changed.
+        """
+        self.is_dirty = True
+        self.ctv_is_dirty = True
+
+    @property
+    def internal_id(self):
+        """
+        A UUID for identifying this transaction in the transaction store. It is
+        only generated when something asks for it, like when serializing, and
+        it is derived from the transaction's position in the tree (see
+        assign_internal_ids).
+        """
+        if self._internal_id == None:
+            assign_internal_ids(self)
+        return self._internal_id
+
+    @internal_id.setter
+    def internal_id(self, value):
+        self._internal_id = value
+
     @property
     def input_utxos(self):
         """
@@ -402,34 +726,12 @@ class PlannedTransaction(object):
 
         return True
 
-    def to_text(self, depth=0, cache=[]):
+    def to_text(self, depth=0, max_depth=None):
         """
         Make a text representation of this planned transaction suitable for
-        human reading.
+        human reading. See iter_text_lines.
         """
-        output = ""
-        prefix = "-" * depth
-
-        num_utxos = len(self.output_utxos)
-
-        if num_utxos == 0:
-            output += f"{prefix} Transaction {self.internal_id} ({self.name}) has no UTXOs.\n\n"
-        else:
-            if self.internal_id in cache:
-                output += f"{prefix} Transaction {self.internal_id} ({self.name}) previously rendered. (Another input)\n"
-            else:
-                cache.append(self.internal_id)
-
-                output += f"{prefix} Transaction {self.internal_id} ({self.name}) has {num_utxos} UTXOs. They are:\n\n"
-
-                for utxo in self.output_utxos:
-                    output += f"{prefix} Transaction ({self.name}) - UTXO {utxo.name} (start)\n"
-                    output += utxo.to_text(depth=depth+1, cache=cache)
-                    output += f"{prefix} Transaction ({self.name}) - UTXO {utxo.name} (end)\n"
-
-                output += f"{prefix} Transaction {self.internal_id} ({self.name}) end\n\n"
-
-        return output
+        return "".join(iter_text_lines(self, depth=depth, max_depth=max_depth))
 
     def to_dict(self):
         """
@@ -439,14 +741,18 @@ class PlannedTransaction(object):
             "counter": self.id,
             "internal_id": str(self.internal_id),
             "name": self.name,
-            "txid": b2lx(self.bitcoin_transaction.GetTxid()),
             "inputs": dict([(idx, some_input.to_dict()) for (idx, some_input) in enumerate(self.inputs)]),
             "outputs": dict([(idx, some_output.to_dict()) for (idx, some_output) in enumerate(self.output_utxos)]),
-            "bitcoin_transaction": b2x(self.bitcoin_transaction.serialize()),
         }
 
-        if hasattr(self, "ctv_bitcoin_transaction"):
-            logger.info("Transaction name: {}".format(self.name))
+        # Transactions planned from a re-vault stub after the keys were
+        # deleted only have an OP_CHECKTEMPLATEVERIFY version.
+        if self.bitcoin_transaction != None:
+            data["txid"] = b2lx(self.bitcoin_transaction.GetTxid())
+            data["bitcoin_transaction"] = b2x(self.bitcoin_transaction.serialize())
+
+        if self.ctv_bitcoin_transaction != None:
+            logger.debug("Transaction name: %s", self.name)
             data["ctv_bitcoin_transaction"] = b2x(self.ctv_bitcoin_transaction.serialize())
             data["ctv_bitcoin_transaction_txid"] = b2lx(self.ctv_bitcoin_transaction.GetTxid())
 
@@ -469,8 +775,18 @@ class PlannedTransaction(object):
         planned_transaction.name = data["name"]
         planned_transaction.internal_id = data["internal_id"]
         planned_transaction.id = data["counter"]
-        planned_transaction.bitcoin_transaction = CMutableTransaction.deserialize(x(data["bitcoin_transaction"]))
+        if "bitcoin_transaction" in data.keys():
+            planned_transaction.bitcoin_transaction = CMutableTransaction.deserialize(x(data["bitcoin_transaction"]))
         planned_transaction.is_finalized = True
+        planned_transaction.is_dirty = False
+
+        # The OP_CHECKTEMPLATEVERIFY version of the transaction, if this is
+        # from the OP_CHECKTEMPLATEVERIFY transaction store. Re-vault stubs
+        # need it for planning and baking their subtrees later.
+        if "ctv_bitcoin_transaction" in data.keys():
+            planned_transaction.ctv_bitcoin_transaction = CMutableTransaction.deserialize(x(data["ctv_bitcoin_transaction"]))
+            planned_transaction.ctv_baked = True
+            planned_transaction.ctv_is_dirty = False
 
         for (idx, some_input) in data["inputs"].items():
             planned_input = PlannedInput.from_dict(some_input)
@@ -511,8 +827,32 @@ class InitialTransaction(object):
     number for the output. It is otherwise not important. It's not a real
     bitcoin transaction. It was setup and provided by the bitcoin node. The
     vault only assumes that the output is a P2WPKH output.
+
+    When several of the user's coins go into one vault, they are all outputs
+    of the same InitialTransaction, and each coin has its own txid and vout
+    (_txid_override and _vout_override) in the user's wallet.
     """
 
+    __slots__ = (
+        "name",
+        "txid",
+        "is_finalized",
+        "output_utxos",
+        "inputs",
+        "id",
+        "internal_id",
+        "is_dirty",
+        "ctv_is_dirty",
+
+        # The signer and the bip119 baker treat this like any other planned
+        # transaction.
+        "bitcoin_inputs",
+        "bitcoin_outputs",
+        "bitcoin_transaction",
+        "ctv_baked",
+        "ctv_bitcoin_transaction",
+    )
+
     def __init__(self, txid=None):
         self.name = "initial transaction (from user)"
         self.txid = txid
@@ -521,6 +861,14 @@ class InitialTransaction(object):
         self.inputs = []
         self.id = -1
         self.internal_id = -1
+        self.is_dirty = False
+        self.ctv_is_dirty = False
+
+        self.bitcoin_inputs = None
+        self.bitcoin_outputs = None
+        self.bitcoin_transaction = None
+        self.ctv_baked = False
+        self.ctv_bitcoin_transaction = None
 
     @classmethod
     def check_inputs_outputs_are_finalized(cls):
@@ -530,14 +878,18 @@ class InitialTransaction(object):
     def serialize(self):
         # The transaction was already created by the user's wallet, so just
         # retrieve it from the wallet.
+        from vaults.rpc import get_bitcoin_rpc_connection
         connection = get_bitcoin_rpc_connection()
         return connection.getrawtransaction(self.txid)
 
     @property
     def child_transactions(self):
+        # Every user coin is spent by the same funding commitment transaction.
         _child_transactions = []
         for some_utxo in self.output_utxos:
-            _child_transactions.extend(some_utxo.child_transactions)
+            for child_transaction in some_utxo.child_transactions:
+                if child_transaction not in _child_transactions:
+                    _child_transactions.append(child_transaction)
         return _child_transactions
 
     def to_dict(self):
@@ -561,3 +913,164 @@ class InitialTransaction(object):
     def reconnect_deserialized_objects(self, inputs, outputs, transactions):
         for some_utxo in self.output_utxos:
             some_utxo.reconnect_deserialized_objects(inputs, outputs, transactions)
+
+def iter_text_lines(some_object, depth=0, max_depth=None):
+    """
+    Generate a text representation of the planned transaction tree below some
+    planned UTXO or transaction (or the InitialTransaction), one line at a
+    time, so that it can be written to a file without holding the whole
+    rendering in memory.
+
+    Transactions and UTXOs that were already rendered (a transaction can
+    spend more than one of the planned UTXOs) get a back-reference instead
+    of their subtree. Nodes deeper than max_depth are not expanded.
+    """
+    seen = set()
+    # Lines are strings, nodes are (planned object, depth) tuples.
+    stack = [(some_object, depth)]
+    while len(stack) > 0:
+        item = stack.pop()
+        if type(item) == str:
+            yield item
+            continue
+
+        (some_object, depth) = item
+        prefix = "-" * depth
+        expand = max_depth == None or depth < max_depth
+
+        if isinstance(some_object, PlannedUTXO):
+            some_utxo = some_object
+            yield f"{prefix} UTXO {some_utxo.name} amount = {some_utxo.amount}\n"
+
+            possible_children = len(some_utxo.child_transactions)
+            if possible_children == 0:
+                yield f"{prefix} UTXO {some_utxo.name} has no children.\n"
+                continue
+            elif id(some_utxo) in seen:
+                yield f"{prefix} UTXO {some_utxo.internal_id} ({some_utxo.name}) previously rendered.\n"
+                continue
+            elif not expand:
+                yield f"{prefix} UTXO {some_utxo.name} has {possible_children} possible child transactions, not rendered (depth limit).\n\n"
+                continue
+            seen.add(id(some_utxo))
+
+            yield f"{prefix} UTXO {some_utxo.name} has {possible_children} possible child transactions. They are:\n\n"
+
+            stack.append(f"{prefix} UTXO {some_utxo.name} (end)\n\n")
+            for child_transaction in reversed(some_utxo.child_transactions):
+                stack.append(f"{prefix} UTXO {some_utxo.name} -> {child_transaction.name} (end)\n")
+                stack.append((child_transaction, depth + 1))
+                stack.append(f"{prefix} UTXO {some_utxo.name} -> {child_transaction.name} (start)\n")
+
+        elif isinstance(some_object, (PlannedTransaction, InitialTransaction)):
+            some_transaction = some_object
+            num_utxos = len(some_transaction.output_utxos)
+            if num_utxos == 0:
+                yield f"{prefix} Transaction {some_transaction.internal_id} ({some_transaction.name}) has no UTXOs.\n\n"
+                continue
+            elif id(some_transaction) in seen:
+                yield f"{prefix} Transaction {some_transaction.internal_id} ({some_transaction.name}) previously rendered. (Another input)\n"
+                continue
+            elif not expand:
+                yield f"{prefix} Transaction {some_transaction.internal_id} ({some_transaction.name}) has {num_utxos} UTXOs, not rendered (depth limit).\n\n"
+                continue
+            seen.add(id(some_transaction))
+
+            yield f"{prefix} Transaction {some_transaction.internal_id} ({some_transaction.name}) has {num_utxos} UTXOs. They are:\n\n"
+
+            stack.append(f"{prefix} Transaction {some_transaction.internal_id} ({some_transaction.name}) end\n\n")
+            for utxo in reversed(some_transaction.output_utxos):
+                stack.append(f"{prefix} Transaction ({some_transaction.name}) - UTXO {utxo.name} (end)\n")
+                stack.append((utxo, depth + 1))
+                stack.append(f"{prefix} Transaction ({some_transaction.name}) - UTXO {utxo.name} (start)\n")
+
+# Namespace for the internal ids of planned objects, see assign_internal_ids.
+INTERNAL_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://github.com/kanzure/python-vaults/internal_id")
+
+def get_structural_parent(some_object):
+    """
+    Get the planned object that some planned UTXO, input or transaction hangs
+    off of, along with what kind of child it is and the list of its siblings
+    (including itself). A transaction hangs off of the UTXO that its first
+    input spends. Returns (None, None, None) for objects that aren't attached
+    to a tree.
+    """
+    if isinstance(some_object, PlannedUTXO):
+        if some_object.transaction == None:
+            return (None, None, None)
+        return (some_object.transaction, "output", some_object.transaction.output_utxos)
+    elif isinstance(some_object, PlannedInput):
+        if some_object.transaction == None:
+            return (None, None, None)
+        return (some_object.transaction, "input", some_object.transaction.inputs)
+    elif isinstance(some_object, PlannedTransaction):
+        if len(some_object.inputs) == 0 or some_object.inputs[0].utxo == None:
+            return (None, None, None)
+        parent_utxo = some_object.inputs[0].utxo
+        return (parent_utxo, "transaction", parent_utxo.child_transactions)
+    return (None, None, None)
+
+def make_root_internal_id(seed):
+    """
+    Make the internal id for the first UTXO of a vault that has to be told
+    apart from other vaults with the same parameters, like the vaults of a
+    farm (see commands/farm.py). The ids below the UTXO are derived from it
+    by assign_internal_ids.
+    """
+    return uuid.uuid5(INTERNAL_ID_NAMESPACE, "root/{}".format(seed))
+
+def assign_internal_ids(some_object):
+    """
+    Give the planned object (and the siblings and ancestors that don't have
+    one yet) an internal id. The id is a hash of the parent's id, the
+    object's position among its siblings and its name, so planning a vault
+    with the same parameters always gives the same ids. The tree starts at
+    the InitialTransaction, which always has internal id -1.
+
+    Objects that aren't attached to a tree get a random UUID.
+    """
+    # Walk up to the closest ancestor that already has an id, without
+    # recursion, because trees can be deeper than the recursion limit.
+    lineage = []
+    while some_object != None and not isinstance(some_object, InitialTransaction) and some_object._internal_id == None:
+        lineage.append(some_object)
+        some_object = get_structural_parent(some_object)[0]
+
+    for some_object in reversed(lineage):
+        if some_object._internal_id != None:
+            continue
+
+        (parent, kind, siblings) = get_structural_parent(some_object)
+        if parent != None:
+            # Number all of the siblings at once, so that a long list of
+            # siblings is only walked once.
+            parent_internal_id = parent.internal_id
+            planned_siblings = list(enumerate(siblings))
+
+            # Siblings can be removed and added again (see
+            # planner.update_vault_parameters), so a position might already
+            # be taken by the id of an older sibling.
+            taken_internal_ids = set([str(sibling._internal_id) for (index, sibling) in planned_siblings if sibling._internal_id != None])
+
+            for (index, sibling) in planned_siblings:
+                if sibling._internal_id != None:
+                    continue
+
+                if kind == "input":
+                    name = sibling.witness_template_selection
+                else:
+                    name = sibling.name
+
+                position = "{}/{}/{}/{}".format(parent_internal_id, kind, index, name)
+                internal_id = uuid.uuid5(INTERNAL_ID_NAMESPACE, position)
+                attempt = 0
+                while str(internal_id) in taken_internal_ids:
+                    attempt += 1
+                    internal_id = uuid.uuid5(INTERNAL_ID_NAMESPACE, "{}/{}".format(position, attempt))
+
+                sibling._internal_id = internal_id
+                taken_internal_ids.add(str(internal_id))
+
+        # This happens when the object isn't among its parent's children.
+        if some_object._internal_id == None:
+            some_object._internal_id = uuid.uuid4()
@@ -134,26 +134,28 @@ class ShardScriptTemplate(ScriptTemplate):
     spendable by hot wallet after timeout
     """
 
-    ephemeral_multisig_gated = BasicPresignedScriptTemplate.miniscript_policy
     # TODO: pick an appropriate timelock length.
     # (Other code is currently manipulating the timelock to make it
     # monotonically increasing in each sharded UTXO.)
-    miniscript_policy = f"or(and(pk(hot_wallet_key),older(144)),{ephemeral_multisig_gated})"
+    miniscript_policy = "or(and(pk(ephemeral_key_1),pk(ephemeral_key_2)),and(pk(hot_wallet_key),older(144)))"
     miniscript_policy_definitions = {"hot_wallet_key": "...", "ephemeral_key_1": "...", "ephemeral_key_2": "..."}
-    # or(and(pk(hot_wallet_key),older(144)),and(pk(ephemeral_key_1),and(pk(ephemeral_key_2),older(144))))
 
+    # Same layout as ColdStorageScriptTemplate, so that the presigned witness
+    # takes the ephemeral multisig branch. The hot wallet witness puts an
+    # empty signature on top, which fails the first OP_CHECKSIG.
     script_template = """
-<hot_wallet_key> OP_CHECKSIG OP_NOTIF
-  <ephemeral_key_1> OP_CHECKSIGVERIFY <ephemeral_key_2> OP_CHECKSIGVERIFY
-OP_ELSE
+<ephemeral_key_1> OP_CHECKSIG OP_NOTIF
+  <hot_wallet_key> OP_CHECKSIGVERIFY
   <TIMELOCK1> OP_CHECKSEQUENCEVERIFY
+OP_ELSE
+  <ephemeral_key_2> OP_CHECKSIG
 OP_ENDIF
     """
 
     witness_template_map = {"ephemeral_sig_1": "ephemeral_key_1", "ephemeral_sig_2": "ephemeral_key_2", "hot_wallet_key_sig": "hot_wallet_key"}
     witness_templates = {
         "presigned": "<ephemeral_sig_2> <ephemeral_sig_1>",
-        "hot-wallet": "<hot_wallet_key_sig>",
+        "hot-wallet": "<hot_wallet_key_sig> <empty>",
     }
     relative_timelocks = {
         "replacements": {
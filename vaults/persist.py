@@ -6,8 +6,19 @@ and loading.
 import os
 import json
 
+from vaults.helpers.formatting import b2x, b2lx
 from vaults.loggingconfig import logger
-from vaults.config import TRANSACTION_STORE_FILENAME
+from vaults.exceptions import VaultException
+from vaults.utils import sha256
+from vaults.config import (
+    TRANSACTION_STORE_FILENAME,
+    FARM_STORE_FILENAME,
+    PARAMETERS_FILENAME,
+    TRANSACTION_JOURNAL_FILENAME,
+    TRANSACTION_JOURNAL_FSYNC_INTERVAL,
+    PLAN_CACHE_DIRECTORY,
+    PLAN_CACHE_FORMAT_VERSION,
+)
 
 from vaults.models.plans import (
     InitialTransaction,
@@ -55,23 +66,21 @@ def from_dict(transaction_dicts):
 
     assert transactions[0].output_utxos[0].name == "segwit input coin"
 
-    outputs = []
-    inputs = []
+    # Index everything by internal id, so that reconnecting doesn't have to
+    # search through every object for every reference.
+    outputs = {}
+    inputs = {}
     for some_transaction in transactions:
-        inputs.extend(some_transaction.inputs)
-        outputs.extend(some_transaction.output_utxos)
-
-    # keep only uniques
-    inputs = list(set(inputs))
-    outputs = list(set(outputs))
+        for some_input in some_transaction.inputs:
+            inputs[str(some_input.internal_id)] = some_input
+        for some_utxo in some_transaction.output_utxos:
+            outputs[str(some_utxo.internal_id)] = some_utxo
+    transactions_by_id = dict([(str(some_transaction.internal_id), some_transaction) for some_transaction in transactions])
 
     # Second pass to add back object-to-object references. Maybe I should have
     # just used an ORM tool....
-    for some_utxo in outputs:
-        some_utxo.reconnect_deserialized_objects(inputs, outputs, transactions)
-
     for some_transaction in transactions:
-        some_transaction.reconnect_deserialized_objects(inputs, outputs, transactions)
+        some_transaction.reconnect_deserialized_objects(inputs, outputs, transactions_by_id)
 
     return transactions[0]
 
@@ -94,9 +103,379 @@ def save(some_utxo, filename=TRANSACTION_STORE_FILENAME):
     output/UTXO) and then dump the serialization into json and write into a
     file.
     """
-    output_data = to_dict(some_utxo)
-    output_json = json.dumps(output_data, sort_keys=False, indent=4, separators=(',', ': '))
+    save_transaction_dicts(to_dict(some_utxo), filename=filename)
+
+def save_transaction_dicts(transaction_dicts, filename=TRANSACTION_STORE_FILENAME):
+    """
+    Write transaction dictionaries (see to_dict) that were serialized
+    earlier, like save() does.
+    """
+    output_json = json.dumps(transaction_dicts, sort_keys=False, indent=4, separators=(',', ': '))
 
     with open(os.path.join(os.getcwd(), filename), "w") as fd:
         fd.write(output_json)
     logger.info(f"Wrote to {filename}")
+
+def save_farm(funding_txid, vault_dicts, filename=FARM_STORE_FILENAME):
+    """
+    Write the store for a farm of vaults (see commands/farm.py): the txid of
+    the funding transaction, and for each vault the vout of its coin in the
+    funding transaction and its transaction dictionaries (see to_dict).
+    vault_dicts is a list of (vout, transaction dictionaries).
+    """
+    with open(os.path.join(os.getcwd(), filename), "w") as fd:
+        fd.write("{{\n    \"funding_txid\": {},\n    \"vaults\": [".format(json.dumps(b2lx(funding_txid))))
+        for (idx, (vout, transaction_dicts)) in enumerate(vault_dicts):
+            if idx > 0:
+                fd.write(",")
+            fd.write("\n        ")
+            fd.write(json.dumps({"vout": vout, "transactions": transaction_dicts}))
+        fd.write("\n    ]\n}\n")
+    logger.info(f"Wrote to {filename}")
+
+def load_farm(path=None, farm_store_filename=FARM_STORE_FILENAME):
+    """
+    Read a farm store. Returns a dictionary from each vault's vout in the
+    funding transaction to the vault's InitialTransaction.
+    """
+    if path == None:
+        path = os.path.join(os.getcwd(), farm_store_filename)
+    with open(path, "r") as fd:
+        data = json.load(fd)
+
+    initial_transactions = {}
+    for vault_data in data["vaults"]:
+        initial_transactions[vault_data["vout"]] = from_dict(vault_data["transactions"])
+    return initial_transactions
+
+# Parameters that aren't saved by save_parameters: make_parameters makes these
+# from the private key, and planning_processes depends on the machine.
+UNSAVED_PARAMETER_NAMES = ["user_key_hash160", "unspendable_key_1", "planning_processes"]
+
+def save_parameters(parameters, filename=PARAMETERS_FILENAME):
+    """
+    Write the vault parameters that decide the shape of the planned
+    transaction tree (everything except the keys), so that commands like
+    "vault topup" can plan the same tree again.
+    """
+    saved_parameters = {}
+    for (some_name, some_value) in parameters.items():
+        if some_name in UNSAVED_PARAMETER_NAMES:
+            continue
+        elif type(some_value) == dict and "public_key" in some_value.keys():
+            continue
+        saved_parameters[some_name] = some_value
+
+    with open(os.path.join(os.getcwd(), filename), "w") as fd:
+        json.dump(saved_parameters, fd, indent=4, sort_keys=True)
+    logger.info(f"Wrote to {filename}")
+
+def load_parameters(path=None, parameters_filename=PARAMETERS_FILENAME):
+    """
+    Read the parameters written by save_parameters, or None for vaults that
+    were made before the parameters were saved.
+    """
+    if path == None:
+        path = os.path.join(os.getcwd(), parameters_filename)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as fd:
+        return json.load(fd)
+
+def fingerprint_parameters(parameters, segwit_utxo=None):
+    """
+    Make a hex digest that identifies the public parts of the vault parameters,
+    and optionally the coin being put into the vault. Private keys are never
+    part of the fingerprint.
+    """
+    public_parameters = {}
+    for (some_name, some_value) in parameters.items():
+        if type(some_value) == dict and "public_key" in some_value.keys():
+            some_value = b2x(some_value["public_key"])
+        elif isinstance(some_value, bytes):
+            some_value = b2x(some_value)
+        public_parameters[some_name] = some_value
+
+    if segwit_utxo != None:
+        public_parameters["segwit_utxo"] = {
+            "txid": b2lx(segwit_utxo.txid),
+            "vout": segwit_utxo.vout,
+            "amount": segwit_utxo.amount,
+        }
+
+        # The rest of the user's coins, for vaults funded by several coins.
+        other_coins = [some_utxo for some_utxo in segwit_utxo.transaction.output_utxos if some_utxo != segwit_utxo]
+        if len(other_coins) > 0:
+            public_parameters["other_user_coins"] = [
+                {"txid": b2lx(some_utxo.txid), "vout": some_utxo.vout, "amount": some_utxo.amount}
+                for some_utxo in other_coins
+            ]
+
+    payload = json.dumps(public_parameters, sort_keys=True, default=str)
+    return b2x(sha256(bytes(payload, "utf-8")))
+
+def fingerprint_plan(parameters, amount):
+    """
+    Make a hex digest that identifies the shape of a planned transaction tree
+    and its OP_CHECKTEMPLATEVERIFY scripts: the public vault parameters and the
+    amount going into the vault, but not the coin itself.
+    """
+    shape_parameters = dict(parameters)
+    shape_parameters.pop("planning_processes", None)
+    shape_parameters["vault_amount"] = amount
+    shape_parameters["plan_cache_format_version"] = PLAN_CACHE_FORMAT_VERSION
+    return fingerprint_parameters(shape_parameters)
+
+class PlanCache(object):
+    """
+    An on-disk cache of the baked OP_CHECKTEMPLATEVERIFY scripts of a planned
+    transaction tree, with one file per fingerprint (see fingerprint_plan).
+    Internal ids are derived from the position in the tree, so a vault with
+    the same fingerprint has the same ids, and the scripts can be looked up
+    by internal id. See bip119_ctv.load_baked_scripts.
+
+    scripts maps a UTXO's internal id to [script hex, number of template
+    hashes], or None for UTXOs that don't have an OP_CHECKTEMPLATEVERIFY
+    script. stubs maps the internal id of a UTXO with a re-vault stub to the
+    stub's template hashes.
+    """
+
+    def __init__(self, fingerprint, directory=None):
+        if directory == None:
+            directory = os.environ.get("VAULT_PLAN_CACHE_DIR", PLAN_CACHE_DIRECTORY)
+        self.fingerprint = fingerprint
+        self.path = os.path.join(directory, "{}.json".format(fingerprint))
+
+        self.scripts = {}
+        self.stubs = {}
+
+        if os.path.exists(self.path):
+            self._read_existing()
+
+    def _read_existing(self):
+        """
+        Read a previously saved cache. A broken cache file is ignored, and it
+        gets replaced the next time the cache is saved.
+        """
+        try:
+            with open(self.path, "r") as fd:
+                data = json.load(fd)
+        except ValueError:
+            logger.warning("Ignoring broken plan cache {}".format(self.path))
+            return
+
+        if data.get("fingerprint", None) != self.fingerprint:
+            logger.warning("Ignoring plan cache {} with the wrong fingerprint".format(self.path))
+            return
+
+        self.scripts = data["scripts"]
+        self.stubs = data["stubs"]
+
+    @property
+    def is_empty(self):
+        return len(self.scripts) == 0 and len(self.stubs) == 0
+
+    def save(self):
+        """
+        Write the cache. The file is replaced in one step, so that other
+        processes never read a partially written cache.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        data = {
+            "fingerprint": self.fingerprint,
+            "scripts": self.scripts,
+            "stubs": self.stubs,
+        }
+
+        temporary_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(temporary_path, "w") as fd:
+            json.dump(data, fd)
+        os.replace(temporary_path, self.path)
+        logger.info("Wrote plan cache {}".format(self.path))
+
+class TransactionJournal(object):
+    """
+    An append-only journal of signed transactions. Each line is a json record.
+    The first record describes the planned transaction tree (the internal ids
+    of every planned object, by rank), and every subsequent record is a signed
+    transaction. A restarted signing run can re-plan the same tree, adopt the
+    journaled internal ids, and only sign whatever is missing from the journal.
+
+    Ranks are positions in the sorted (by id) lists of UTXOs and transactions,
+    which are stable across runs because planning is deterministic.
+
+    The journal is for resuming, it is not a substitute for the tree in
+    memory: the signing run still holds every planned and signed
+    transaction.
+    """
+
+    def __init__(self, path=None, fingerprint=None, fsync_interval=TRANSACTION_JOURNAL_FSYNC_INTERVAL):
+        if path == None:
+            path = os.path.join(os.getcwd(), TRANSACTION_JOURNAL_FILENAME)
+        self.path = path
+        self.fingerprint = fingerprint
+        self.fsync_interval = fsync_interval
+
+        self.plan = None
+        self.checkpoints = {}
+        self._unsynced = 0
+        self._fd = None
+
+        if os.path.exists(self.path):
+            self._read_existing()
+
+        self._fd = open(self.path, "a")
+
+    @property
+    def resuming(self):
+        """
+        Whether this journal was left behind by a previous (interrupted) run.
+        """
+        return self.plan != None
+
+    def _read_existing(self):
+        """
+        Read the records from a previous run. A partially written last line
+        (from a crash mid-write) is discarded and truncated away.
+        """
+        good_offset = 0
+        with open(self.path, "rb") as fd:
+            for line in fd:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+
+                if record["type"] == "plan":
+                    if self.fingerprint != None and record["fingerprint"] != self.fingerprint:
+                        raise VaultException("Journal {} was made with different parameters. Remove it to start over.".format(self.path))
+                    self.plan = record
+                elif record["type"] == "transaction":
+                    self.checkpoints[record["rank"]] = record["data"]
+
+                good_offset += len(line)
+
+        if good_offset != os.path.getsize(self.path):
+            logger.warning("Discarding a partially written journal record in {}".format(self.path))
+            with open(self.path, "r+b") as fd:
+                fd.truncate(good_offset)
+
+        if self.plan == None and len(self.checkpoints) > 0:
+            raise VaultException("Journal {} is missing its plan record".format(self.path))
+
+    def _write(self, record):
+        self._fd.write(json.dumps(record))
+        self._fd.write("\n")
+        self._fd.flush()
+
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """
+        Force journal records onto the disk.
+        """
+        os.fsync(self._fd.fileno())
+        self._unsynced = 0
+
+    def begin(self, planned_utxos, planned_transactions):
+        """
+        Record the internal ids of a freshly planned tree, or- when resuming-
+        copy the internal ids from the journal onto the re-planned tree so that
+        the journaled transactions still reference the right objects.
+
+        Both lists must be sorted by id.
+        """
+        if not self.resuming:
+            self.plan = {
+                "type": "plan",
+                "fingerprint": self.fingerprint,
+                "utxos": [str(some_utxo.internal_id) for some_utxo in planned_utxos],
+                "transactions": [str(some_transaction.internal_id) for some_transaction in planned_transactions],
+                "inputs": [[str(some_input.internal_id) for some_input in some_transaction.inputs] for some_transaction in planned_transactions],
+            }
+            self._write(self.plan)
+            self.sync()
+            return
+
+        if len(self.plan["utxos"]) != len(planned_utxos) or len(self.plan["transactions"]) != len(planned_transactions):
+            raise VaultException("Journal {} does not match the planned transaction tree".format(self.path))
+
+        for (some_utxo, internal_id) in zip(planned_utxos, self.plan["utxos"]):
+            some_utxo.internal_id = internal_id
+
+        for (rank, some_transaction) in enumerate(planned_transactions):
+            some_transaction.internal_id = self.plan["transactions"][rank]
+            for (some_input, internal_id) in zip(some_transaction.inputs, self.plan["inputs"][rank]):
+                some_input.internal_id = internal_id
+
+        logger.info("Resuming from journal {} with {} signed transactions".format(self.path, len(self.checkpoints)))
+
+    def get_checkpoint(self, rank):
+        """
+        Get the journaled dictionary for the transaction at some rank, if the
+        transaction was already signed in a previous run.
+        """
+        return self.checkpoints.get(rank, None)
+
+    def append(self, rank, planned_transaction):
+        """
+        Append a signed transaction to the journal.
+        """
+        self._write({"type": "transaction", "rank": rank, "data": planned_transaction.to_dict()})
+
+    def iter_transaction_dicts(self):
+        """
+        Read back the journaled transactions one at a time, in rank order.
+        The signed tree is still in memory (see TransactionJournal), this
+        only avoids loading every journaled dictionary at once.
+        """
+        self._fd.flush()
+
+        # Ranks are journaled in increasing order, except that a resumed run
+        # never re-journals a rank, so a plain scan already yields each rank
+        # exactly once and in order.
+        last_rank = -1
+        with open(self.path, "r") as fd:
+            for line in fd:
+                record = json.loads(line)
+                if record["type"] != "transaction":
+                    continue
+                if record["rank"] <= last_rank:
+                    raise VaultException("Journal {} is out of order at rank {}".format(self.path, record["rank"]))
+                last_rank = record["rank"]
+                yield record["data"]
+
+    def close(self, remove=False):
+        """
+        Close the journal, and optionally delete it (once a transaction store
+        has been written, the journal is no longer needed).
+        """
+        if self._fd != None:
+            self.sync()
+            self._fd.close()
+            self._fd = None
+
+        if remove:
+            os.remove(self.path)
+
+def save_from_journal(journal, filename=TRANSACTION_STORE_FILENAME):
+    """
+    Write the transaction store by streaming transactions out of a journal,
+    instead of building the whole list of transaction dictionaries in memory.
+    The output is the same json document that save() writes.
+    """
+    with open(os.path.join(os.getcwd(), filename), "w") as fd:
+        fd.write("[")
+        for (idx, transaction_data) in enumerate(journal.iter_transaction_dicts()):
+            if idx > 0:
+                fd.write(",")
+            fd.write("\n    ")
+            transaction_json = json.dumps(transaction_data, sort_keys=False, indent=4, separators=(',', ': '))
+            fd.write(transaction_json.replace("\n", "\n    "))
+        fd.write("\n]")
+    logger.info(f"Wrote to {filename}")
@@ -9,11 +9,17 @@ entrypoint: setup_vault
 """
 
 import os
+import math
+import time
+import heapq
+from collections import deque
 
-from bitcoin.core import COIN
+from bitcoin.core import COIN, CTxOut
 
 from vaults.config import TEXT_RENDERING_FILENAME
 from vaults.loggingconfig import logger
+from vaults.exceptions import VaultException
+from vaults.timelocks import get_timelock_schedule, get_script_timelocks
 
 from vaults.models.script_templates import (
     ScriptTemplate,
@@ -30,8 +36,14 @@ from vaults.models.plans import (
     PlannedInput,
     PlannedTransaction,
     InitialTransaction,
+    RevaultStub,
+    iter_text_lines,
 )
 
+from vaults.models.columnar import ColumnarTree
+
+from vaults.context import PlanContext, uses_plan_context
+
 def make_burn_transaction(incoming_utxo, parameters=None):
     """
     Extend the planned transaction tree by making a "burn" transaction that
@@ -61,7 +73,7 @@ def make_burn_transaction(incoming_utxo, parameters=None):
         amount=burn_utxo_amount,
     )
     burn_transaction.output_utxos.append(burn_utxo)
-    incoming_utxo.child_transactions.append(burn_transaction)
+    incoming_utxo.add_child_transaction(burn_transaction)
     return burn_transaction
 
 def make_push_to_cold_storage_transaction(incoming_utxo, parameters=None):
@@ -103,37 +115,43 @@ def make_push_to_cold_storage_transaction(incoming_utxo, parameters=None):
     # Make a possible transaction: burn/donate the cold storage UTXO.
     burn_transaction = make_burn_transaction(cold_storage_utxo, parameters=parameters)
 
-    incoming_utxo.child_transactions.append(push_transaction)
+    incoming_utxo.add_child_transaction(push_transaction)
     return push_transaction
 
 def make_sweep_to_cold_storage_transaction(incoming_utxos, parameters=None):
     """
     Create a transaction that sweeps some input coins into the cold storage layer.
+
+    All of the swept coins go into a single cold storage UTXO (with a single
+    burn transaction), instead of one cold storage UTXO and one burn
+    transaction per input. Each cold storage UTXO would have the same script
+    anyway, and this keeps the number of planned UTXOs linear in the number of
+    inputs across all the sweeps of a sharding transaction.
     """
 
     # name was: "Sweep UTXOs to cold storage wallet"
     # phase 2 name was: Sharded UTXO sweep transaction
     push_transaction = PlannedTransaction(name="Sharded UTXO sweep transaction")
 
+    amount = 0
     for incoming_utxo in incoming_utxos:
-        # Inputs
         planned_input = PlannedInput(
             utxo=incoming_utxo,
             witness_template_selection="presigned",
             transaction=push_transaction,
         )
         push_transaction.inputs.append(planned_input)
+        incoming_utxo.add_child_transaction(push_transaction)
+        amount += incoming_utxo.amount
 
-        # Outputs
-        amount = incoming_utxo.amount
-        cold_storage_utxo = PlannedUTXO(
-            name="cold storage UTXO",
-            transaction=push_transaction,
-            script_template=ColdStorageScriptTemplate,
-            amount=amount,
-        )
-        push_transaction.output_utxos.append(cold_storage_utxo)
-        burn_transaction = make_burn_transaction(cold_storage_utxo, parameters=parameters)
+    cold_storage_utxo = PlannedUTXO(
+        name="cold storage UTXO",
+        transaction=push_transaction,
+        script_template=ColdStorageScriptTemplate,
+        amount=amount,
+    )
+    push_transaction.output_utxos.append(cold_storage_utxo)
+    burn_transaction = make_burn_transaction(cold_storage_utxo, parameters=parameters)
 
     return push_transaction
 
@@ -148,14 +166,36 @@ def make_telescoping_subsets(some_set):
     the first UTXO is spent or not spent, the first and second UTXO are spent
     or not spent, etc. Ultimately the sweep transactions are not enabled by
     default in this prototype, because they combinatorially explode the planned
-    transaction tree size.
+    transaction tree size. (See make_sweep_transactions.)
     """
     item_sets = []
     for x in range(0, len(some_set)-1):
         item_sets.append(some_set[x:len(some_set)])
     return item_sets
 
-def make_sharding_transaction(per_shard_amount=1 * COIN, num_shards=100, first_shard_extra_amount=0, incoming_utxo=None, original_num_shards=None, make_sweeps=False, parameters=None):
+def make_sweep_transactions(sharding_transaction, parameters=None, max_count=None):
+    """
+    Make the sweep transactions for the shards of a sharding transaction: one
+    for each telescoping subset of the shards (all of them, all but the
+    first, and so on). The shards are spent in order, so the shards that are
+    left at any time are one of these subsets, and can be pushed to cold
+    storage with a single transaction instead of one transaction per shard.
+
+    At most max_count sweep transactions are made, starting with the largest
+    subset. Returns the number of sweep transactions that were made.
+    """
+    shard_utxos = [some_utxo for some_utxo in sharding_transaction.output_utxos if some_utxo.script_template == ShardScriptTemplate]
+
+    sweep_count = 0
+    for start in range(0, len(shard_utxos) - 1):
+        if max_count != None and sweep_count >= max_count:
+            break
+        make_sweep_to_cold_storage_transaction(shard_utxos[start:], parameters=parameters)
+        sweep_count += 1
+
+    return sweep_count
+
+def make_sharding_transaction(per_shard_amount=1 * COIN, num_shards=100, first_shard_extra_amount=0, incoming_utxo=None, original_num_shards=None, make_sweeps=False, parameters=None, shard_offset=0):
     """
     Make a new sharding transaction. A sharding transaction is one that takes
     some coin and splits the coin into many UTXOs each with a fraction of the
@@ -163,15 +203,27 @@ def make_sharding_transaction(per_shard_amount=1 * COIN, num_shards=100, first_s
     increasing relative timelock so that each UTXO becomes spendable
     one-at-a-time and a watchtower can later take some action if more than one
     of these UTXOs is spendable at any given time.
+
+    When the timelock schedule has a stage size (timelock_stage_size), only
+    that many shards are made, plus a "next stage" UTXO that unlocks when the
+    last shard of this stage does. The next stage UTXO is spent by another
+    sharding transaction for the remaining shards. shard_offset is the number
+    of shards in the previous stages.
     """
 
-    if num_shards < original_num_shards:
-        partial ="(partial) "
-    elif num_shards == original_num_shards:
-        partial = ""
+    schedule = get_timelock_schedule(parameters)
+    stage_size = schedule.stage_size
+    is_staged = stage_size != None and num_shards > stage_size
 
-    sharding_transaction = PlannedTransaction(name=f"Vault {partial}stipend start transaction.")
-    incoming_utxo.child_transactions.append(sharding_transaction)
+    if shard_offset > 0:
+        sharding_transaction_name = "Vault stipend next stage transaction."
+    elif num_shards < original_num_shards:
+        sharding_transaction_name = "Vault (partial) stipend start transaction."
+    else:
+        sharding_transaction_name = "Vault stipend start transaction."
+
+    sharding_transaction = PlannedTransaction(name=sharding_transaction_name)
+    incoming_utxo.add_child_transaction(sharding_transaction)
 
     planned_input = PlannedInput(
         utxo=incoming_utxo,
@@ -180,15 +232,19 @@ def make_sharding_transaction(per_shard_amount=1 * COIN, num_shards=100, first_s
     )
     sharding_transaction.inputs.append(planned_input)
 
+    stage_num_shards = num_shards
+    if is_staged:
+        stage_num_shards = stage_size
+
     shard_utxos = []
-    for shard_id in range(0, num_shards):
+    for shard_id in range(0, stage_num_shards):
         amount = per_shard_amount
         if shard_id == 0 and first_shard_extra_amount != None:
             amount += first_shard_extra_amount
 
         sharded_utxo_name = "shard fragment UTXO {shard_id}/{num_shards}".format(
-            shard_id = shard_id + 1,
-            num_shards=num_shards,
+            shard_id = shard_offset + shard_id + 1,
+            num_shards=shard_offset + num_shards,
         )
 
         # Note: can't re-vault from this point. Must pass through the cold
@@ -214,20 +270,40 @@ def make_sharding_transaction(per_shard_amount=1 * COIN, num_shards=100, first_s
     # into cold storage. By aggregating it into these sweep transactions, they
     # don't need to do that anymore.
     #
-    # Note: this makes the transaction tree planner pretty slow. It's
-    # unreasonably slow. By comparison, having 100 separate transactions that
-    # need to be CPFPed would be easier to deal with.
+    # Each sweep has a single cold storage output, so this adds a linear
+    # number of transactions per sharding transaction. See also
+    # make_sweeps_paths for adding sweeps to the whole tree under a budget.
     if make_sweeps == True:
-        subsets = make_telescoping_subsets(shard_utxos)
-        # Iteration over all the possible subsets substantially and negatively
-        # impacts the runtime of the program.
-        #sweep_transactions = []
-        for some_subset in subsets:
-            sweep_transaction = make_sweep_to_cold_storage_transaction(some_subset, parameters=parameters)
-            #sweep_transactions.append(sweep_transaction)
+        make_sweep_transactions(sharding_transaction, parameters=parameters)
+
+    if is_staged:
+        # The timelock multiplier of the next stage UTXO is the same as what
+        # the next shard would have had, so the overall schedule is the same
+        # as without staging. The next stage's shard timelocks are relative to
+        # the confirmation of the next stage transaction.
+        remaining_num_shards = num_shards - stage_size
+        next_stage_utxo = PlannedUTXO(
+            name="next stage UTXO",
+            transaction=sharding_transaction,
+            script_template=BasicPresignedScriptTemplate,
+            amount=remaining_num_shards * per_shard_amount,
+            timelock_multiplier=stage_size,
+        )
+        next_stage_utxo.timelock_schedule = schedule
+        sharding_transaction.output_utxos.append(next_stage_utxo)
 
-            for utxo in some_subset:
-                utxo.child_transactions.append(sweep_transaction)
+        make_push_to_cold_storage_transaction(next_stage_utxo, parameters=parameters)
+
+        make_sharding_transaction(
+            per_shard_amount=per_shard_amount,
+            num_shards=remaining_num_shards,
+            first_shard_extra_amount=None,
+            incoming_utxo=next_stage_utxo,
+            original_num_shards=original_num_shards,
+            make_sweeps=make_sweeps,
+            parameters=parameters,
+            shard_offset=shard_offset + stage_size,
+        )
 
     return sharding_transaction
 
@@ -236,13 +312,86 @@ def make_sharding_transaction(per_shard_amount=1 * COIN, num_shards=100, first_s
 # So if the user knows they only want a small amount, they use the one-time
 # spend. If they know they want more, then they can use the stipend (or migrate
 # out of the vault by first broadcasting the stipend setup transaction).
-def make_one_shard_possible_spend(incoming_utxo, per_shard_amount, num_shards, original_num_shards=None, first_shard_extra_amount=None, parameters=None):
+def make_one_shard_possible_spend(incoming_utxo, per_shard_amount, num_shards, original_num_shards=None, first_shard_extra_amount=None, parameters=None, depth=0):
     """
     Make a possible transaction for the vault UTXO that has two possibilities
     hanging off of it: one to spend a single sharded UTXO (either to the cold
     storage layer, or to the hot wallet), and then a second vault UTXO that has
     the remaining funds minus that one sharded UTXO, and then the typical vault
     possibilities hanging off of that.
+
+    Each re-vault UTXO gets the same possibilities again, with one shard less.
+    This is a loop rather than recursion so that vaults with hundreds of
+    shards don't hit the recursion limit.
+
+    With parameters["lazy_revault_depth"], only that many re-vault UTXOs are
+    planned. The next re-vault UTXO gets a RevaultStub instead of its
+    sharding transaction and re-vault path, see expand_revault_stub.
+
+    Returns a list of (depth, vault UTXO, num_shards, original_num_shards,
+    first_shard_extra_amount) for each vault UTXO along the way, which is where
+    make_spend_k_shards_paths can add more re-vault paths.
+    """
+    lazy_revault_depth = None
+    if parameters != None:
+        lazy_revault_depth = parameters.get("lazy_revault_depth", None)
+
+    vault_utxos = []
+    revault_depth = 0
+    while incoming_utxo != None:
+        vault_utxos.append((depth, incoming_utxo, num_shards, original_num_shards, first_shard_extra_amount))
+        depth += 1
+        revault_depth += 1
+
+        lazy = lazy_revault_depth != None and revault_depth > lazy_revault_depth
+
+        incoming_utxo = make_one_shard_spend_transaction(
+            incoming_utxo=incoming_utxo,
+            per_shard_amount=per_shard_amount,
+            num_shards=num_shards,
+            original_num_shards=original_num_shards,
+            first_shard_extra_amount=first_shard_extra_amount,
+            parameters=parameters,
+            lazy=lazy,
+            depth=depth,
+        )
+        num_shards -= 1
+        first_shard_extra_amount = None
+
+        if lazy:
+            break
+
+    return vault_utxos
+
+def make_one_shard_spend_transaction(incoming_utxo, per_shard_amount, num_shards, original_num_shards=None, first_shard_extra_amount=None, parameters=None, lazy=False, depth=0):
+    """
+    Make one level of make_one_shard_possible_spend: the spend-one-shard
+    transaction, and the sharding transaction and push-to-cold-storage
+    transaction for the re-vault UTXO. Returns the re-vault UTXO, or None
+    when there was only one shard left.
+    """
+    return make_spend_shards_transaction(
+        incoming_utxo=incoming_utxo,
+        per_shard_amount=per_shard_amount,
+        num_shards=num_shards,
+        spend_num_shards=1,
+        original_num_shards=original_num_shards,
+        first_shard_extra_amount=first_shard_extra_amount,
+        parameters=parameters,
+        lazy=lazy,
+        depth=depth,
+    )
+
+def make_spend_shards_transaction(incoming_utxo, per_shard_amount, num_shards, spend_num_shards=1, original_num_shards=None, first_shard_extra_amount=None, parameters=None, lazy=False, depth=0):
+    """
+    Make a transaction that spends spend_num_shards shards out of the vault
+    UTXO (as a single UTXO for the hot wallet, or to push to cold storage),
+    and re-vaults the remaining shards. The re-vault UTXO gets a sharding
+    transaction and a push-to-cold-storage transaction, but no re-vault paths
+    of its own. Returns the re-vault UTXO, or None when no shards are left.
+
+    When lazy is set, the re-vault UTXO gets a RevaultStub instead of the
+    sharding transaction. depth is the depth of the re-vault UTXO.
     """
     # Spend initial vault UTXO into two UTXOs- one for the hot wallet/push to
     # cold storage, one for re-vaulting the remaining amount- and then all the
@@ -253,10 +402,17 @@ def make_one_shard_possible_spend(incoming_utxo, per_shard_amount, num_shards, o
     # This path is another route of possible transactions, as a
     # possible-sibling to the vault stipend initiation transaction.
 
+    if spend_num_shards < 1 or spend_num_shards > num_shards:
+        raise VaultException("Can't spend {} shards out of {}".format(spend_num_shards, num_shards))
+
     # phase 2 name: There was no equivalent name for this transaction discussed
     # in phase 2. This transaction was added in phase 3.
-    vault_spend_one_shard_transaction = PlannedTransaction(name="Vault transaction: spend one shard, re-vault the remaining shards")
-    incoming_utxo.child_transactions.append(vault_spend_one_shard_transaction)
+    if spend_num_shards == 1:
+        transaction_name = "Vault transaction: spend one shard, re-vault the remaining shards"
+    else:
+        transaction_name = "Vault transaction: spend {} shards, re-vault the remaining shards".format(spend_num_shards)
+    vault_spend_one_shard_transaction = PlannedTransaction(name=transaction_name)
+    incoming_utxo.add_child_transaction(vault_spend_one_shard_transaction)
 
     planned_input = PlannedInput(
         utxo=incoming_utxo,
@@ -267,13 +423,17 @@ def make_one_shard_possible_spend(incoming_utxo, per_shard_amount, num_shards, o
 
     # Next, add two UTXOs to vault_spend_one_shard transaction.
 
-    amount = per_shard_amount
+    amount = spend_num_shards * per_shard_amount
     if first_shard_extra_amount != None:
         amount += first_shard_extra_amount
 
+    exiting_utxo_name = "shard fragment UTXO"
+    if spend_num_shards > 1:
+        exiting_utxo_name = "shard fragment UTXO ({} shards)".format(spend_num_shards)
+
     # phase 2 name: k% sharded UTXO
     exiting_utxo = PlannedUTXO(
-        name="shard fragment UTXO",
+        name=exiting_utxo_name,
         transaction=vault_spend_one_shard_transaction,
         script_template=ShardScriptTemplate,
         amount=amount,
@@ -287,11 +447,11 @@ def make_one_shard_possible_spend(incoming_utxo, per_shard_amount, num_shards, o
     # a pre-signed transaction. It can be created at a later time, by the hot
     # wallet keys.
 
-    if num_shards == 1:
-        return
+    remaining_num_shards = num_shards - spend_num_shards
+    if remaining_num_shards == 0:
+        return None
     else:
-        # TODO: should this be num_shards or (num_shards - 1) ?
-        remaining_amount = (num_shards - 1) * per_shard_amount
+        remaining_amount = remaining_num_shards * per_shard_amount
 
         # Second UTXO attached to vault_spend_one_shard_transaction.
         # phase 2 name: funding/commitment UTXO, kind of... But this wasn't
@@ -307,11 +467,23 @@ def make_one_shard_possible_spend(incoming_utxo, per_shard_amount, num_shards, o
         # The vault UTXO can also be spent directly to cold storage.
         make_push_to_cold_storage_transaction(revault_utxo, parameters=parameters)
 
+        if lazy:
+            # The rest of the re-vault UTXO's child transactions are planned
+            # when they are needed.
+            revault_utxo.revault_stub = RevaultStub(
+                per_shard_amount=per_shard_amount,
+                num_shards=remaining_num_shards,
+                original_num_shards=original_num_shards,
+                depth=depth,
+                parameters=parameters,
+            )
+            return revault_utxo
+
         # The re-vault UTXO can be sharded into "100" pieces (but not really 100..
         # it should be 100 minus the depth).
         make_sharding_transaction(
             per_shard_amount=per_shard_amount,
-            num_shards=num_shards - 1,
+            num_shards=remaining_num_shards,
             incoming_utxo=revault_utxo,
             original_num_shards=original_num_shards,
             first_shard_extra_amount=None,
@@ -319,17 +491,426 @@ def make_one_shard_possible_spend(incoming_utxo, per_shard_amount, num_shards, o
         )
 
         # The re-vault UTXO can also be spent using the one-shard possible spend
-        # method.
-        make_one_shard_possible_spend(
-            incoming_utxo=revault_utxo,
+        # method (see make_one_shard_possible_spend).
+        return revault_utxo
+
+def expand_revault_stub(incoming_utxo, parameters=None):
+    """
+    Plan the child transactions of a re-vault UTXO that has a RevaultStub
+    (see make_one_shard_possible_spend): the sharding transaction for the
+    remaining shards, and the transaction that spends one shard and re-vaults
+    the rest. The new re-vault UTXO gets the next stub, so each call plans one
+    more level of the re-vault chain.
+
+    The subtree only depends on the stub and the parameters, so planning it
+    again always gives the same transactions. The stub's parameters are used
+    when no parameters are given. Returns the new child transactions.
+    """
+    stub = incoming_utxo.revault_stub
+    if stub == None:
+        raise VaultException("UTXO {} has no re-vault stub".format(incoming_utxo.name))
+
+    if parameters == None:
+        parameters = stub.parameters
+
+    num_child_transactions = len(incoming_utxo.child_transactions)
+    incoming_utxo.revault_stub = None
+
+    make_sharding_transaction(
+        per_shard_amount=stub.per_shard_amount,
+        num_shards=stub.num_shards,
+        incoming_utxo=incoming_utxo,
+        original_num_shards=stub.original_num_shards,
+        first_shard_extra_amount=None,
+        parameters=parameters,
+    )
+
+    revault_utxo = make_one_shard_spend_transaction(
+        incoming_utxo=incoming_utxo,
+        per_shard_amount=stub.per_shard_amount,
+        num_shards=stub.num_shards,
+        original_num_shards=stub.original_num_shards,
+        parameters=parameters,
+        lazy=True,
+        depth=stub.depth + 1,
+    )
+
+    # The template hashes of the rest of the chain are already known.
+    if revault_utxo != None and stub.template_hashes != None:
+        revault_utxo.revault_stub.template_hashes = stub.template_hashes[1:]
+
+    apply_timelock_schedule(incoming_utxo, parameters)
+
+    return incoming_utxo.child_transactions[num_child_transactions:]
+
+def add_node_counts(*node_counts):
+    """
+    Add up (utxos, transactions) pairs, like the ones from
+    PlannedUTXO.count_nodes.
+    """
+    return (sum([node_count[0] for node_count in node_counts]), sum([node_count[1] for node_count in node_counts]))
+
+def multiply_node_counts(node_count, factor):
+    return (node_count[0] * factor, node_count[1] * factor)
+
+def count_push_to_cold_storage_nodes(parameters=None):
+    """
+    The (utxos, transactions) made by make_push_to_cold_storage_transaction:
+    the push transaction, the cold storage UTXO and maybe a burn transaction.
+    Every planned transaction also has a CPFP hook UTXO.
+    """
+    if parameters != None and parameters.get("enable_burn_transactions", False) == True:
+        return (4, 2)
+    return (2, 1)
+
+def count_sweep_nodes(num_shards, parameters=None):
+    """
+    The (utxos, transactions) made by make_sweep_transactions for a sharding
+    transaction with num_shards shards: one sweep (with a single cold storage
+    UTXO, like a push-to-cold-storage transaction) per telescoping subset of
+    the shards.
+    """
+    return multiply_node_counts(count_push_to_cold_storage_nodes(parameters), max(num_shards - 1, 0))
+
+def count_sharding_nodes(num_shards, parameters=None, make_sweeps=False):
+    """
+    The (utxos, transactions) made by make_sharding_transaction, including the
+    later stages when the timelock schedule is staged.
+    """
+    stage_size = get_timelock_schedule(parameters).stage_size
+    # a shard (or next stage) UTXO and its push-to-cold-storage transaction
+    shard_node_count = add_node_counts((1, 0), count_push_to_cold_storage_nodes(parameters))
+
+    node_count = (0, 0)
+    while True:
+        # the sharding transaction and its CPFP hook
+        node_count = add_node_counts(node_count, (1, 1))
+
+        if stage_size == None or num_shards <= stage_size:
+            node_count = add_node_counts(node_count, multiply_node_counts(shard_node_count, num_shards))
+            if make_sweeps == True:
+                node_count = add_node_counts(node_count, count_sweep_nodes(num_shards, parameters=parameters))
+            return node_count
+
+        # the stage's shards, and the next stage UTXO
+        node_count = add_node_counts(node_count, multiply_node_counts(shard_node_count, stage_size + 1))
+        if make_sweeps == True:
+            node_count = add_node_counts(node_count, count_sweep_nodes(stage_size, parameters=parameters))
+        num_shards -= stage_size
+
+def count_spend_shards_nodes(num_shards, spend_num_shards=1, parameters=None, make_sweeps=False, lazy=False):
+    """
+    The (utxos, transactions) made by make_spend_shards_transaction: the spend
+    transaction, the exiting UTXO, and the re-vault UTXO with its sharding
+    transaction (unless the re-vault UTXO gets a stub).
+    """
+    push_node_count = count_push_to_cold_storage_nodes(parameters)
+
+    # the transaction, its CPFP hook, and the exiting UTXO
+    node_count = add_node_counts((2, 1), push_node_count)
+
+    remaining_num_shards = num_shards - spend_num_shards
+    if remaining_num_shards > 0:
+        node_count = add_node_counts(node_count, (1, 0), push_node_count)
+        if not lazy:
+            node_count = add_node_counts(node_count, count_sharding_nodes(remaining_num_shards, parameters=parameters, make_sweeps=make_sweeps))
+
+    return node_count
+
+def count_eager_vault_utxos(num_shards, parameters=None):
+    """
+    The number of vault UTXOs on a re-vault path that
+    make_one_shard_possible_spend plans: the first one, and the re-vault UTXOs
+    that don't get a stub (see parameters["lazy_revault_depth"]).
+    """
+    lazy_revault_depth = None
+    if parameters != None:
+        lazy_revault_depth = parameters.get("lazy_revault_depth", None)
+    if lazy_revault_depth == None:
+        return num_shards
+    return min(num_shards, lazy_revault_depth + 1)
+
+def count_one_shard_possible_spend_nodes(num_shards, parameters=None, make_sweeps=False):
+    """
+    The (utxos, transactions) made by make_one_shard_possible_spend: one
+    spend-one-shard transaction for each number of remaining shards, down to
+    the first re-vault stub.
+    """
+    num_eager_vault_utxos = count_eager_vault_utxos(num_shards, parameters=parameters)
+
+    node_count = (0, 0)
+    for idx in range(num_eager_vault_utxos):
+        lazy = idx == num_eager_vault_utxos - 1 and num_eager_vault_utxos < num_shards
+        node_count = add_node_counts(node_count, count_spend_shards_nodes(num_shards - idx, parameters=parameters, make_sweeps=make_sweeps, lazy=lazy))
+    return node_count
+
+def count_push_to_cold_storage_transactions(parameters=None):
+    """
+    The number of transactions made by make_push_to_cold_storage_transaction.
+    """
+    return count_push_to_cold_storage_nodes(parameters)[1]
+
+def count_sweep_transactions(num_shards, parameters=None):
+    """
+    The number of transactions made by make_sweep_transactions for a sharding
+    transaction with num_shards shards: each sweep and its burn transaction.
+    """
+    return count_sweep_nodes(num_shards, parameters=parameters)[1]
+
+def count_sharding_transactions(num_shards, parameters=None, make_sweeps=False):
+    """
+    The number of transactions made by make_sharding_transaction, including
+    the later stages when the timelock schedule is staged.
+    """
+    return count_sharding_nodes(num_shards, parameters=parameters, make_sweeps=make_sweeps)[1]
+
+def count_spend_shards_transactions(num_shards, spend_num_shards=1, parameters=None):
+    """
+    The number of transactions made by make_spend_shards_transaction.
+    """
+    return count_spend_shards_nodes(num_shards, spend_num_shards=spend_num_shards, parameters=parameters)[1]
+
+def count_one_shard_possible_spend_transactions(num_shards, parameters=None):
+    """
+    The number of transactions made by make_one_shard_possible_spend.
+    """
+    return count_one_shard_possible_spend_nodes(num_shards, parameters=parameters)[1]
+
+def make_spend_k_shards_paths(vault_utxos, per_shard_amount, planned_transaction_count, parameters=None):
+    """
+    Add "spend k shards, re-vault the rest" transactions to the vault UTXOs
+    (from make_one_shard_possible_spend), for each k in
+    parameters["spend_k_shards"]. This lets a large withdrawal happen in one
+    transaction instead of k sequential spend-one-shard transactions.
+
+    Without parameters["max_planned_transactions"], only the given vault UTXOs
+    get the extra paths, and the new re-vault UTXOs can only be sharded or
+    pushed to cold storage.
+
+    With a budget, branches are materialized greedily, shallowest vault UTXO
+    first, as long as the total number of planned transactions stays within
+    the budget. The re-vault UTXO of each new branch then becomes a candidate
+    for more spend paths (including spending one shard). Branches that don't
+    fit are skipped, but cheaper branches deeper in the tree are still tried.
+
+    planned_transaction_count is the number of transactions already in the
+    tree. Returns the new total.
+    """
+    spend_k_shards = sorted(set(parameters.get("spend_k_shards", None) or []))
+    budget = parameters.get("max_planned_transactions", None)
+
+    if budget != None and planned_transaction_count > budget:
+        raise VaultException("Planned transaction tree has {} transactions, over the budget of {}".format(planned_transaction_count, budget))
+
+    # (depth, sequence, vault utxo, num_shards, original_num_shards,
+    # first_shard_extra_amount, k values)
+    candidates = []
+    for (sequence, (depth, vault_utxo, num_shards, original_num_shards, first_shard_extra_amount)) in enumerate(vault_utxos):
+        candidates.append((depth, sequence, vault_utxo, num_shards, original_num_shards, first_shard_extra_amount, spend_k_shards))
+    heapq.heapify(candidates)
+    sequence = len(candidates)
+
+    skipped_count = 0
+    while len(candidates) > 0:
+        (depth, _, vault_utxo, num_shards, original_num_shards, first_shard_extra_amount, k_values) = heapq.heappop(candidates)
+
+        for spend_num_shards in k_values:
+            # Spending every shard at once is what the sharding transaction
+            # is for.
+            if spend_num_shards >= num_shards:
+                continue
+
+            cost = count_spend_shards_transactions(num_shards, spend_num_shards=spend_num_shards, parameters=parameters)
+            if budget != None and planned_transaction_count + cost > budget:
+                skipped_count += 1
+                continue
+
+            revault_utxo = make_spend_shards_transaction(
+                incoming_utxo=vault_utxo,
+                per_shard_amount=per_shard_amount,
+                num_shards=num_shards,
+                spend_num_shards=spend_num_shards,
+                original_num_shards=original_num_shards,
+                first_shard_extra_amount=first_shard_extra_amount,
+                parameters=parameters,
+            )
+            planned_transaction_count += cost
+
+            if budget != None and revault_utxo != None:
+                heapq.heappush(candidates, (depth + 1, sequence, revault_utxo, num_shards - spend_num_shards, original_num_shards, None, [1] + spend_k_shards))
+                sequence += 1
+
+    if skipped_count > 0:
+        logger.info("Skipped {} spend-k-shards paths to stay within the budget of {} transactions".format(skipped_count, budget))
+
+    return planned_transaction_count
+
+def make_sweeps_paths(initial_utxo, planned_transaction_count, parameters=None):
+    """
+    Add sweep transactions (see make_sweep_transactions) to the sharding
+    transactions in the tree, shallowest sharding transaction first.
+
+    The sweeps are limited by parameters["max_sweep_transactions"] (the number
+    of sweep and burn transactions to add), parameters["sweep_time_budget"]
+    (in seconds) and parameters["max_planned_transactions"] (the size of the
+    whole tree). Sharding transactions that don't fit in the budget get no
+    sweeps, or sweeps for only the largest subsets of their shards.
+
+    planned_transaction_count is the number of transactions already in the
+    tree. Returns the new total.
+    """
+    max_sweep_transactions = parameters.get("max_sweep_transactions", None)
+    time_budget = parameters.get("sweep_time_budget", None)
+    budget = parameters.get("max_planned_transactions", None)
+    push_count = count_push_to_cold_storage_transactions(parameters)
+
+    start_time = time.time()
+
+    # Find the sharding transactions, breadth-first.
+    sharding_transactions = []
+    queue = deque([initial_utxo])
+    while len(queue) > 0:
+        some_utxo = queue.popleft()
+        for child_transaction in some_utxo.child_transactions:
+            shard_count = len([child_utxo for child_utxo in child_transaction.output_utxos if child_utxo.script_template == ShardScriptTemplate])
+            if shard_count > 1:
+                sharding_transactions.append(child_transaction)
+            queue.extend(child_transaction.output_utxos)
+
+    sweep_transaction_count = 0
+    skipped_count = 0
+    for sharding_transaction in sharding_transactions:
+        max_count = None
+        if max_sweep_transactions != None:
+            max_count = (max_sweep_transactions - sweep_transaction_count) // push_count
+        if budget != None:
+            budget_count = (budget - planned_transaction_count) // push_count
+            max_count = budget_count if max_count == None else min(max_count, budget_count)
+        if time_budget != None and time.time() - start_time > time_budget:
+            max_count = 0
+
+        if max_count != None and max_count <= 0:
+            skipped_count += 1
+            continue
+
+        sweep_count = make_sweep_transactions(sharding_transaction, parameters=parameters, max_count=max_count)
+        sweep_transaction_count += sweep_count * push_count
+        planned_transaction_count += sweep_count * push_count
+
+    logger.info("Planned {} sweep transactions in {:.2f} seconds".format(sweep_transaction_count, time.time() - start_time))
+    if skipped_count > 0:
+        logger.info("Skipped sweeps for {} sharding transactions to stay within the budget".format(skipped_count))
+
+    return planned_transaction_count
+
+def get_shard_group_size(num_shards, parameters=None):
+    """
+    The maximum number of shards (or of child groups) per group, for the
+    hierarchical sharding mode. Defaults to log2 of the number of shards, so
+    that the tree size grows like O(n log n).
+    """
+    group_size = None
+    if parameters != None:
+        group_size = parameters.get("shard_group_size", None)
+    if group_size == None:
+        group_size = math.ceil(math.log2(max(num_shards, 2)))
+    return max(group_size, 2)
+
+def make_hierarchical_sharding(incoming_utxo, per_shard_amount, num_shards, first_shard_extra_amount=None, shard_offset=0, parameters=None, depth=0):
+    """
+    Hierarchical (multi-level) sharding. The vault UTXO is split into groups,
+    each group is split into smaller groups, and so on, until a group has at
+    most shard_group_size shards. Only those smallest groups get the usual
+    sharding transaction and the one-shard spend (re-vault) path, so the
+    quadratic part of the tree is limited to the size of a group.
+
+    Each group UTXO is timelocked until its first shard would become
+    spendable, so the schedule for the shards is the same as without groups.
+    Each group UTXO can also be pushed to cold storage.
+
+    Returns the vault UTXOs of the groups' re-vault paths, like
+    make_one_shard_possible_spend does.
+    """
+    group_size = get_shard_group_size(num_shards, parameters=parameters)
+    schedule = get_timelock_schedule(parameters)
+
+    if num_shards <= group_size:
+        # The group UTXO holds all of the group's shards, so the group's re-vault
+        # chain starts from the group's full shard count.
+        group_num_shards = num_shards
+
+        make_sharding_transaction(
             per_shard_amount=per_shard_amount,
-            num_shards=num_shards - 1,
-            original_num_shards=original_num_shards,
-            first_shard_extra_amount=None,
+            num_shards=num_shards,
+            first_shard_extra_amount=first_shard_extra_amount,
+            incoming_utxo=incoming_utxo,
+            original_num_shards=group_num_shards,
             parameters=parameters,
         )
+        return make_one_shard_possible_spend(
+            incoming_utxo=incoming_utxo,
+            per_shard_amount=per_shard_amount,
+            num_shards=num_shards,
+            first_shard_extra_amount=first_shard_extra_amount,
+            original_num_shards=group_num_shards,
+            parameters=parameters,
+            depth=depth,
+        )
+
+    # The number of shards in each child group is a power of the group size,
+    # so that the tree is as shallow as possible.
+    group_capacity = 1
+    while group_capacity * group_size < num_shards:
+        group_capacity *= group_size
+
+    split_transaction = PlannedTransaction(name="Vault group split transaction.")
+    incoming_utxo.add_child_transaction(split_transaction)
+
+    planned_input = PlannedInput(
+        utxo=incoming_utxo,
+        witness_template_selection="presigned",
+        transaction=split_transaction,
+    )
+    split_transaction.inputs.append(planned_input)
+
+    vault_utxos = []
+    for group_start in range(0, num_shards, group_capacity):
+        group_num_shards = min(group_capacity, num_shards - group_start)
 
-def setup_vault(segwit_utxo, parameters):
+        group_first_shard_extra_amount = None
+        amount = group_num_shards * per_shard_amount
+        if group_start == 0 and first_shard_extra_amount != None:
+            group_first_shard_extra_amount = first_shard_extra_amount
+            amount += first_shard_extra_amount
+
+        group_utxo = PlannedUTXO(
+            name="vault group UTXO (shards {}-{})".format(shard_offset + group_start + 1, shard_offset + group_start + group_num_shards),
+            transaction=split_transaction,
+            script_template=BasicPresignedScriptTemplate,
+            amount=amount,
+            # BasicPresignedScriptTemplate leaves the timelock on the stack,
+            # so it can't be zero.
+            timelock_multiplier=group_start + 1,
+        )
+        group_utxo.timelock_schedule = schedule
+        split_transaction.output_utxos.append(group_utxo)
+
+        make_push_to_cold_storage_transaction(group_utxo, parameters=parameters)
+
+        vault_utxos.extend(make_hierarchical_sharding(
+            incoming_utxo=group_utxo,
+            per_shard_amount=per_shard_amount,
+            num_shards=group_num_shards,
+            first_shard_extra_amount=group_first_shard_extra_amount,
+            shard_offset=shard_offset + group_start,
+            parameters=parameters,
+            depth=depth + 1,
+        ))
+
+    return vault_utxos
+
+@uses_plan_context
+def setup_vault(segwit_utxo, parameters=None):
     """
     Generate a pre-signed transaction tree using the segwit_utxo as the coins
     to be inserted into the vault. The pre-signed transaction tree is
@@ -341,21 +922,40 @@ def setup_vault(segwit_utxo, parameters):
     planned transaction tree. This sign-off should be predicated on secure key
     deletion of the keys used to create the pre-signed transactions in the
     planned transaction tree.
+
+    To plan several vaults at the same time, pass each vault's PlanContext as
+    context (here, and to the signing and baking entrypoints), see
+    vaults/context.py. The parameters default to the context's parameters.
+
+    segwit_utxo can also be a list of the user's coins (outputs of the same
+    InitialTransaction). The funding commitment transaction then has one input
+    per coin, and the vault gets the sum of their amounts.
     """
 
+    if type(segwit_utxo) == list:
+        segwit_utxos = segwit_utxo
+        segwit_utxo = segwit_utxos[0]
+    else:
+        segwit_utxos = [segwit_utxo]
+
     # name was: Vault locking transaction
     # phase 2 name: Funding commitment transaction
     vault_locking_transaction = PlannedTransaction(name="Funding commitment transaction")
-    segwit_utxo.child_transactions.append(vault_locking_transaction)
 
-    planned_input = PlannedInput(
-        utxo=segwit_utxo,
-        witness_template_selection="user",
-        transaction=vault_locking_transaction,
-    )
-    vault_locking_transaction.inputs.append(planned_input)
+    for some_utxo in segwit_utxos:
+        if some_utxo.transaction != segwit_utxo.transaction:
+            raise VaultException("The user's coins must be outputs of the same InitialTransaction")
 
-    vault_initial_utxo_amount = segwit_utxo.amount
+        some_utxo.add_child_transaction(vault_locking_transaction)
+
+        planned_input = PlannedInput(
+            utxo=some_utxo,
+            witness_template_selection="user",
+            transaction=vault_locking_transaction,
+        )
+        vault_locking_transaction.inputs.append(planned_input)
+
+    vault_initial_utxo_amount = sum([some_utxo.amount for some_utxo in segwit_utxos])
     vault_initial_utxo = PlannedUTXO(
         name="vault initial UTXO",
         transaction=vault_locking_transaction,
@@ -377,86 +977,367 @@ def setup_vault(segwit_utxo, parameters):
     first_shard_extra_amount = vault_initial_utxo.amount - (int(vault_initial_utxo.amount/num_shards)*num_shards)
     assert (amount_per_shard * num_shards) + first_shard_extra_amount == vault_initial_utxo.amount
 
-    # Optional transaction: split the UTXO up into 100 shards, when it's time
-    # to start spending the coins.
-    # Make a transaction that sets up 100 UTXOs (with appropriate relative
-    # timelocks).
-    make_sharding_transaction(
-        per_shard_amount=amount_per_shard,
-        num_shards=num_shards,
-        first_shard_extra_amount=first_shard_extra_amount,
-        incoming_utxo=vault_initial_utxo,
-        original_num_shards=num_shards,
-        parameters=parameters,
-    )
+    sharding_mode = parameters.get("sharding_mode", "flat")
+    if sharding_mode == "flat":
+        # Optional transaction: split the UTXO up into 100 shards, when it's time
+        # to start spending the coins.
+        # Make a transaction that sets up 100 UTXOs (with appropriate relative
+        # timelocks).
+        make_sharding_transaction(
+            per_shard_amount=amount_per_shard,
+            num_shards=num_shards,
+            first_shard_extra_amount=first_shard_extra_amount,
+            incoming_utxo=vault_initial_utxo,
+            original_num_shards=parameters["num_shards"],
+            parameters=parameters,
+        )
 
-    # Another optional transaction
-    # Make a transaction that lets the user spend one shard, but re-vaults
-    # everything else.
-    make_one_shard_possible_spend(
-        incoming_utxo=vault_initial_utxo,
-        per_shard_amount=amount_per_shard,
-        num_shards=num_shards,
-        first_shard_extra_amount=first_shard_extra_amount,
-        original_num_shards=num_shards,
-        parameters=parameters,
-    )
+        # Another optional transaction
+        # Make a transaction that lets the user spend one shard, but re-vaults
+        # everything else.
+        vault_utxos = make_one_shard_possible_spend(
+            incoming_utxo=vault_initial_utxo,
+            per_shard_amount=amount_per_shard,
+            num_shards=num_shards,
+            first_shard_extra_amount=first_shard_extra_amount,
+            original_num_shards=parameters["num_shards"],
+            parameters=parameters,
+        )
+    elif sharding_mode == "hierarchical":
+        # Split the vault into groups of shards. The sharding and re-vault
+        # transactions are made per group.
+        vault_utxos = make_hierarchical_sharding(
+            incoming_utxo=vault_initial_utxo,
+            per_shard_amount=amount_per_shard,
+            num_shards=num_shards,
+            first_shard_extra_amount=first_shard_extra_amount,
+            parameters=parameters,
+        )
+    else:
+        raise VaultException("Unknown sharding mode {}".format(sharding_mode))
+
+    # Optional transactions: spend k shards at once, re-vault the rest.
+    if parameters.get("spend_k_shards", None) or parameters.get("max_planned_transactions", None) != None:
+        (num_utxos, num_transactions) = segwit_utxo.count_nodes()
+        make_spend_k_shards_paths(
+            vault_utxos,
+            per_shard_amount=amount_per_shard,
+            planned_transaction_count=num_transactions,
+            parameters=parameters,
+        )
+
+    # Optional transactions: sweep the remaining shards of a sharding
+    # transaction into cold storage with one transaction.
+    if parameters.get("enable_sweeps", False) == True:
+        (num_utxos, num_transactions) = segwit_utxo.count_nodes()
+        make_sweeps_paths(
+            vault_initial_utxo,
+            planned_transaction_count=num_transactions,
+            parameters=parameters,
+        )
+
+    apply_timelock_schedule(segwit_utxo, parameters)
+
+    (num_utxos, num_transactions) = segwit_utxo.count_nodes()
+    logger.info("Planned {} transactions and {} UTXOs for {} shards ({} sharding)".format(num_transactions, num_utxos, num_shards, sharding_mode))
+
+    if parameters.get("lazy_revault_depth", None) != None:
+        # Only the OP_CHECKTEMPLATEVERIFY version of the vault commits to the
+        # re-vault subtrees that aren't planned yet.
+        logger.warning("Re-vault paths deeper than {} are planned lazily, so the presigned transaction tree doesn't have them".format(parameters["lazy_revault_depth"]))
 
     return vault_initial_utxo
 
-def safety_check(initial_tx=None):
+def apply_timelock_schedule(initial_utxo, parameters):
     """
-    Check that the planned transaction tree conforms to some specific rules.
+    Set the timelock schedule (from the parameters) on every planned UTXO in
+    the tree, and check that every relative timelock in the tree can be
+    encoded with that schedule. Shard UTXOs, and the stage and group UTXOs
+    (which were given the schedule when they were planned) are on the shard
+    schedule. Every other UTXO gets the window schedule, so that the base
+    interval doesn't shorten the cold storage and presigned windows.
     """
+    schedule = get_timelock_schedule(parameters)
+    window_schedule = schedule.get_window_schedule()
+
+    # Deep trees (many shards) would hit the recursion limit in crawl, so
+    # walk the tree with a stack.
+    seen_transactions = set()
+    stack = [initial_utxo]
+    while len(stack) > 0:
+        planned_utxo = stack.pop()
+        if planned_utxo.script_template == ShardScriptTemplate:
+            planned_utxo.timelock_schedule = schedule
+        elif planned_utxo.timelock_schedule == None or planned_utxo.timelock_schedule.window:
+            planned_utxo.timelock_schedule = window_schedule
+        else:
+            planned_utxo.timelock_schedule = schedule
+
+        for child_transaction in planned_utxo.child_transactions:
+            if child_transaction in seen_transactions:
+                continue
+            seen_transactions.add(child_transaction)
+            stack.extend(child_transaction.output_utxos)
 
-    if initial_tx == None:
-        initial_tx = load()
+    # These raise VaultException when a timelock is too long.
+    for some_transaction in seen_transactions:
+        for some_output in some_transaction.output_utxos:
+            get_script_timelocks(some_output)
+        for some_input in some_transaction.inputs:
+            some_input.relative_timelock
 
-    initial_utxo = initial_tx.output_utxos[0]
+    return schedule
+
+@uses_plan_context
+def update_vault_parameters(initial_utxo, parameters, new_parameters):
+    """
+    Apply some new parameter values to an already planned (and possibly
+    already signed or baked) transaction tree. Only the affected planned UTXOs
+    and transactions are marked as dirty, so that sign_transaction_tree and
+    the bip119 entrypoint only redo the work for those parts of the tree.
+
+    Rotating a key marks the UTXOs whose scripts use that key. Toggling
+    enable_burn_transactions adds or removes the burn transactions hanging off
+    of the cold storage UTXOs. Parameters that change the shape of the whole
+    tree (like num_shards) require planning a new tree.
+
+    The parameters dictionary is updated in place. Returns the list of the
+    names of the parameters that changed.
+    """
+    changed_names = []
+    for (some_name, new_value) in new_parameters.items():
+        old_value = parameters.get(some_name, None)
+        if type(old_value) == dict and type(new_value) == dict:
+            # Compare keys by their public key; private key objects don't
+            # implement equality.
+            if old_value["public_key"] == new_value["public_key"]:
+                continue
+        elif old_value == new_value:
+            continue
+        changed_names.append(some_name)
+
+    for some_name in ["num_shards", "amount", "timelock_stage_size", "sharding_mode", "shard_group_size", "spend_k_shards", "max_planned_transactions", "enable_sweeps", "max_sweep_transactions", "sweep_time_budget", "lazy_revault_depth"]:
+        if some_name in changed_names:
+            raise VaultException("Changing {} requires a new planned transaction tree".format(some_name))
+
+    parameters.update(new_parameters)
+
+    if len(changed_names) == 0:
+        return changed_names
 
     (planned_utxos, planned_transactions) = initial_utxo.crawl()
 
-    # Every transaction should have at least one output, including the burner
-    # transactions (unless they are burning to miner fee...).
-    counter = 0
-    for some_transaction in planned_transactions:
-        counter += 1
-        if len(some_transaction.output_utxos) == 0:
-            raise VaultException("Transaction {} has no outputs".format(str(some_transaction.internal_id)))
-
-        # The sum of the input amounts should equal the sum of the output
-        # amounts.
-        input_amounts = sum([some_input.utxo.amount for some_input in some_transaction.inputs])
-        output_amounts = sum([some_output.amount for some_output in some_transaction.output_utxos])
-        if input_amounts != output_amounts and some_transaction.id != -1:
-            raise VaultException("Transaction {} takes {} and spends {}, not equal".format(str(some_transaction.internal_id), input_amounts, output_amounts))
+    # A new timelock schedule changes the scripts of every UTXO with a
+    # relative timelock, and the nSequence of the inputs that spend them.
+    if "timelock_mode" in changed_names or "timelock_base_interval" in changed_names:
+        apply_timelock_schedule(initial_utxo, parameters)
+        for planned_utxo in planned_utxos:
+            if planned_utxo.script_template.relative_timelocks not in [None, {}]:
+                planned_utxo.mark_dirty()
+                for child_transaction in planned_utxo.child_transactions:
+                    child_transaction.mark_dirty()
+
+    for planned_utxo in planned_utxos:
+        script_template = planned_utxo.script_template
+
+        # The script itself uses the changed parameter, so the UTXO gets a
+        # new scriptpubkey.
+        if any([some_name in script_template.miniscript_policy_definitions.keys() for some_name in changed_names]):
+            planned_utxo.mark_dirty()
+
+        # Only the witness uses the changed parameter (like the user's key
+        # for a P2WPKH output), so only the spending transactions have to be
+        # signed again. Their txids don't change.
+        if any([some_name in script_template.witness_template_map.values() for some_name in changed_names]):
+            for child_transaction in planned_utxo.child_transactions:
+                child_transaction.is_dirty = True
+
+    if "enable_burn_transactions" in changed_names:
+        for planned_utxo in planned_utxos:
+            if planned_utxo.script_template != ColdStorageScriptTemplate:
+                continue
 
-        for some_output in some_transaction.output_utxos:
-            if some_output.name in ["CPFP hook", "burned UTXO"]:
+            burn_transactions = [child for child in planned_utxo.child_transactions if child.name == "Burn some UTXO"]
+            if parameters["enable_burn_transactions"] == True and len(burn_transactions) == 0:
+                make_burn_transaction(planned_utxo, parameters=parameters)
+            elif parameters["enable_burn_transactions"] != True and len(burn_transactions) > 0:
+                for burn_transaction in burn_transactions:
+                    planned_utxo.child_transactions.remove(burn_transaction)
+            else:
                 continue
-            elif len(some_output.child_transactions) == 0:
-                raise VaultException("UTXO {} has no child transactions".format(str(some_output.internal_id)))
 
-        # TODO: There should be other rule checks as well, possibly including
-        # things like "does this transaction have the correct scripts and
-        # correct outputs" and "does this UTXO have any scripts at all".
+            # The presigned script doesn't depend on the list of children, but
+            # the OP_CHECKTEMPLATEVERIFY script does.
+            planned_utxo.ctv_is_dirty = True
+
+    # The subtrees of the re-vault stubs will be planned with the new
+    # parameters, so their template hashes have to be computed again.
+    for planned_utxo in planned_utxos:
+        if planned_utxo.revault_stub != None:
+            planned_utxo.revault_stub.template_hashes = None
+            planned_utxo.ctv_is_dirty = True
 
-    if counter < 1 or counter < len(planned_transactions):
-        raise VaultException("Length of the list of planned transactions is too low.")
+    logger.info("Changed parameters: {}".format(", ".join(changed_names)))
 
-    return True
+    return changed_names
+
+def copy_planned_amounts(old_utxo, new_utxo):
+    """
+    Walk two planned transaction trees of the same shape at the same time, and
+    copy the amounts (and re-vault stubs) of the second tree into the first.
+    The transactions whose outputs changed are marked as dirty, and so are the
+    UTXOs whose re-vault stubs changed. The compiled scripts are kept; only the
+    bitcoin outputs get the new amounts. Returns the number of UTXOs that got
+    a new amount.
+    """
+    changed_count = 0
+
+    stack = [(old_utxo, new_utxo)]
+    while len(stack) > 0:
+        (old_utxo, new_utxo) = stack.pop()
+
+        if old_utxo.name != new_utxo.name:
+            raise VaultException("UTXO {} doesn't match the new plan ({})".format(str(old_utxo.internal_id), new_utxo.name))
+
+        if old_utxo.amount != new_utxo.amount:
+            old_utxo.amount = new_utxo.amount
+            if old_utxo.bitcoin_output != None:
+                old_utxo.bitcoin_output = CTxOut(old_utxo.amount, old_utxo.scriptpubkey)
+
+            # The script stays the same, but the transaction that creates the
+            # UTXO has to be signed (and hashed) again.
+            old_utxo.transaction.is_dirty = True
+            old_utxo.transaction.ctv_is_dirty = True
+            changed_count += 1
+
+        if old_utxo.revault_stub != None and old_utxo.revault_stub.to_dict() != new_utxo.revault_stub.to_dict():
+            old_utxo.revault_stub = new_utxo.revault_stub
+            old_utxo.ctv_is_dirty = True
+
+        old_children = old_utxo.child_transactions
+        new_children = new_utxo.child_transactions
+        if len(old_children) != len(new_children):
+            raise VaultException("UTXO {} has a different number of child transactions in the new plan".format(str(old_utxo.internal_id)))
+
+        for (old_transaction, new_transaction) in zip(old_children, new_children):
+            if len(old_transaction.output_utxos) != len(new_transaction.output_utxos):
+                raise VaultException("Transaction {} has a different number of outputs in the new plan".format(str(old_transaction.internal_id)))
+            stack.extend(zip(old_transaction.output_utxos, new_transaction.output_utxos))
+
+    return changed_count
+
+@uses_plan_context
+def top_up_vault(segwit_utxo, new_coins, parameters=None):
+    """
+    Put more of the user's coins into an already planned (and possibly
+    already signed or baked) vault, instead of planning a new vault. The new
+    coins must be outputs of the vault's InitialTransaction, like the coins in
+    setup_vault.
+
+    The new coins become inputs of the funding commitment transaction, so
+    this only works until the funding commitment transaction is broadcasted.
+    After that, the vault UTXOs can only be spent by the planned transactions.
+
+    The amounts of the rest of the tree are taken from a throwaway plan for
+    the new total amount, which has the same shape. Only the transactions
+    whose amounts changed (and their descendants, which spend new txids) are
+    signed and baked again by sign_transaction_tree and the bip119
+    entrypoint; the scripts of the planned UTXOs are reused. Returns the
+    number of planned UTXOs that got a new amount.
+    """
+    initial_tx = segwit_utxo.transaction
+    funding_transaction = segwit_utxo.child_transactions[0]
+
+    for new_coin in new_coins:
+        if new_coin.transaction != initial_tx:
+            raise VaultException("The user's coins must be outputs of the same InitialTransaction")
+        if new_coin not in initial_tx.output_utxos:
+            initial_tx.output_utxos.append(new_coin)
+
+        new_coin.add_child_transaction(funding_transaction)
+        planned_input = PlannedInput(
+            utxo=new_coin,
+            witness_template_selection="user",
+            transaction=funding_transaction,
+        )
+        funding_transaction.inputs.append(planned_input)
+
+    funding_transaction.mark_dirty()
+
+    amount = sum([some_input.utxo.amount for some_input in funding_transaction.inputs])
+    parameters["amount"] = amount
+
+    # Plan the tree for the new amount on a placeholder coin. This is cheap
+    # compared to signing and baking, and it keeps all of the amount rules
+    # in one place (setup_vault).
+    with PlanContext(parameters=parameters).activate():
+        placeholder_tx = InitialTransaction(txid=initial_tx.txid)
+        placeholder_utxo = PlannedUTXO(
+            name="segwit input coin",
+            transaction=placeholder_tx,
+            script_template=UserScriptTemplate,
+            amount=amount,
+        )
+        placeholder_tx.output_utxos = [placeholder_utxo]
+        setup_vault(placeholder_utxo, parameters=parameters)
+
+    new_funding_transaction = placeholder_utxo.child_transactions[0]
+    changed_count = 0
+    for (old_utxo, new_utxo) in zip(funding_transaction.output_utxos, new_funding_transaction.output_utxos):
+        changed_count += copy_planned_amounts(old_utxo, new_utxo)
+
+    logger.info("Topped up the vault with {} coins, {} UTXOs have new amounts".format(len(new_coins), changed_count))
+
+    return changed_count
+
+def safety_check(initial_tx=None):
+    """
+    Check that the planned transaction tree conforms to some specific rules.
+    The rules run over a columnar snapshot of the whole tree, see
+    ColumnarTree.run_safety_checks. Returns a list of (rule name, bad nodes,
+    seconds) tuples, starting with the time it took to build the snapshot
+    (as the "snapshot" rule), or raises a VaultException for the first broken
+    rule.
+    """
+
+    if initial_tx == None:
+        initial_tx = load()
 
-def render_planned_tree_to_text_file(some_utxo, filename=TEXT_RENDERING_FILENAME):
+    start_time = time.perf_counter()
+    tree = ColumnarTree.from_tree(initial_tx)
+    results = [("snapshot", [], time.perf_counter() - start_time)]
+
+    schedule = initial_tx.output_utxos[0].get_timelock_schedule()
+    results.extend(tree.run_safety_checks(schedule=schedule))
+
+    for (rule_name, bad_nodes, seconds) in results:
+        logger.info("Safety check {}: {} bad nodes in {:.6f} seconds".format(rule_name, len(bad_nodes), seconds))
+
+    messages = {
+        "outputs": "Transaction {} has no outputs",
+        "amounts": "Transaction {} doesn't spend the amount that it takes",
+        "children": "UTXO {} has no child transactions",
+        "timelocks": "UTXO {} has a timelock multiplier that is out of bounds",
+        "templates": "Node {} has inconsistent script templates",
+    }
+    for (rule_name, bad_nodes, seconds) in results:
+        if len(bad_nodes) > 0:
+            message = messages[rule_name].format(tree.describe_node(bad_nodes[0]))
+            if len(bad_nodes) > 1:
+                message += " (and {} more)".format(len(bad_nodes) - 1)
+            raise VaultException(message)
+
+    return results
+
+def render_planned_tree_to_text_file(some_utxo, filename=TEXT_RENDERING_FILENAME, max_depth=None):
     """
     Dump some text describing the planned transaction tree to a text file. This
-    is primarily for human debugging.
+    is primarily for human debugging. The text is written as it is generated
+    (see iter_text_lines), and max_depth limits how deep the rendering goes.
     """
     logger.info("Rendering to text...")
-    output = some_utxo.to_text()
-    filename = TEXT_RENDERING_FILENAME
-    fd = open(os.path.join(os.getcwd(), filename), "w")
-    fd.write(output)
-    fd.close()
+    with open(os.path.join(os.getcwd(), filename), "w") as fd:
+        fd.writelines(iter_text_lines(some_utxo, max_depth=max_depth))
     logger.info(f"Wrote to {filename}")
     return
 
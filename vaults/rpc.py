@@ -3,15 +3,25 @@ Functions dealing with RPC communication to bitcoind.
 """
 
 from vaults.helpers.formatting import b2x, x, b2lx, lx
+from vaults.metrics import count
 
 import bitcoin.rpc
 
+class MeteredProxy(bitcoin.rpc.Proxy):
+    """
+    A bitcoin.rpc.Proxy that counts its calls (see metrics.py).
+    """
+
+    def _call(self, service_name, *args):
+        count("rpc_calls")
+        return super()._call(service_name, *args)
+
 def get_bitcoin_rpc_connection():
     """
     Establish an RPC connection.
     """
     # by default uses ~/.bitcoin/bitcoin.conf so be careful.
-    btcproxy = bitcoin.rpc.Proxy()
+    btcproxy = MeteredProxy()
 
     # sanity check
     assert btcproxy._call("getblockchaininfo")["chain"] == "regtest"
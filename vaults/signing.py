@@ -8,17 +8,22 @@ PlannedInput.parameterize_witness_template_by_signing in the models/ folder.
 entrypoint: sign_transaction_tree
 """
 
+import struct
+import logging
 from copy import copy
 
 from vaults.helpers.formatting import b2x, x, b2lx, lx
 from vaults.exceptions import VaultException
 from vaults.loggingconfig import logger
-from vaults.utils import sha256
+from vaults.metrics import count
+from vaults.utils import sha256, ser_string
+from vaults.timelocks import get_script_timelocks
+from vaults.context import uses_plan_context
 
 from vaults.models.script_templates import UserScriptTemplate
 
 import bitcoin.core.script
-from bitcoin.core import CTxOut, COutPoint, CTxIn, CMutableTransaction, CTxWitness, CTxInWitness, CScriptWitness
+from bitcoin.core import CTxOut, COutPoint, CTxIn, CMutableTransaction, CTxWitness, CTxInWitness, CScriptWitness, Hash
 from bitcoin.core.script import CScript, OP_0, OP_NOP3, SignatureHash, SIGHASH_ALL, SIGVERSION_WITNESS_V0, Hash160
 from bitcoin.wallet import P2WSHBitcoinAddress, P2WPKHBitcoinAddress
 
@@ -27,17 +32,62 @@ from bitcoin.wallet import P2WSHBitcoinAddress, P2WPKHBitcoinAddress
 # python-bitcointx just farms this out to libbitcoinconsensus, so that's an
 # option...
 
-def parameterize_witness_template_by_signing(some_input, parameters):
+def get_witness_sighash_midstate(bitcoin_transaction):
+    """
+    Compute the parts of the bip143 (segwit v0) signature hash that are the
+    same for every input of the transaction, when signing with SIGHASH_ALL:
+    hashPrevouts, hashSequence and hashOutputs.
+
+    SignatureHash computes these again for every input, which makes signing a
+    transaction with many inputs (like a funding commitment transaction that
+    spends many of the user's coins) quadratic in the number of inputs.
+    """
+    hash_prevouts = Hash(b"".join([txin.prevout.serialize() for txin in bitcoin_transaction.vin]))
+    hash_sequence = Hash(b"".join([struct.pack("<I", txin.nSequence) for txin in bitcoin_transaction.vin]))
+    hash_outputs = Hash(b"".join([txout.serialize() for txout in bitcoin_transaction.vout]))
+    return (hash_prevouts, hash_sequence, hash_outputs)
+
+def get_witness_signature_hash(script_code, bitcoin_transaction, txin_index, amount, midstate):
+    """
+    The same as SignatureHash(script_code, bitcoin_transaction, txin_index,
+    SIGHASH_ALL, amount=amount, sigversion=SIGVERSION_WITNESS_V0), using the
+    midstate from get_witness_sighash_midstate.
+    """
+    (hash_prevouts, hash_sequence, hash_outputs) = midstate
+    txin = bitcoin_transaction.vin[txin_index]
+
+    preimage = b"".join([
+        struct.pack("<i", bitcoin_transaction.nVersion),
+        hash_prevouts,
+        hash_sequence,
+        txin.prevout.serialize(),
+        ser_string(bytes(script_code)),
+        struct.pack("<q", amount),
+        struct.pack("<I", txin.nSequence),
+        hash_outputs,
+        struct.pack("<i", bitcoin_transaction.nLockTime),
+        struct.pack("<i", SIGHASH_ALL),
+    ])
+    count("sighashes")
+    return Hash(preimage)
+
+def parameterize_witness_template_by_signing(some_input, parameters, txin_index=None, sighash_midstate=None):
     """
     Take a specific witness template, a bag of parameters, and a
     transaction, and then produce a parameterized witness (including all
     necessary valid signatures).
 
-    Make a sighash for the bitcoin transaction.
+    Make a sighash for the bitcoin transaction. When signing every input of a
+    transaction, pass the input's index and the transaction's midstate (see
+    get_witness_sighash_midstate) so that they aren't computed again for each
+    input.
     """
     p2wsh_redeem_script = some_input.utxo.p2wsh_redeem_script
     tx = some_input.transaction.bitcoin_transaction
-    txin_index = some_input.transaction.inputs.index(some_input)
+    if txin_index == None:
+        txin_index = some_input.transaction.inputs.index(some_input)
+    if sighash_midstate == None:
+        sighash_midstate = get_witness_sighash_midstate(tx)
 
     computed_witness = []
 
@@ -58,6 +108,11 @@ def parameterize_witness_template_by_signing(some_input, parameters):
             if section == "user_key":
                 computed_witness.append(parameters["user_key"]["public_key"])
                 continue
+            elif section == "empty":
+                # An empty stack item, like a signature that must fail
+                # OP_CHECKSIG to select the OP_NOTIF branch.
+                computed_witness.append(b"")
+                continue
             elif section not in script_template.witness_template_map.keys():
                 raise VaultException("Missing key mapping for {}".format(section))
 
@@ -73,8 +128,9 @@ def parameterize_witness_template_by_signing(some_input, parameters):
                 redeem_script = user_address.to_redeemScript()
                 # P2WPKH redeemScript: OP_DUP OP_HASH160 ....
 
-            sighash = SignatureHash(redeem_script, tx, txin_index, SIGHASH_ALL, amount=amount, sigversion=SIGVERSION_WITNESS_V0)
+            sighash = get_witness_signature_hash(redeem_script, tx, txin_index, amount, sighash_midstate)
             signature = private_key.sign(sighash) + bytes([SIGHASH_ALL])
+            count("signatures")
             computed_witness.append(signature)
 
         else:
@@ -90,7 +146,7 @@ def parameterize_witness_template_by_signing(some_input, parameters):
         # Append the p2wsh redeem script.
         computed_witness.append(p2wsh_redeem_script)
 
-    computed_witness = CScript(computed_witness)
+    # A list of stack items: a CScript would turn an empty item into OP_0.
     some_input.witness = computed_witness
     return computed_witness
 
@@ -115,15 +171,10 @@ def parameterize_planned_utxo(planned_utxo, parameters=None):
         script = script.replace("<" + some_variable + ">", some_public_key)
 
     # Insert the appropriate relative timelocks, based on the timelock
-    # multiplier.
-    relative_timelocks = planned_utxo.script_template.relative_timelocks
-    timelock_multiplier = planned_utxo.timelock_multiplier
-    if relative_timelocks not in [{}, None]:
-        replacements = relative_timelocks["replacements"]
-
-        # Update these values to take into account the timelock multiplier.
-        replacements = dict((key, value*timelock_multiplier) for (key, value) in replacements.items())
-
+    # multiplier and the UTXO's timelock schedule. The same values are used
+    # for nSequence on the spending inputs (PlannedInput.relative_timelock).
+    replacements = get_script_timelocks(planned_utxo)
+    if replacements != {}:
         # Insert the new value into the script. The value has to be
         # converted to the right value (vch), though.
         for (replacement_name, replacement_value) in replacements.items():
@@ -185,8 +236,8 @@ def parameterize_planned_utxo(planned_utxo, parameters=None):
     planned_utxo.bitcoin_output = CTxOut(amount, scriptpubkey)
     planned_utxo.is_finalized = True
 
-    logger.info("UTXO name: {}".format(planned_utxo.name))
-    logger.info("final script: {}".format(script))
+    logger.debug("UTXO name: %s", planned_utxo.name)
+    logger.debug("final script: %s", script)
     #logger.info("p2wsh_redeem_script: ".format(b2x(planned_utxo.p2wsh_redeem_script)))
     #logger.info("p2wsh_redeem_script: ".format(CScript(planned_utxo.p2wsh_redeem_script)))
 
@@ -204,7 +255,7 @@ def sign_planned_transaction(planned_transaction, parameters=None):
     the script templates from their predecesor coins.
     """
     for planned_input in planned_transaction.inputs:
-        logger.info("parent transaction name: {}".format(planned_input.utxo.transaction.name))
+        logger.debug("parent transaction name: %s", planned_input.utxo.transaction.name)
 
         # Sanity test: all parent transactions should already be finalized
         assert planned_input.utxo.transaction.is_finalized == True
@@ -221,7 +272,7 @@ def sign_planned_transaction(planned_transaction, parameters=None):
         # Would use transaction.bitcoin_transaction.get_txid() but for the
         # very first utxo, the txid is going to be mocked for testing
         # purposes. So it's better to just use the txid property...
-        txid = planned_utxo.transaction.txid
+        txid = planned_utxo.txid
         vout = planned_utxo.vout
 
         relative_timelock = planned_input.relative_timelock
@@ -261,12 +312,14 @@ def sign_planned_transaction(planned_transaction, parameters=None):
         raise VaultException("Can't have a transaction with zero inputs")
 
     # Now that the inputs are finalized, it should be possible to sign each
-    # input on this transaction and add to the list of witnesses.
+    # input on this transaction and add to the list of witnesses. The parts of
+    # the sighash that every input shares are only computed once.
+    sighash_midstate = get_witness_sighash_midstate(planned_transaction.bitcoin_transaction)
     witnesses = []
-    for planned_input in planned_transaction.inputs:
+    for (txin_index, planned_input) in enumerate(planned_transaction.inputs):
         # sign!
         # Make a signature. Use some code defined in the PlannedInput model.
-        witness = parameterize_witness_template_by_signing(planned_input, parameters)
+        witness = parameterize_witness_template_by_signing(planned_input, parameters, txin_index=txin_index, sighash_midstate=sighash_midstate)
         witnesses.append(witness)
 
     # Now take the list of CScript objects and do the needful.
@@ -280,52 +333,143 @@ def sign_planned_transaction(planned_transaction, parameters=None):
         # serialization function fails, so just skip
         return
 
-    serialized_transaction = planned_transaction.serialize()
-    logger.info("tx len: {}".format(len(serialized_transaction)))
-    logger.info("txid: {}".format(b2lx(planned_transaction.bitcoin_transaction.GetTxid())))
-    logger.info("Serialized transaction: {}".format(b2x(serialized_transaction)))
+    # Serializing the whole transaction is only worth it for debugging.
+    if logger.isEnabledFor(logging.DEBUG):
+        serialized_transaction = planned_transaction.serialize()
+        logger.debug("tx len: %d", len(serialized_transaction))
+        logger.debug("txid: %s", b2lx(planned_transaction.bitcoin_transaction.GetTxid()))
+        logger.debug("Serialized transaction: %s", b2x(serialized_transaction))
+
+def restore_signed_transaction(planned_transaction, transaction_data):
+    """
+    Restore a planned transaction that was already signed in a previous run
+    (see TransactionJournal), instead of signing it again. The outputs must
+    already be parameterized, so that the restored transaction can be checked
+    against the current plan.
+    """
+    bitcoin_transaction = CMutableTransaction.deserialize(x(transaction_data["bitcoin_transaction"]))
+
+    bitcoin_outputs = [planned_output.bitcoin_output for planned_output in planned_transaction.output_utxos]
+    journaled_outputs = [some_output.serialize() for some_output in bitcoin_transaction.vout]
+    planned_outputs = [some_output.serialize() for some_output in bitcoin_outputs]
+    if journaled_outputs != planned_outputs or len(bitcoin_transaction.vin) != len(planned_transaction.inputs):
+        raise VaultException("Journaled transaction {} does not match the plan".format(planned_transaction.internal_id))
+
+    for (idx, planned_input) in enumerate(planned_transaction.inputs):
+        bitcoin_input = bitcoin_transaction.vin[idx]
+        if bitcoin_input.prevout.hash != planned_input.utxo.txid:
+            raise VaultException("Journaled transaction {} spends the wrong parent".format(planned_transaction.internal_id))
+
+        planned_input.bitcoin_input = bitcoin_input
+        planned_input.witness = list(bitcoin_transaction.wit.vtxinwit[idx].scriptWitness.stack)
+        planned_input.is_finalized = True
+
+    planned_transaction.bitcoin_inputs = list(bitcoin_transaction.vin)
+    planned_transaction.bitcoin_outputs = bitcoin_outputs
+    planned_transaction.bitcoin_transaction = bitcoin_transaction
+    planned_transaction.is_finalized = True
+
+def sign_planned_transactions(planned_transactions, parameters=None, journal=None):
+    """
+    Sign the given planned transactions, which must be sorted such that parent
+    transactions come before their children. Transactions are skipped unless
+    they are dirty, have dirty outputs, or spend a parent transaction that got
+    a new txid during this pass. Returns the number of signed transactions.
+    """
+    logger.debug("======== Start")
 
-def sign_planned_transactions(planned_transactions, parameters=None):
-    logger.info("======== Start")
+    # Transactions whose txid changed during this pass.
+    changed_transactions = set()
+    signed_count = 0
 
     # Finalize each transaction by creating a set of bitcoin objects (including
     # a bitcoin transaction) representing the planned transaction.
     for (counter, planned_transaction) in enumerate(planned_transactions):
-        logger.info("--------")
-        logger.info("current transaction name: {}".format(planned_transaction.name))
-        logger.info(f"counter: {counter}")
+        needs_signing = planned_transaction.is_dirty
+        needs_signing = needs_signing or any([some_utxo.is_dirty for some_utxo in planned_transaction.output_utxos])
+        needs_signing = needs_signing or any([some_input.utxo.transaction in changed_transactions for some_input in planned_transaction.inputs])
+        if not needs_signing:
+            continue
+
+        logger.debug("--------")
+        logger.debug("current transaction name: %s", planned_transaction.name)
+        logger.debug("counter: %d", counter)
+
+        old_txid = None
+        if planned_transaction.bitcoin_transaction != None:
+            old_txid = planned_transaction.txid
+
+        # Previously signed trees (like ones loaded from a transaction store)
+        # might not have compiled scripts yet.
+        for some_utxo in planned_transaction.output_utxos + [some_input.utxo for some_input in planned_transaction.inputs]:
+            if some_utxo.bitcoin_output == None:
+                parameterize_planned_utxo(some_utxo, parameters=parameters)
+
+        checkpoint = None
+        if journal != None:
+            checkpoint = journal.get_checkpoint(counter)
+
+        # The placeholder for the user's transaction is never really signed,
+        # so it is cheaper to just run it through the signer again.
+        if checkpoint != None and planned_transaction.id != -1:
+            restore_signed_transaction(planned_transaction, checkpoint)
+        else:
+            sign_planned_transaction(planned_transaction, parameters=parameters)
 
-        sign_planned_transaction(planned_transaction, parameters=parameters)
+            if journal != None and checkpoint == None:
+                journal.append(counter, planned_transaction)
 
-def sign_transaction_tree(initial_utxo, parameters):
+        if planned_transaction.txid != old_txid:
+            changed_transactions.add(planned_transaction)
+
+        planned_transaction.is_dirty = False
+        signed_count += 1
+
+    return signed_count
+
+@uses_plan_context
+def sign_transaction_tree(initial_utxo, parameters=None, journal=None):
     """
     Walk the planned transaction tree and convert everything into bitcoin
     transactions. Convert the script templates and witness templates into real
     values.
+
+    Only dirty parts of the tree are processed: dirty UTXOs are parameterized
+    again, and the transactions affected by them (or by a changed parent txid)
+    are signed again. For a freshly planned tree, everything is dirty. Returns
+    the number of transactions that were signed.
+
+    When a TransactionJournal is given, each signed transaction is streamed
+    into the journal as soon as it is signed, and any transactions that were
+    journaled by a previous (interrupted) run are restored instead of signed.
+    The signed transactions also stay attached to the tree.
     """
 
     # Crawl the planned transaction tree and get a list of all planned
     # transactions and all planned UTXOs.
     (planned_utxos, planned_transactions) = initial_utxo.crawl()
 
-    # also get a list of all inputs
-    planned_inputs = set()
-    for planned_transaction in planned_transactions:
-        planned_inputs.update(planned_transaction.inputs)
-
     # Sort the objects such that the lowest IDs get processed first.
     planned_utxos = sorted(planned_utxos, key=lambda utxo: utxo.id)
     planned_transactions = sorted(planned_transactions, key=lambda tx: tx.id)
 
-    # Parameterize each PlannedUTXO's script template, based on the given
-    # config/parameters. Loop through all of the PlannedUTXOs in any order.
-    parameterize_planned_utxos(planned_utxos, parameters=parameters)
+    if journal != None:
+        journal.begin(planned_utxos, planned_transactions)
+
+    # Parameterize each dirty PlannedUTXO's script template, based on the
+    # given config/parameters. Loop through all of the PlannedUTXOs in any
+    # order.
+    dirty_utxos = [planned_utxo for planned_utxo in planned_utxos if planned_utxo.is_dirty]
+    parameterize_planned_utxos(dirty_utxos, parameters=parameters)
 
     # Sign each planned transaction by parameterizing the inputs, which can be
     # done by referencing the script template object for the output being
     # consumed by each input.
-    sign_planned_transactions(planned_transactions, parameters=parameters)
+    signed_count = sign_planned_transactions(planned_transactions, parameters=parameters, journal=journal)
 
-    return
+    for planned_utxo in dirty_utxos:
+        planned_utxo.is_dirty = False
 
+    logger.info("Parameterized {} UTXOs and signed {} transactions".format(len(dirty_utxos), signed_count))
 
+    return signed_count
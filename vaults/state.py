@@ -3,20 +3,46 @@ Functions for checking the state of the vault on the blockchain by querying
 bitcoind over RPC.
 """
 
+from vaults.loggingconfig import logger
+from vaults.config import TRANSACTION_STORE_FILENAME, CTV_TRANSACTION_STORE_FILENAME
+from vaults.persist import load, save
 from vaults.rpc import (
     get_bitcoin_rpc_connection,
     check_blockchain_has_transaction,
 )
 
-def get_next_possible_transactions_by_walking_tree(current_transaction, connection=None):
+def get_txid(planned_transaction, ctv=False):
+    """
+    The txid of either the presigned or the OP_CHECKTEMPLATEVERIFY version of
+    a planned transaction. The initial transaction is the same for both.
+    """
+    if ctv and planned_transaction.ctv_bitcoin_transaction != None:
+        return planned_transaction.ctv_bitcoin_transaction.GetTxid()
+    return planned_transaction.txid
+
+def get_next_possible_transactions_by_walking_tree(current_transaction, connection=None, ctv=False, materialized_utxos=None):
     """
     Walk the planned transaction tree and find which transaction is not yet in
     the blockchain. Recursively check child transactions until an unconfirmed
     tree node is found.
+
+    With ctv=True, the OP_CHECKTEMPLATEVERIFY transactions are checked, and
+    lazy re-vault subtrees are planned as the walk reaches them (see
+    bip119_ctv.materialize_revault_stub). Those UTXOs are appended to
+    materialized_utxos, so that the caller can save the new transactions.
     """
     if connection == None:
         connection = get_bitcoin_rpc_connection()
 
+    if ctv:
+        # Only the OP_CHECKTEMPLATEVERIFY version needs the planner.
+        from vaults.bip119_ctv import materialize_revault_stub
+        for some_utxo in current_transaction.output_utxos:
+            if some_utxo.revault_stub != None:
+                materialize_revault_stub(some_utxo)
+                if materialized_utxos != None:
+                    materialized_utxos.append(some_utxo)
+
     # This is an intentionally simple implementation: it will not work when
     # there are multiple possible non-interfering transactions hanging off of
     # this transaction. For example, two separate transactions might spend two
@@ -26,19 +52,19 @@ def get_next_possible_transactions_by_walking_tree(current_transaction, connecti
 
     possible_transactions = []
     for some_transaction in current_transaction.child_transactions:
-        if not check_blockchain_has_transaction(some_transaction.txid):
+        if not check_blockchain_has_transaction(get_txid(some_transaction, ctv=ctv), connection=connection):
             # If none of them are confirmed, then they are all possible
             # options.
             possible_transactions.append(some_transaction)
         else:
             # One of them was confirmed, so reset the possible transaction list
             # and find the next possible transactions.
-            possible_transactions = get_next_possible_transactions_by_walking_tree(some_transaction, connection=connection)
+            possible_transactions = get_next_possible_transactions_by_walking_tree(some_transaction, connection=connection, ctv=ctv, materialized_utxos=materialized_utxos)
             break
 
     return list(set(possible_transactions))
 
-def get_current_confirmed_transaction(current_transaction, connection=None):
+def get_current_confirmed_transaction(current_transaction, connection=None, ctv=False, materialized_utxos=None):
     """
     Find the most recently broadcasted-and-confirmed  pre-signed transaction
     from the vault, by walking the tree starting from the root (the first
@@ -46,16 +72,19 @@ def get_current_confirmed_transaction(current_transaction, connection=None):
 
     The "current confirmed transaction" is the transaction where no child
     transactions are broadcasted or confirmed.
+
+    See get_next_possible_transactions_by_walking_tree for ctv and
+    materialized_utxos.
     """
     if connection == None:
         connection = get_bitcoin_rpc_connection()
 
-    if not check_blockchain_has_transaction(current_transaction.txid):
+    if not check_blockchain_has_transaction(get_txid(current_transaction, ctv=ctv), connection=connection):
         return current_transaction
 
-    possible_transactions = get_next_possible_transactions_by_walking_tree(current_transaction, connection=connection)
+    possible_transactions = get_next_possible_transactions_by_walking_tree(current_transaction, connection=connection, ctv=ctv, materialized_utxos=materialized_utxos)
     #logger.info("possible_transactions: {}".format([b2lx(possible_tx.txid) for possible_tx in possible_transactions]))
-    assert all([len(possible_tx.parent_transactions) == 1 for possible_tx in possible_transactions])
+    assert all([len(set(possible_tx.parent_transactions)) == 1 for possible_tx in possible_transactions])
     parents = [possible_tx.parent_transactions[0] for possible_tx in possible_transactions]
     assert len(set(parents)) == 1
     parent = parents[0]
@@ -63,4 +92,26 @@ def get_current_confirmed_transaction(current_transaction, connection=None):
 
     return {"current": current_transaction, "next": possible_transactions}
 
+def load_current_state(transaction_store_filename=None, connection=None, ctv=False):
+    """
+    Load the vault's transaction store (the OP_CHECKTEMPLATEVERIFY one with
+    ctv=True) and find the current confirmed transaction, see
+    get_current_confirmed_transaction.
+
+    Lazy re-vault subtrees that get planned on the way are saved back into
+    the transaction store, so that later commands (like broadcast) find the
+    same transactions without planning them again.
+    """
+    if transaction_store_filename == None:
+        transaction_store_filename = CTV_TRANSACTION_STORE_FILENAME if ctv else TRANSACTION_STORE_FILENAME
+
+    initial_tx = load(transaction_store_filename=transaction_store_filename)
+
+    materialized_utxos = []
+    latest_info = get_current_confirmed_transaction(initial_tx, connection=connection, ctv=ctv, materialized_utxos=materialized_utxos)
+
+    if len(materialized_utxos) > 0:
+        logger.info("Saving {} newly planned re-vault levels".format(len(materialized_utxos)))
+        save(initial_tx.output_utxos[0], filename=transaction_store_filename)
 
+    return latest_info
@@ -0,0 +1,78 @@
+import os
+import copy
+import tempfile
+import unittest
+
+from vaults.benchmarks import (
+    get_scenarios,
+    get_scenario_name,
+    run_plan_benchmark,
+    save_baseline,
+    load_baseline,
+    compare_to_baseline,
+    format_plan_benchmark,
+)
+from vaults.exceptions import VaultException
+
+PHASE_NAMES = ["setup_vault", "crawl", "sign_transaction_tree", "save", "load", "ctv conversion", "ctv save"]
+
+class PlanBenchmarkTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.baseline_path = os.path.join(self.tempdir.name, "benchmark-baseline.json")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_scenarios(self):
+        scenarios = get_scenarios((3, 4))
+        self.assertEqual(len(scenarios), 8)
+        self.assertEqual(len(set([get_scenario_name(*scenario) for scenario in scenarios])), 8)
+
+    def test_run_and_compare(self):
+        results = run_plan_benchmark([(3, False, True)], repeat=1)
+        scenario_results = results["shards=3 burn=off sweeps=on"]
+        self.assertEqual(list(scenario_results.keys()), PHASE_NAMES)
+
+        signing = scenario_results["sign_transaction_tree"]
+        self.assertGreater(signing["counts"]["signatures"], 0)
+        self.assertGreater(scenario_results["crawl"]["values"]["transactions"], 0)
+        self.assertGreater(scenario_results["ctv conversion"]["counts"]["ctv_hashes"], 0)
+        self.assertGreater(scenario_results["save"]["peak_memory"], 0)
+        self.assertIn("sign_transaction_tree", format_plan_benchmark(results))
+
+        save_baseline(results, self.baseline_path, threshold=0.5)
+        baseline = load_baseline(self.baseline_path)
+        self.assertEqual(baseline["threshold"], 0.5)
+        self.assertEqual(compare_to_baseline(results, baseline), [])
+
+        # slower, but not by much in absolute terms
+        slower = copy.deepcopy(results)
+        slower["shards=3 burn=off sweeps=on"]["crawl"]["wall_time"] *= 2
+        self.assertEqual(compare_to_baseline(slower, baseline), [])
+
+        slower["shards=3 burn=off sweeps=on"]["sign_transaction_tree"]["wall_time"] += 1
+        slower["shards=3 burn=off sweeps=on"]["save"]["peak_memory"] *= 10
+        slower["shards=3 burn=off sweeps=on"]["sign_transaction_tree"]["counts"]["sighashes"] += 1
+        regressions = compare_to_baseline(slower, baseline)
+        self.assertEqual(sorted([(phase_name, metric) for (scenario, phase_name, metric, old_value, new_value) in regressions]), [
+            ("save", "peak_memory"),
+            ("sign_transaction_tree", "sighashes"),
+            ("sign_transaction_tree", "wall_time"),
+        ])
+
+        # a very high threshold only leaves the counter
+        regressions = compare_to_baseline(slower, baseline, threshold=100)
+        self.assertEqual([metric for (scenario, phase_name, metric, old_value, new_value) in regressions], ["sighashes"])
+
+        # scenarios that aren't in the baseline are skipped
+        self.assertEqual(compare_to_baseline({"shards=4 burn=on sweeps=on": slower["shards=3 burn=off sweeps=on"]}, baseline), [])
+
+    def test_unknown_baseline(self):
+        with open(self.baseline_path, "w") as fd:
+            fd.write("{}")
+        with self.assertRaises(VaultException):
+            load_baseline(self.baseline_path)
+
+if __name__ == "__main__":
+    unittest.main()
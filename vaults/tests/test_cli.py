@@ -0,0 +1,57 @@
+import logging
+import unittest
+
+from click.testing import CliRunner
+
+from vaults.cli import cli
+from vaults.benchmarks import get_imported_modules, HEAVY_MODULES
+from vaults.loggingconfig import logger, set_log_level, DEFAULT_LOG_LEVEL
+
+class CommandLineTests(unittest.TestCase):
+    def test_help(self):
+        result = CliRunner().invoke(cli, ["--help"])
+        self.assertEqual(result.exit_code, 0)
+        for command_name in ["init", "info", "broadcast", "graph", "bench"]:
+            self.assertIn(command_name, result.output)
+
+    def test_ctv_option(self):
+        for command_name in ["info", "status", "graph", "broadcast"]:
+            result = CliRunner().invoke(cli, [command_name, "--help"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("--ctv", result.output)
+
+    def test_plan_options(self):
+        # init, farm and estimate take the same options for the shape of the
+        # tree.
+        for command_name in ["init", "farm", "estimate"]:
+            result = CliRunner().invoke(cli, [command_name, "--help"])
+            self.assertEqual(result.exit_code, 0)
+            for option in ["--sharding-mode", "--spend-k-shards", "--sweep-time-budget", "--lazy-revault-depth", "--timelock-base-interval"]:
+                self.assertIn(option, result.output)
+
+        result = CliRunner().invoke(cli, ["estimate", "--no-calibrate", "--num-shards", "40", "--sharding-mode", "hierarchical", "--timelock-stage-size", "4"])
+        self.assertEqual(result.exit_code, 0)
+
+    def test_lazy_imports(self):
+        # The planning code is only imported by the commands that plan.
+        modules = get_imported_modules("import vaults.cli")
+        self.assertEqual(modules.intersection(HEAVY_MODULES), set())
+        self.assertNotIn("vaults.commands.initialize", modules)
+
+        modules = get_imported_modules("import vaults.cli, vaults.commands.info, vaults.commands.broadcast")
+        self.assertEqual(modules.intersection(HEAVY_MODULES), set())
+
+        modules = get_imported_modules("import vaults.commands.initialize")
+        self.assertIn("vaults.planner", modules)
+
+    def test_log_level(self):
+        # The per-transaction messages are only logged at debug.
+        self.assertFalse(logger.isEnabledFor(logging.DEBUG))
+        try:
+            set_log_level("debug")
+            with self.assertLogs(logger, level="DEBUG") as logs:
+                logger.debug("some message %s", "here")
+            self.assertEqual(logs.records[0].getMessage(), "some message here")
+        finally:
+            set_log_level(DEFAULT_LOG_LEVEL)
+        self.assertEqual(logger.level, logging.INFO)
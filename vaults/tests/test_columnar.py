@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from vaults.exceptions import VaultException
+from vaults.models.columnar import ColumnarTree, COLUMNS, SAFETY_RULES
+from vaults.models.script_templates import ShardScriptTemplate
+from vaults.planner import safety_check
+from vaults.signing import sign_transaction_tree
+from vaults.tests.test_signing import make_planned_vault
+
+class ColumnarTreeTests(unittest.TestCase):
+    def assertTreesEqual(self, tree1, tree2):
+        for (column_name, typecode) in COLUMNS:
+            self.assertEqual(getattr(tree1, column_name), getattr(tree2, column_name), column_name)
+        self.assertEqual(tree1.strings, tree2.strings)
+        self.assertEqual(tree1.initial_txid, tree2.initial_txid)
+        self.assertEqual(tree1.vout_overrides, tree2.vout_overrides)
+
+    def test_from_tree(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        (utxos, transactions) = segwit_utxo.crawl()
+
+        tree = ColumnarTree.from_tree(segwit_utxo.transaction)
+        self.assertEqual(len(tree), len(utxos) + len(transactions))
+        self.assertEqual(tree.check_amounts(), [])
+        self.assertEqual(tree.get_depths()[1], 1)
+        self.assertEqual(min(tree.get_depths()), 0)
+
+        # Changing the amount of the user's coin unbalances the transaction
+        # that spends it.
+        tree.amount[1] += 1
+        self.assertEqual(tree.check_amounts(), list(tree.get_children(1)))
+
+    def test_safety_checks(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        tree = ColumnarTree.from_tree(segwit_utxo.transaction)
+
+        results = tree.run_safety_checks()
+        self.assertEqual([result[0] for result in results], [rule_name for (rule_name, method_name) in SAFETY_RULES])
+        self.assertEqual([result[1] for result in results], [[]] * len(SAFETY_RULES))
+
+        some_transaction = tree.get_children(1)[0]
+        tree.input_selections[tree.input_offsets[some_transaction]] = tree.intern_string("cold-wallet")
+        tree.timelock_multiplier[1] = -1
+        tree.amount[1] += 1
+        results = dict([(rule_name, bad_nodes) for (rule_name, bad_nodes, seconds) in tree.run_safety_checks()])
+        self.assertEqual(results["amounts"], [some_transaction])
+        self.assertEqual(results["templates"], [some_transaction])
+        self.assertEqual(results["timelocks"], [1])
+        self.assertEqual(results["outputs"], [])
+        self.assertEqual(results["children"], [])
+
+    def test_safety_check(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        initial_tx = segwit_utxo.transaction
+        results = safety_check(initial_tx)
+        self.assertEqual([result[0] for result in results], ["snapshot"] + [rule_name for (rule_name, method_name) in SAFETY_RULES])
+
+        (utxos, transactions) = segwit_utxo.crawl()
+        shard_utxo = [some_utxo for some_utxo in utxos if some_utxo.script_template == ShardScriptTemplate][0]
+
+        shard_utxo.timelock_multiplier = 100000
+        with self.assertRaisesRegex(VaultException, "timelock multiplier"):
+            safety_check(initial_tx)
+
+        shard_utxo.timelock_multiplier = 1
+        shard_utxo.child_transactions = []
+        with self.assertRaisesRegex(VaultException, "has no child transactions"):
+            safety_check(initial_tx)
+
+    def test_round_trip(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        tree = ColumnarTree.from_tree(segwit_utxo.transaction)
+
+        initial_tx = tree.to_tree()
+        self.assertTreesEqual(ColumnarTree.from_tree(initial_tx), tree)
+
+        # The rebuilt tree signs into the same transactions.
+        sign_transaction_tree(segwit_utxo, parameters)
+        sign_transaction_tree(initial_tx.output_utxos[0], parameters)
+        expected = sorted([(some_transaction.id, some_transaction.txid) for some_transaction in segwit_utxo.crawl()[1]])
+        rebuilt = sorted([(some_transaction.id, some_transaction.txid) for some_transaction in initial_tx.output_utxos[0].crawl()[1]])
+        self.assertEqual(rebuilt, expected)
+
+    def test_save_and_load(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        tree = ColumnarTree.from_tree(segwit_utxo.transaction)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "tree.columnar")
+            tree.save(path)
+            self.assertTreesEqual(ColumnarTree.load(path), tree)
@@ -0,0 +1,71 @@
+import threading
+import unittest
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from bitcoin.core import COIN
+
+from vaults.helpers.formatting import lx
+from vaults.helpers.prototyping import make_parameters
+from vaults.context import PlanContext, get_current_plan_context
+from vaults.models.script_templates import UserScriptTemplate
+from vaults.models.plans import PlannedUTXO, PlannedTransaction, InitialTransaction
+from vaults.planner import setup_vault
+from vaults.signing import sign_transaction_tree
+from vaults.bip119_ctv import make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY
+from vaults.tests.test_signing import PRIVATE_KEY
+
+def plan_vault_in_context(context):
+    """
+    Plan, sign and bake a vault with everything in the given context.
+    """
+    initial_tx = InitialTransaction(txid=lx("cf600e3cfc2cdc01be7563334b33f304ab6466b976e17f66c15228bd81f80007"))
+    with context.activate():
+        segwit_utxo = PlannedUTXO(
+            name="segwit input coin",
+            transaction=initial_tx,
+            script_template=UserScriptTemplate,
+            amount=2 * COIN,
+        )
+    segwit_utxo._vout_override = 0
+    initial_tx.output_utxos = [segwit_utxo]
+
+    setup_vault(segwit_utxo, context=context)
+    sign_transaction_tree(segwit_utxo, context=context)
+    make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, context=context)
+
+    (utxos, transactions) = segwit_utxo.crawl()
+    transactions = sorted([some_transaction for some_transaction in transactions if some_transaction.id != -1], key=lambda tx: tx.id)
+    return [(some_transaction.id, some_transaction.txid, some_transaction.ctv_bitcoin_transaction.GetTxid()) for some_transaction in transactions]
+
+class PlanContextTests(unittest.TestCase):
+    def test_ids_come_from_the_context(self):
+        context = PlanContext()
+        utxo_counter = PlannedUTXO.__counter__
+        with context.activate():
+            self.assertEqual(get_current_plan_context(), context)
+            planned_transaction = PlannedTransaction(name="some transaction")
+            planned_utxo = PlannedUTXO(name="some UTXO")
+        self.assertEqual(get_current_plan_context(), None)
+
+        # The CPFP hook UTXO came first.
+        self.assertEqual((planned_transaction.id, planned_utxo.id), (0, 1))
+        self.assertEqual(context.count("PlannedUTXO"), 2)
+        self.assertEqual(PlannedUTXO.__counter__, utxo_counter)
+
+    def test_concurrent_planning(self):
+        expected = plan_vault_in_context(PlanContext(parameters=make_parameters(PRIVATE_KEY, num_shards=4)))
+
+        results = [None] * 4
+        def plan(idx):
+            results[idx] = plan_vault_in_context(PlanContext(parameters=make_parameters(PRIVATE_KEY, num_shards=4)))
+
+        threads = [threading.Thread(target=plan, args=(idx,)) for idx in range(len(results))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for result in results:
+            self.assertEqual(result, expected)
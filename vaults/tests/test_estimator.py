@@ -0,0 +1,62 @@
+import unittest
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from vaults.exceptions import VaultException
+from vaults.estimator import estimate, estimate_tree_size
+from vaults.commands.estimate import estimate_vault, format_bytes
+from vaults.tests.test_signing import make_planned_vault, PRIVATE_KEY
+
+class EstimateTreeSizeTests(unittest.TestCase):
+    def assertEstimateMatchesPlan(self, num_shards, **extra_parameters):
+        (segwit_utxo, parameters) = make_planned_vault(num_shards, **extra_parameters)
+        (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+
+        result = estimate_tree_size(parameters)
+        self.assertEqual((result["transactions"], result["utxos"]), (len(planned_transactions), len(planned_utxos)), extra_parameters)
+        self.assertTrue(result["exact"])
+
+    def test_flat(self):
+        self.assertEstimateMatchesPlan(5)
+        self.assertEstimateMatchesPlan(10, enable_burn_transactions=False)
+        self.assertEstimateMatchesPlan(10, timelock_stage_size=3)
+
+    def test_hierarchical(self):
+        self.assertEstimateMatchesPlan(17, sharding_mode="hierarchical")
+        self.assertEstimateMatchesPlan(40, sharding_mode="hierarchical", shard_group_size=3)
+
+    def test_sweeps_and_budgets(self):
+        self.assertEstimateMatchesPlan(10, enable_sweeps=True, max_sweep_transactions=33)
+        self.assertEstimateMatchesPlan(12, enable_sweeps=True, timelock_stage_size=5, spend_k_shards=[4])
+        self.assertEstimateMatchesPlan(10, spend_k_shards=[2, 3], max_planned_transactions=900, enable_sweeps=True)
+        self.assertEstimateMatchesPlan(20, sharding_mode="hierarchical", shard_group_size=4, spend_k_shards=[2], max_planned_transactions=3000)
+
+    def test_over_budget(self):
+        (segwit_utxo, parameters) = make_planned_vault(5)
+        parameters["max_planned_transactions"] = 10
+        with self.assertRaises(VaultException):
+            estimate_tree_size(parameters)
+
+    def test_time_budget_is_not_exact(self):
+        (segwit_utxo, parameters) = make_planned_vault(3, enable_sweeps=True, sweep_time_budget=10)
+        self.assertFalse(estimate_tree_size(parameters)["exact"])
+
+class EstimateTests(unittest.TestCase):
+    def test_calibrated_estimate(self):
+        (segwit_utxo, parameters) = make_planned_vault(3)
+        parameters["num_shards"] = 100
+
+        result = estimate(parameters)
+        self.assertEqual(result["transactions"], 10702)
+        for some_name in ["planning_seconds", "signing_seconds", "ctv_baking_seconds", "transaction_store_bytes", "ctv_transaction_store_bytes"]:
+            self.assertGreater(result[some_name], 0)
+
+    def test_estimate_vault(self):
+        output = estimate_vault(PRIVATE_KEY, num_shards=100, calibrate=False)
+        self.assertIn("transactions: 10702", output)
+
+    def test_format_bytes(self):
+        self.assertEqual(format_bytes(12), "12 bytes")
+        self.assertEqual(format_bytes(1536), "1.5 KB")
+        self.assertEqual(format_bytes(3 * 1024 * 1024), "3.0 MB")
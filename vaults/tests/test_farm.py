@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from bitcoin.core import COIN
+from bitcoin.core.script import CScript, OP_0, Hash160
+
+from vaults.helpers.formatting import lx
+from vaults.exceptions import VaultException
+from vaults.helpers.prototyping import make_parameters
+from vaults.persist import save_farm, load_farm
+from vaults.commands.farm import make_funding_transaction, estimate_funding_transaction_fee, build_farm_vaults
+from vaults.tests.test_signing import PRIVATE_KEY
+
+FUNDING_TXID = lx("cf600e3cfc2cdc01be7563334b33f304ab6466b976e17f66c15228bd81f80007")
+
+def make_user_scriptpubkey():
+    parameters = make_parameters(PRIVATE_KEY, num_shards=2)
+    return CScript([OP_0, Hash160(parameters["user_key"]["public_key"])])
+
+class FarmTests(unittest.TestCase):
+    def test_funding_transaction(self):
+        funding_transaction = make_funding_transaction(FUNDING_TXID, 1, 50 * COIN, make_user_scriptpubkey(), num_vaults=7)
+        self.assertEqual(len(funding_transaction.vin), 1)
+        self.assertEqual(len(funding_transaction.vout), 7)
+        self.assertEqual(len(set([some_output.nValue for some_output in funding_transaction.vout])), 1)
+
+        fee = 50 * COIN - sum([some_output.nValue for some_output in funding_transaction.vout])
+        self.assertTrue(fee >= estimate_funding_transaction_fee(7))
+        self.assertTrue(fee < estimate_funding_transaction_fee(7) + 7)
+
+    def test_funding_transaction_too_small(self):
+        with self.assertRaises(VaultException):
+            make_funding_transaction(FUNDING_TXID, 0, 100, make_user_scriptpubkey(), num_vaults=3)
+
+    def test_build_and_store_vaults(self):
+        amount = 2 * COIN
+        tasks = [(PRIVATE_KEY, 2, FUNDING_TXID, vout, amount, {}) for vout in range(2)]
+
+        results = build_farm_vaults(tasks, processes=2)
+        self.assertEqual([result[0] for result in results], [0, 1])
+        self.assertEqual([result[2] for result in results], [0, 0])
+
+        # Serially planned vaults are the same (signatures aside).
+        serial_results = build_farm_vaults(tasks[1:], processes=1)
+        get_txids = lambda transaction_dicts: [data.get("txid", None) for data in transaction_dicts]
+        self.assertEqual(get_txids(serial_results[0][1]), get_txids(results[1][1]))
+        self.assertEqual(serial_results[0][2], results[1][2])
+        self.assertNotEqual(get_txids(results[0][1])[1], get_txids(results[1][1])[1])
+
+        # Vaults with the same amount don't share internal ids, but planning
+        # a vault again gives the same ids.
+        get_internal_ids = lambda transaction_dicts: [data.get("internal_id", None) for data in transaction_dicts[1:]]
+        self.assertEqual(set(get_internal_ids(results[0][1])) & set(get_internal_ids(results[1][1])), set())
+        self.assertEqual(get_internal_ids(serial_results[0][1]), get_internal_ids(results[1][1]))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "farm-store.json")
+            current_directory = os.getcwd()
+            os.chdir(directory)
+            try:
+                save_farm(FUNDING_TXID, [(vout, transaction_dicts) for (vout, transaction_dicts, num_failures) in results])
+            finally:
+                os.chdir(current_directory)
+
+            initial_transactions = load_farm(path=path)
+
+        self.assertEqual(sorted(initial_transactions.keys()), [0, 1])
+        for (vout, initial_tx) in initial_transactions.items():
+            segwit_utxo = initial_tx.output_utxos[0]
+            self.assertEqual(segwit_utxo.vout, vout)
+            self.assertEqual(initial_tx.txid, FUNDING_TXID)
@@ -0,0 +1,76 @@
+import os
+import re
+import tempfile
+import unittest
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from vaults.exceptions import VaultException
+from vaults.graphics import iter_dot_lines, generate_graphviz
+from vaults.tests.test_signing import make_planned_vault
+
+NODE_PATTERN = re.compile(r'^\t"([^"]+)" \[label=')
+EDGE_PATTERN = re.compile(r'^\t"([^"]+)" -> "([^"]+)";$')
+
+def parse_dot_lines(lines):
+    """
+    Get the node ids and the edges of a dotfile written by iter_dot_lines.
+    """
+    nodes = set()
+    edges = []
+    for line in lines:
+        match = NODE_PATTERN.match(line)
+        if match:
+            nodes.add(match.group(1))
+            continue
+        match = EDGE_PATTERN.match(line.rstrip("\n"))
+        if match:
+            edges.append((match.group(1), match.group(2)))
+    return (nodes, edges)
+
+class GraphvizTests(unittest.TestCase):
+    def test_full_graph(self):
+        (segwit_utxo, parameters) = make_planned_vault(3)
+        lines = list(iter_dot_lines(segwit_utxo.transaction, collapse=False))
+        self.assertEqual(lines[0], "digraph output {\n")
+        self.assertEqual(lines[-1], "}\n")
+
+        (utxos, transactions) = segwit_utxo.crawl()
+        (nodes, edges) = parse_dot_lines(lines)
+        self.assertEqual(len(nodes), len(utxos) + len(transactions))
+        for (start, end) in edges:
+            self.assertIn(start, nodes)
+            self.assertIn(end, nodes)
+
+    def test_collapsed_graph(self):
+        (segwit_utxo, parameters) = make_planned_vault(3)
+        (nodes, edges) = parse_dot_lines(iter_dot_lines(segwit_utxo.transaction, collapse=False))
+
+        lines = list(iter_dot_lines(segwit_utxo.transaction))
+        (collapsed_nodes, collapsed_edges) = parse_dot_lines(lines)
+        self.assertTrue(len(collapsed_nodes) < len(nodes) / 2)
+        self.assertFalse(any('"CPFP hook"' in line for line in lines))
+        self.assertTrue(any("shape=box3d" in line for line in lines))
+        for (start, end) in collapsed_edges:
+            self.assertIn(end, collapsed_nodes)
+
+    def test_depth_and_focus(self):
+        (segwit_utxo, parameters) = make_planned_vault(3)
+        funding_transaction = segwit_utxo.child_transactions[0]
+
+        lines = list(iter_dot_lines(segwit_utxo, focus=funding_transaction.internal_id, max_depth=1))
+        (nodes, edges) = parse_dot_lines(lines)
+        self.assertEqual(nodes, set([str(funding_transaction.internal_id), str(funding_transaction.output_utxos[1].internal_id)]))
+        self.assertTrue(any("style=dashed" in line for line in lines))
+
+        with self.assertRaises(VaultException):
+            list(iter_dot_lines(segwit_utxo, focus="not-an-internal-id"))
+
+    def test_generate_graphviz(self):
+        (segwit_utxo, parameters) = make_planned_vault(3)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "output.gv")
+            self.assertEqual(generate_graphviz(segwit_utxo, parameters, output_filename=path), path)
+            with open(path, "r") as fd:
+                self.assertEqual(fd.read(), "".join(iter_dot_lines(segwit_utxo)))
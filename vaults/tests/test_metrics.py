@@ -0,0 +1,63 @@
+import os
+import json
+import tempfile
+import unittest
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from vaults.metrics import PhaseRecorder, COUNTERS, count
+from vaults.signing import sign_transaction_tree
+from vaults.bip119_ctv import make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY
+from vaults.tests.test_signing import make_planned_vault
+
+class PhaseRecorderTests(unittest.TestCase):
+    def test_counts(self):
+        (segwit_utxo, parameters) = make_planned_vault(3)
+        recorder = PhaseRecorder()
+        with recorder.phase("nothing"):
+            pass
+        with recorder.phase("sign_transaction_tree"):
+            sign_transaction_tree(segwit_utxo, parameters)
+        with recorder.phase("ctv conversion"):
+            make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(segwit_utxo.transaction, parameters=parameters)
+
+        (nothing, signing, ctv) = recorder.phases
+        self.assertEqual(nothing.counts, dict([(name, 0) for name in COUNTERS]))
+        self.assertGreater(signing.counts["signatures"], 0)
+        self.assertEqual(signing.counts["signatures"], signing.counts["sighashes"])
+        self.assertEqual(signing.counts["ctv_hashes"], 0)
+        self.assertGreater(ctv.counts["ctv_hashes"], 0)
+        self.assertEqual(ctv.counts["signatures"], 0)
+        self.assertEqual(signing.peak_memory, None)
+
+    def test_save(self):
+        recorder = PhaseRecorder(trace_memory=True)
+        recorder.values["num_shards"] = 3
+        with recorder.phase("allocate") as phase:
+            data = [bytes(1000) for idx in range(100)]
+            count("rpc_calls", 2)
+            phase.values["items"] = len(data)
+        recorder.stop()
+
+        self.assertGreater(recorder.phases[0].peak_memory, 100 * 1000)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, "profile.json")
+            recorder.save(filename=filename)
+            with open(filename, "r") as fd:
+                report = json.load(fd)
+
+        self.assertEqual(report["values"], {"num_shards": 3})
+        self.assertEqual(report["phases"][0]["name"], "allocate")
+        self.assertEqual(report["phases"][0]["values"], {"items": 100})
+        self.assertEqual(report["totals"]["counts"]["rpc_calls"], 2)
+        self.assertEqual(report["totals"]["peak_memory"], recorder.phases[0].peak_memory)
+
+        output = recorder.format_report()
+        self.assertIn("allocate", output)
+        self.assertIn("allocate items: 100", output)
+        self.assertIn("num_shards: 3", output)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -52,6 +52,37 @@ class AbstractPlanningTests(unittest.TestCase):
         del utxo1
         self.assertEqual(counter_end - counter_start, 1)
 
+    def test_planned_utxo_slots(self):
+        utxo = PlannedUTXO(name="some UTXO")
+        self.assertFalse(hasattr(utxo, "__dict__"))
+        with self.assertRaises(AttributeError):
+            utxo.some_undeclared_attribute = True
+
+    def test_internal_id_is_lazy(self):
+        planned_transaction = PlannedTransaction(name="name goes here")
+        self.assertEqual(planned_transaction._internal_id, None)
+
+        internal_id = planned_transaction.internal_id
+        self.assertEqual(planned_transaction.internal_id, internal_id)
+
+        planned_transaction.internal_id = "some-other-id"
+        self.assertEqual(planned_transaction.internal_id, "some-other-id")
+
+    def test_internal_ids_are_deterministic(self):
+        from vaults.tests.test_signing import make_planned_vault
+
+        internal_ids = []
+        for attempt in range(2):
+            (segwit_utxo, parameters) = make_planned_vault(4)
+            (utxos, transactions) = segwit_utxo.crawl()
+            some_ids = [str(some_utxo.internal_id) for some_utxo in utxos]
+            some_ids.extend([str(some_transaction.internal_id) for some_transaction in transactions])
+            some_ids.extend([str(some_input.internal_id) for some_transaction in transactions for some_input in some_transaction.inputs])
+            internal_ids.append(sorted(some_ids))
+
+        self.assertEqual(internal_ids[0], internal_ids[1])
+        self.assertEqual(len(set(internal_ids[0])), len(internal_ids[0]))
+
     def test_planned_transaction_cpfp_hook_utxo(self):
         planned_transaction = PlannedTransaction(name="name goes here")
         self.assertEqual(len(planned_transaction.output_utxos), 1)
@@ -0,0 +1,320 @@
+import os
+import tempfile
+import unittest
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from vaults.exceptions import VaultException
+from vaults.models.script_templates import ShardScriptTemplate
+from vaults.models.columnar import ColumnarTree
+from vaults.planner import (
+    get_shard_group_size,
+    update_vault_parameters,
+    count_push_to_cold_storage_transactions,
+    count_sharding_transactions,
+    count_sweep_transactions,
+    count_one_shard_possible_spend_transactions,
+    add_node_counts,
+    count_push_to_cold_storage_nodes,
+    count_sharding_nodes,
+    count_one_shard_possible_spend_nodes,
+)
+from vaults.helpers.formatting import b2lx
+from vaults.config import CTV_TRANSACTION_STORE_FILENAME
+from vaults.persist import save, load, to_dict, from_dict
+from vaults.state import load_current_state, get_txid
+from vaults.bip119_ctv import (
+    make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY,
+    materialize_revault_stub,
+    get_revault_stub_template_hashes,
+)
+from vaults.estimator import estimate_tree_size
+from vaults.validation import validate_transaction_tree
+from vaults.signing import sign_transaction_tree
+from vaults.tests.test_signing import make_planned_vault
+
+class ConfirmedTransactions(object):
+    """
+    Stands in for the bitcoind connection, with only the given txids
+    confirmed.
+    """
+
+    def __init__(self, txids):
+        self.txids = set([b2lx(txid) for txid in txids])
+
+    def _call(self, method, txid, verbose):
+        return {"confirmations": 1 if txid in self.txids else 0}
+
+class HierarchicalShardingTests(unittest.TestCase):
+    def test_group_size(self):
+        self.assertEqual(get_shard_group_size(1000), 10)
+        self.assertEqual(get_shard_group_size(1), 2)
+        self.assertEqual(get_shard_group_size(1000, parameters={"shard_group_size": 32}), 32)
+
+    def test_smaller_tree(self):
+        (flat_utxo, flat_parameters) = make_planned_vault(16)
+        (segwit_utxo, parameters) = make_planned_vault(16, sharding_mode="hierarchical", shard_group_size=4)
+
+        (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+        self.assertLess(len(planned_transactions), len(flat_utxo.crawl()[1]))
+
+        tree = ColumnarTree.from_tree(segwit_utxo.transaction)
+        self.assertEqual(tree.check_amounts(), [])
+
+        # The vault UTXO splits into 4 groups, each timelocked one interval
+        # past its first shard's multiplier (never zero).
+        vault_initial_utxo = segwit_utxo.child_transactions[0].output_utxos[1]
+        split_transaction = [child for child in vault_initial_utxo.child_transactions if child.name == "Vault group split transaction."][0]
+        group_utxos = split_transaction.output_utxos[1:]
+        self.assertEqual([group_utxo.timelock_multiplier for group_utxo in group_utxos], [1, 5, 9, 13])
+        self.assertEqual(group_utxos[1].name, "vault group UTXO (shards 5-8)")
+
+        # Each group has its own sharding and re-vault transactions.
+        for group_utxo in group_utxos:
+            names = [child.name for child in group_utxo.child_transactions]
+            self.assertIn("Vault stipend start transaction.", names)
+            self.assertIn("Vault transaction: spend one shard, re-vault the remaining shards", names)
+
+            sharding_transaction = group_utxo.child_transactions[names.index("Vault stipend start transaction.")]
+            shards = [some_utxo for some_utxo in sharding_transaction.output_utxos if some_utxo.script_template == ShardScriptTemplate]
+            self.assertEqual(len(shards), 4)
+
+    def test_presigned_tree_is_valid(self):
+        # Every group UTXO has a non-zero timelock on its presigned spend.
+        for shard_group_size in [2, 4]:
+            (segwit_utxo, parameters) = make_planned_vault(8, sharding_mode="hierarchical", shard_group_size=shard_group_size)
+            sign_transaction_tree(segwit_utxo, parameters)
+            self.assertEqual(validate_transaction_tree(segwit_utxo, processes=1), [])
+
+    def test_unknown_sharding_mode(self):
+        with self.assertRaises(VaultException):
+            make_planned_vault(3, sharding_mode="something")
+
+    def test_sharding_mode_is_fixed(self):
+        (segwit_utxo, parameters) = make_planned_vault(4, sharding_mode="hierarchical", shard_group_size=2)
+        with self.assertRaises(VaultException):
+            update_vault_parameters(segwit_utxo, parameters, {"sharding_mode": "flat"})
+
+    def test_save_and_load(self):
+        (segwit_utxo, parameters) = make_planned_vault(9, sharding_mode="hierarchical", shard_group_size=3)
+        sign_transaction_tree(segwit_utxo, parameters)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "transaction-store.json")
+            save(segwit_utxo, filename=path)
+            initial_tx = load(path=path)
+
+        (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+        (loaded_utxos, loaded_transactions) = initial_tx.output_utxos[0].crawl()
+        self.assertEqual(len(loaded_transactions), len(planned_transactions))
+
+        # Child transactions are reconnected once each, in the saved order.
+        for (some_utxo, loaded_utxo) in zip(sorted(planned_utxos, key=lambda utxo: utxo.id), sorted(loaded_utxos, key=lambda utxo: utxo.id)):
+            self.assertEqual([child.id for child in loaded_utxo.child_transactions], [child.id for child in some_utxo.child_transactions])
+
+class SpendKShardsTests(unittest.TestCase):
+    def test_count_helpers(self):
+        for extra_parameters in [{}, {"enable_burn_transactions": False}, {"timelock_stage_size": 3}]:
+            (segwit_utxo, parameters) = make_planned_vault(10, **extra_parameters)
+            (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+
+            # funding transaction, push-to-cold-storage, sharding, re-vault paths
+            expected = 1 + count_push_to_cold_storage_transactions(parameters) + count_sharding_transactions(10, parameters) + count_one_shard_possible_spend_transactions(10, parameters)
+            # The crawl includes the initial transaction.
+            self.assertEqual(len(planned_transactions), expected + 1)
+
+    def test_count_node_helpers(self):
+        for extra_parameters in [{}, {"enable_burn_transactions": False}, {"timelock_stage_size": 3}, {"lazy_revault_depth": 2}]:
+            (segwit_utxo, parameters) = make_planned_vault(10, **extra_parameters)
+
+            # the initial transaction and the user's coin, the funding
+            # transaction and its CPFP hook, the vault initial UTXO
+            expected = add_node_counts((2, 2), (1, 0), count_push_to_cold_storage_nodes(parameters), count_sharding_nodes(10, parameters), count_one_shard_possible_spend_nodes(10, parameters))
+            self.assertEqual(segwit_utxo.count_nodes(), expected)
+
+    def test_spend_k_shards(self):
+        (segwit_utxo, parameters) = make_planned_vault(10, spend_k_shards=[3])
+
+        vault_initial_utxo = segwit_utxo.child_transactions[0].output_utxos[1]
+        names = [child.name for child in vault_initial_utxo.child_transactions]
+        self.assertIn("Vault transaction: spend 3 shards, re-vault the remaining shards", names)
+
+        spend_transaction = vault_initial_utxo.child_transactions[names.index("Vault transaction: spend 3 shards, re-vault the remaining shards")]
+        (exiting_utxo, revault_utxo) = spend_transaction.output_utxos[1:]
+        self.assertEqual(exiting_utxo.script_template, ShardScriptTemplate)
+        self.assertEqual(revault_utxo.amount, 7 * (vault_initial_utxo.amount // 10))
+        self.assertEqual(exiting_utxo.amount + revault_utxo.amount, vault_initial_utxo.amount)
+
+        tree = ColumnarTree.from_tree(segwit_utxo.transaction)
+        self.assertEqual(tree.check_amounts(), [])
+
+    def test_budget(self):
+        (segwit_utxo, parameters) = make_planned_vault(10)
+        base_count = len(segwit_utxo.crawl()[1])
+
+        for budget in [base_count, base_count + 50, base_count + 500]:
+            (segwit_utxo, parameters) = make_planned_vault(10, spend_k_shards=[2, 4], max_planned_transactions=budget)
+            count = len(segwit_utxo.crawl()[1])
+            self.assertLessEqual(count, budget)
+            self.assertGreater(count + 10, budget)
+
+        with self.assertRaises(VaultException):
+            make_planned_vault(10, spend_k_shards=[2], max_planned_transactions=base_count - 1)
+
+class SweepTests(unittest.TestCase):
+    def get_sweep_transactions(self, segwit_utxo):
+        (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+        return [some_transaction for some_transaction in planned_transactions if some_transaction.name == "Sharded UTXO sweep transaction"]
+
+    def test_sweeps(self):
+        (segwit_utxo, parameters) = make_planned_vault(5, enable_sweeps=True)
+        (base_utxo, base_parameters) = make_planned_vault(5)
+
+        vault_initial_utxo = segwit_utxo.child_transactions[0].output_utxos[1]
+        sharding_transaction = [child for child in vault_initial_utxo.child_transactions if child.name == "Vault stipend start transaction."][0]
+        shard_utxos = sharding_transaction.output_utxos[1:]
+
+        # One sweep for each telescoping subset of the shards, each with one
+        # cold storage output.
+        self.assertEqual([len(shard_utxo.child_transactions) for shard_utxo in shard_utxos], [2, 3, 4, 5, 5])
+        sweep_transaction = shard_utxos[0].child_transactions[1]
+        self.assertEqual(len(sweep_transaction.inputs), 5)
+        self.assertEqual(sweep_transaction.output_utxos[1].amount, vault_initial_utxo.amount)
+
+        # Every sharding transaction (5 shards, then 4, 3 and 2 on the
+        # re-vault path) gets sweeps.
+        expected = sum([count_sweep_transactions(num_shards, parameters) for num_shards in range(2, 6)])
+        self.assertEqual(len(segwit_utxo.crawl()[1]) - len(base_utxo.crawl()[1]), expected)
+
+        tree = ColumnarTree.from_tree(segwit_utxo.transaction)
+        self.assertEqual(tree.check_amounts(), [])
+
+    def test_sweep_budget(self):
+        (segwit_utxo, parameters) = make_planned_vault(5, enable_sweeps=True, max_sweep_transactions=10)
+        sweep_transactions = self.get_sweep_transactions(segwit_utxo)
+
+        # sweep and burn transactions
+        self.assertEqual(len(sweep_transactions) * 2, 10)
+
+        # The shallowest sharding transaction gets all of its sweeps first.
+        vault_initial_utxo = segwit_utxo.child_transactions[0].output_utxos[1]
+        sharding_transaction = [child for child in vault_initial_utxo.child_transactions if child.name == "Vault stipend start transaction."][0]
+        self.assertEqual(len(sharding_transaction.output_utxos[-1].child_transactions), 5)
+
+class LazyRevaultTests(unittest.TestCase):
+    def make_baked_vault(self, num_shards, **extra_parameters):
+        (segwit_utxo, parameters) = make_planned_vault(num_shards, **extra_parameters)
+        sign_transaction_tree(segwit_utxo, parameters)
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(segwit_utxo.transaction, parameters=parameters)
+        return (segwit_utxo, parameters)
+
+    def get_stub_utxos(self, segwit_utxo):
+        (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+        return [some_utxo for some_utxo in planned_utxos if some_utxo.revault_stub != None]
+
+    def test_lazy_tree(self):
+        (segwit_utxo, parameters) = self.make_baked_vault(6, lazy_revault_depth=1)
+        (eager_utxo, eager_parameters) = self.make_baked_vault(6)
+
+        self.assertLess(segwit_utxo.count_nodes()[1], eager_utxo.count_nodes()[1])
+
+        estimate = estimate_tree_size(parameters)
+        self.assertEqual(segwit_utxo.count_nodes(), (estimate["utxos"], estimate["transactions"]))
+
+        # The second re-vault UTXO is a stub for the remaining 4 shards.
+        stub_utxos = self.get_stub_utxos(segwit_utxo)
+        self.assertEqual([(stub_utxo.revault_stub.num_shards, stub_utxo.revault_stub.depth) for stub_utxo in stub_utxos], [(4, 2)])
+
+        # The vault commits to the same OP_CHECKTEMPLATEVERIFY tree either
+        # way.
+        vault_initial_utxo = segwit_utxo.child_transactions[0].output_utxos[1]
+        eager_vault_initial_utxo = eager_utxo.child_transactions[0].output_utxos[1]
+        self.assertEqual(vault_initial_utxo.ctv_scriptpubkey, eager_vault_initial_utxo.ctv_scriptpubkey)
+
+    def test_stub_original_num_shards(self):
+        (segwit_utxo, parameters) = make_planned_vault(6, lazy_revault_depth=2)
+        stub_utxos = self.get_stub_utxos(segwit_utxo)
+        self.assertEqual([(stub_utxo.revault_stub.num_shards, stub_utxo.revault_stub.original_num_shards) for stub_utxo in stub_utxos], [(3, 6)])
+
+        # Each group's re-vault chain starts from the group's shard count.
+        (segwit_utxo, parameters) = make_planned_vault(9, lazy_revault_depth=1, sharding_mode="hierarchical", shard_group_size=3)
+        stub_utxos = self.get_stub_utxos(segwit_utxo)
+        self.assertEqual([(stub_utxo.revault_stub.num_shards, stub_utxo.revault_stub.original_num_shards) for stub_utxo in stub_utxos], [(1, 3)] * 3)
+
+    def test_parallel_template_hashes(self):
+        template_hashes = []
+        for processes in [1, 2]:
+            (segwit_utxo, parameters) = make_planned_vault(6, lazy_revault_depth=0)
+            stub_utxo = self.get_stub_utxos(segwit_utxo)[0]
+            get_revault_stub_template_hashes(stub_utxo, parameters=parameters, processes=processes)
+            template_hashes.append(stub_utxo.revault_stub.template_hashes)
+
+        self.assertEqual(len(template_hashes[0]), 5)
+        self.assertEqual(template_hashes[0], template_hashes[1])
+
+    def test_materialize(self):
+        (segwit_utxo, parameters) = self.make_baked_vault(5, lazy_revault_depth=0)
+        funding_transaction = segwit_utxo.child_transactions[0]
+
+        stub_utxo = self.get_stub_utxos(segwit_utxo)[0]
+        new_transactions = materialize_revault_stub(stub_utxo, parameters)
+        self.assertEqual([some_transaction.name for some_transaction in new_transactions], ["Vault (partial) stipend start transaction.", "Vault transaction: spend one shard, re-vault the remaining shards"])
+        self.assertEqual(stub_utxo.revault_stub, None)
+
+        next_stub_utxo = self.get_stub_utxos(segwit_utxo)[0]
+        self.assertEqual(next_stub_utxo.revault_stub.num_shards, 3)
+
+        failures = validate_transaction_tree(segwit_utxo, ctv=True, processes=1)
+        self.assertEqual([failure["internal_id"] for failure in failures], [str(funding_transaction.internal_id)])
+
+    def test_load_current_state(self):
+        (segwit_utxo, parameters) = self.make_baked_vault(4, lazy_revault_depth=0)
+        funding_transaction = segwit_utxo.child_transactions[0]
+        vault_initial_utxo = funding_transaction.output_utxos[1]
+        spend_transaction = [some_transaction for some_transaction in vault_initial_utxo.child_transactions if some_transaction.name.startswith("Vault transaction: spend one shard")][0]
+
+        confirmed_txids = [segwit_utxo.transaction.txid] + [get_txid(some_transaction, ctv=True) for some_transaction in [funding_transaction, spend_transaction]]
+        connection = ConfirmedTransactions(confirmed_txids)
+
+        with tempfile.TemporaryDirectory() as directory:
+            current_directory = os.getcwd()
+            os.chdir(directory)
+            try:
+                save(segwit_utxo, filename=CTV_TRANSACTION_STORE_FILENAME)
+
+                # The re-vault UTXO of the confirmed spend is a stub, so its
+                # child transactions get planned, and saved.
+                latest_info = load_current_state(connection=connection, ctv=True)
+                self.assertEqual(str(latest_info["current"].internal_id), str(spend_transaction.internal_id))
+                next_transactions = sorted([(some_transaction.name, str(some_transaction.internal_id)) for some_transaction in latest_info["next"]])
+                self.assertIn("Vault (partial) stipend start transaction.", [name for (name, internal_id) in next_transactions])
+
+                initial_tx = load(transaction_store_filename=CTV_TRANSACTION_STORE_FILENAME)
+                stub_utxos = self.get_stub_utxos(initial_tx.output_utxos[0])
+                self.assertEqual([stub_utxo.revault_stub.num_shards for stub_utxo in stub_utxos], [2])
+
+                latest_info = load_current_state(connection=connection, ctv=True)
+                self.assertEqual(sorted([(some_transaction.name, str(some_transaction.internal_id)) for some_transaction in latest_info["next"]]), next_transactions)
+            finally:
+                os.chdir(current_directory)
+
+    def test_materialize_after_load(self):
+        (segwit_utxo, parameters) = self.make_baked_vault(4, lazy_revault_depth=0)
+
+        initial_tx = from_dict(to_dict(segwit_utxo))
+        stub_utxo = self.get_stub_utxos(initial_tx.output_utxos[0])[0]
+        self.assertNotIn("private_key", stub_utxo.revault_stub.parameters["cold_key1"])
+
+        new_transactions = materialize_revault_stub(stub_utxo)
+        self.assertEqual(len(new_transactions), 2)
+        self.assertTrue(all([some_transaction.ctv_baked for some_transaction in new_transactions]))
+
+        # A subtree that doesn't match what the vault committed to is
+        # rejected.
+        initial_tx = from_dict(to_dict(segwit_utxo))
+        stub_utxo = self.get_stub_utxos(initial_tx.output_utxos[0])[0]
+        stub_utxo.revault_stub.per_shard_amount -= 1
+        stub_utxo.revault_stub.template_hashes = None
+        with self.assertRaises(VaultException):
+            materialize_revault_stub(stub_utxo)
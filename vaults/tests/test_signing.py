@@ -0,0 +1,374 @@
+import os
+import json
+import tempfile
+import unittest
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from bitcoin.core import COIN
+from bitcoin.core.script import SignatureHash, SIGHASH_ALL, SIGVERSION_WITNESS_V0
+
+from vaults.helpers.formatting import lx
+from vaults.exceptions import VaultException
+from vaults.helpers.prototyping import make_parameters, make_private_keys
+from vaults.models.script_templates import UserScriptTemplate
+from vaults.models.plans import PlannedUTXO, InitialTransaction
+from vaults.planner import setup_vault, update_vault_parameters, top_up_vault
+from vaults.signing import sign_transaction_tree, get_witness_sighash_midstate, get_witness_signature_hash
+from vaults.validation import validate_transaction_tree
+from vaults.bip119_ctv import make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY, load_baked_scripts
+from vaults.commands.topup import get_vault_parameters
+from vaults.persist import load, to_dict, from_dict, save_from_journal, save_parameters, fingerprint_parameters, fingerprint_plan, TransactionJournal, PlanCache
+
+PRIVATE_KEY = "cUB8G5cFtxc4usfgfovqRgCo8qTQUJtctLV8t6YYNfULg3GtehdX"
+
+def make_planned_vault(num_shards=3, **extra_parameters):
+    """
+    Plan a vault on top of a placeholder user transaction, without bitcoind.
+    """
+    parameters = make_parameters(PRIVATE_KEY, num_shards=num_shards)
+    parameters.update(extra_parameters)
+
+    initial_tx = InitialTransaction(txid=lx("cf600e3cfc2cdc01be7563334b33f304ab6466b976e17f66c15228bd81f80007"))
+    segwit_utxo = PlannedUTXO(
+        name="segwit input coin",
+        transaction=initial_tx,
+        script_template=UserScriptTemplate,
+        amount=2 * COIN,
+    )
+    segwit_utxo._vout_override = 0
+    initial_tx.output_utxos = [segwit_utxo]
+
+    setup_vault(segwit_utxo, parameters)
+    return (segwit_utxo, parameters)
+
+class TransactionJournalTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.tempdir.name, "transaction-store.journal")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def sign_with_journal(self, segwit_utxo, parameters):
+        fingerprint = fingerprint_parameters(parameters, segwit_utxo=segwit_utxo)
+        journal = TransactionJournal(path=self.journal_path, fingerprint=fingerprint)
+        sign_transaction_tree(segwit_utxo, parameters, journal=journal)
+        return journal
+
+    def test_journal_matches_transaction_tree(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        journal = self.sign_with_journal(segwit_utxo, parameters)
+
+        store_path = os.path.join(self.tempdir.name, "transaction-store.json")
+        save_from_journal(journal, filename=store_path)
+        journal.close()
+
+        (utxos, transactions) = segwit_utxo.crawl()
+        with open(store_path, "r") as fd:
+            self.assertEqual(len(json.loads(fd.read())), len(transactions))
+
+        initial_tx = load(path=store_path)
+        self.assertEqual(type(initial_tx), InitialTransaction)
+        self.assertEqual(str(initial_tx.output_utxos[0].internal_id), str(segwit_utxo.internal_id))
+
+    def test_resume_after_interruption(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        journal = self.sign_with_journal(segwit_utxo, parameters)
+        journal.close()
+
+        expected_txids = dict([(str(transaction.internal_id), transaction.txid) for transaction in segwit_utxo.crawl()[1]])
+
+        # Pretend that the process died: keep the plan and some of the signed
+        # transactions, and leave a torn record at the end.
+        with open(self.journal_path, "r") as fd:
+            lines = fd.readlines()
+        with open(self.journal_path, "w") as fd:
+            fd.writelines(lines[:10])
+            fd.write(lines[10][:20])
+
+        # A new run plans the same tree from scratch, and only signs whatever
+        # is missing from the journal.
+        (segwit_utxo, parameters) = make_planned_vault()
+        journal = self.sign_with_journal(segwit_utxo, parameters)
+        self.assertEqual(len(journal.checkpoints), 9)
+
+        resumed_txids = dict([(str(transaction.internal_id), transaction.txid) for transaction in segwit_utxo.crawl()[1]])
+        self.assertEqual(resumed_txids, expected_txids)
+
+        with open(self.journal_path, "r") as fd:
+            records = [json.loads(line) for line in fd]
+        ranks = [record["rank"] for record in records if record["type"] == "transaction"]
+        self.assertEqual(ranks, list(range(0, len(expected_txids))))
+        journal.close()
+
+    def test_resume_with_different_parameters(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        self.sign_with_journal(segwit_utxo, parameters).close()
+
+        (segwit_utxo, parameters) = make_planned_vault(num_shards=2)
+        with self.assertRaises(VaultException):
+            self.sign_with_journal(segwit_utxo, parameters)
+
+class PlanCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def bake(self, **extra_parameters):
+        (segwit_utxo, parameters) = make_planned_vault(4, **extra_parameters)
+        sign_transaction_tree(segwit_utxo, parameters)
+        plan_cache = PlanCache(fingerprint_plan(parameters, amount=segwit_utxo.amount), directory=self.tempdir.name)
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(segwit_utxo.transaction, parameters=parameters, plan_cache=plan_cache)
+        (utxos, transactions) = segwit_utxo.crawl()
+        txids = dict([(str(some_transaction.internal_id), some_transaction.ctv_bitcoin_transaction.GetTxid()) for some_transaction in transactions if some_transaction.id != -1])
+        return (plan_cache, txids)
+
+    def test_cache_hit(self):
+        (first_cache, first_txids) = self.bake(lazy_revault_depth=1)
+        self.assertFalse(first_cache.is_empty)
+
+        (second_cache, second_txids) = self.bake(lazy_revault_depth=1)
+        self.assertEqual(second_cache.path, first_cache.path)
+        self.assertEqual(second_txids, first_txids)
+
+        # Every script is in the cache.
+        (segwit_utxo, parameters) = make_planned_vault(4, lazy_revault_depth=1)
+        (utxos, transactions) = segwit_utxo.crawl()
+        self.assertEqual(len(load_baked_scripts(utxos, second_cache)), len(utxos))
+        self.assertEqual([some_utxo for some_utxo in utxos if some_utxo.ctv_is_dirty], [])
+
+    def test_wrong_cached_script(self):
+        (first_cache, first_txids) = self.bake()
+
+        # Change a template hash in one of the cached scripts.
+        (internal_id, (script_hex, num_template_hashes)) = [(internal_id, script) for (internal_id, script) in sorted(first_cache.scripts.items()) if script != None and script[0].startswith("20")][0]
+        first_cache.scripts[internal_id] = [script_hex[:2] + ("0" if script_hex[2] != "0" else "1") + script_hex[3:], num_template_hashes]
+        first_cache.save()
+
+        # The tree is baked again without the cache, which gets fixed.
+        (second_cache, second_txids) = self.bake()
+        self.assertEqual(second_txids, first_txids)
+        self.assertEqual(second_cache.scripts[internal_id][0], script_hex)
+
+    def test_different_parameters(self):
+        (first_cache, first_txids) = self.bake()
+        (second_cache, second_txids) = self.bake(enable_burn_transactions=False)
+        self.assertNotEqual(second_cache.path, first_cache.path)
+
+    def test_broken_cache_is_ignored(self):
+        (first_cache, first_txids) = self.bake()
+        with open(first_cache.path, "w") as fd:
+            fd.write("{")
+
+        (second_cache, second_txids) = self.bake()
+        self.assertEqual(second_txids, first_txids)
+
+class DirtyTrackingTests(unittest.TestCase):
+    def mark_everything_dirty(self, segwit_utxo):
+        (utxos, transactions) = segwit_utxo.crawl()
+        for some_utxo in utxos:
+            some_utxo.mark_dirty()
+        for some_transaction in transactions:
+            if some_transaction.id != -1:
+                some_transaction.mark_dirty()
+
+    def get_txids(self, segwit_utxo, attribute="bitcoin_transaction"):
+        (utxos, transactions) = segwit_utxo.crawl()
+        return dict([(some_transaction.id, getattr(some_transaction, attribute).GetTxid()) for some_transaction in transactions if some_transaction.id != -1])
+
+    def test_sign_again_without_changes(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        sign_transaction_tree(segwit_utxo, parameters)
+        self.assertEqual(sign_transaction_tree(segwit_utxo, parameters), 0)
+
+    def test_cold_key_rotation(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        total_count = sign_transaction_tree(segwit_utxo, parameters)
+
+        new_key = make_private_keys()[0]
+        changed = update_vault_parameters(segwit_utxo, parameters, {"cold_key1": {"private_key": new_key, "public_key": new_key.pub}})
+        self.assertEqual(changed, ["cold_key1"])
+
+        # Only the push-to-cold-storage transactions and their burn
+        # transactions get new scripts or new txids.
+        (utxos, transactions) = segwit_utxo.crawl()
+        expected_count = len([some_transaction for some_transaction in transactions if some_transaction.name in ["push-to-cold-storage", "Burn some UTXO"]])
+        signed_count = sign_transaction_tree(segwit_utxo, parameters)
+        self.assertEqual(signed_count, expected_count)
+        self.assertLess(signed_count, total_count)
+
+        # Same result as signing everything again.
+        incremental_txids = self.get_txids(segwit_utxo)
+        self.mark_everything_dirty(segwit_utxo)
+        sign_transaction_tree(segwit_utxo, parameters)
+        self.assertEqual(self.get_txids(segwit_utxo), incremental_txids)
+
+    def test_cold_key_rotation_ctv(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        initial_tx = segwit_utxo.transaction
+        sign_transaction_tree(segwit_utxo, parameters)
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=parameters)
+
+        new_key = make_private_keys()[0]
+        update_vault_parameters(segwit_utxo, parameters, {"cold_key1": {"private_key": new_key, "public_key": new_key.pub}})
+        sign_transaction_tree(segwit_utxo, parameters)
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=parameters)
+        incremental_txids = self.get_txids(segwit_utxo, attribute="ctv_bitcoin_transaction")
+
+        self.mark_everything_dirty(segwit_utxo)
+        sign_transaction_tree(segwit_utxo, parameters)
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=parameters)
+        self.assertEqual(self.get_txids(segwit_utxo, attribute="ctv_bitcoin_transaction"), incremental_txids)
+
+    def test_toggle_burn_transactions(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        sign_transaction_tree(segwit_utxo, parameters)
+        (utxos, transactions) = segwit_utxo.crawl()
+
+        update_vault_parameters(segwit_utxo, parameters, {"enable_burn_transactions": False})
+        (fewer_utxos, fewer_transactions) = segwit_utxo.crawl()
+        self.assertTrue(all([some_transaction.name != "Burn some UTXO" for some_transaction in fewer_transactions]))
+        self.assertEqual(sign_transaction_tree(segwit_utxo, parameters), 0)
+
+        update_vault_parameters(segwit_utxo, parameters, {"enable_burn_transactions": True})
+        self.assertEqual(sign_transaction_tree(segwit_utxo, parameters), len(transactions) - len(fewer_transactions))
+        self.assertEqual(len(segwit_utxo.crawl()[1]), len(transactions))
+
+def make_multi_coin_vault(num_coins=4, num_shards=3, **extra_parameters):
+    """
+    Plan a vault that is funded by several of the user's coins, from two
+    different wallet transactions.
+    """
+    parameters = make_parameters(PRIVATE_KEY, num_shards=num_shards)
+    parameters.update(extra_parameters)
+
+    initial_tx = InitialTransaction(txid=lx("cf600e3cfc2cdc01be7563334b33f304ab6466b976e17f66c15228bd81f80007"))
+    other_txid = lx("a7b5f1cda04a46ad2b24e3fbc0e5c1b0b8a15bd6d6c5d0b45b2b7f2e84a19c53")
+    segwit_utxos = []
+    for idx in range(num_coins):
+        segwit_utxo = PlannedUTXO(
+            name="segwit input coin",
+            transaction=initial_tx,
+            script_template=UserScriptTemplate,
+            amount=COIN + idx,
+        )
+        segwit_utxo._vout_override = idx
+        if idx % 2 == 1:
+            segwit_utxo._txid_override = other_txid
+        segwit_utxos.append(segwit_utxo)
+    initial_tx.output_utxos = segwit_utxos
+
+    setup_vault(segwit_utxos, parameters)
+    return (segwit_utxos, parameters)
+
+class MultiCoinTests(unittest.TestCase):
+    def test_witness_signature_hash(self):
+        (segwit_utxos, parameters) = make_multi_coin_vault()
+        sign_transaction_tree(segwit_utxos[0], parameters)
+        bitcoin_transaction = segwit_utxos[0].child_transactions[0].bitcoin_transaction
+
+        midstate = get_witness_sighash_midstate(bitcoin_transaction)
+        for (idx, segwit_utxo) in enumerate(segwit_utxos):
+            script_code = segwit_utxo.p2wsh_redeem_script
+            expected = SignatureHash(script_code, bitcoin_transaction, idx, SIGHASH_ALL, amount=segwit_utxo.amount, sigversion=SIGVERSION_WITNESS_V0)
+            self.assertEqual(get_witness_signature_hash(script_code, bitcoin_transaction, idx, segwit_utxo.amount, midstate), expected)
+
+    def test_funding_commitment_spends_every_coin(self):
+        (segwit_utxos, parameters) = make_multi_coin_vault()
+        funding_transaction = segwit_utxos[0].child_transactions[0]
+        self.assertEqual(len(funding_transaction.inputs), len(segwit_utxos))
+        self.assertEqual(funding_transaction.output_utxos[1].amount, sum([segwit_utxo.amount for segwit_utxo in segwit_utxos]))
+
+        sign_transaction_tree(segwit_utxos[0], parameters)
+        failures = validate_transaction_tree(segwit_utxos[0], processes=1)
+        self.assertNotIn(str(funding_transaction.internal_id), [failure["internal_id"] for failure in failures])
+
+        outpoints = [(bitcoin_input.prevout.hash, bitcoin_input.prevout.n) for bitcoin_input in funding_transaction.bitcoin_transaction.vin]
+        self.assertEqual(outpoints, [(segwit_utxo.txid, segwit_utxo.vout) for segwit_utxo in segwit_utxos])
+
+        initial_tx = segwit_utxos[0].transaction
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=parameters)
+        ctv_outpoints = [(bitcoin_input.prevout.hash, bitcoin_input.prevout.n) for bitcoin_input in funding_transaction.ctv_bitcoin_transaction.vin]
+        self.assertEqual(ctv_outpoints, outpoints)
+
+        # The user's coins survive a round trip through the transaction store.
+        loaded_initial_tx = from_dict(to_dict(segwit_utxos[0]))
+        loaded_coins = loaded_initial_tx.output_utxos
+        self.assertEqual([(some_utxo.txid, some_utxo.vout) for some_utxo in loaded_coins], [(segwit_utxo.txid, segwit_utxo.vout) for segwit_utxo in segwit_utxos])
+        self.assertEqual(len(loaded_initial_tx.child_transactions), 1)
+        self.assertEqual(len(loaded_initial_tx.child_transactions[0].inputs), len(segwit_utxos))
+
+class TopUpTests(unittest.TestCase):
+    def get_txids(self, segwit_utxo):
+        (utxos, transactions) = segwit_utxo.crawl()
+        transactions = [some_transaction for some_transaction in transactions if some_transaction.id != -1]
+        return sorted([(str(some_transaction.internal_id), some_transaction.txid, some_transaction.ctv_bitcoin_transaction.GetTxid()) for some_transaction in transactions])
+
+    def make_new_coins(self, initial_tx, coins):
+        new_coins = []
+        for coin in coins:
+            new_coin = PlannedUTXO(
+                name="segwit input coin",
+                transaction=initial_tx,
+                script_template=UserScriptTemplate,
+                amount=coin.amount,
+            )
+            new_coin._vout_override = coin._vout_override
+            new_coin._txid_override = coin._txid_override
+            new_coins.append(new_coin)
+        return new_coins
+
+    def check_top_up(self, reload):
+        (expected_coins, expected_parameters) = make_multi_coin_vault(num_coins=4)
+        sign_transaction_tree(expected_coins[0], expected_parameters)
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(expected_coins[0].transaction, parameters=expected_parameters)
+
+        (segwit_utxos, parameters) = make_multi_coin_vault(num_coins=2)
+        sign_transaction_tree(segwit_utxos[0], parameters)
+        initial_tx = segwit_utxos[0].transaction
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=parameters)
+
+        if reload:
+            initial_tx = from_dict(to_dict(segwit_utxos[0]))
+
+        changed_count = top_up_vault(initial_tx.output_utxos[0], self.make_new_coins(initial_tx, expected_coins[2:]), parameters=parameters)
+        self.assertTrue(changed_count > 0)
+        self.assertEqual(parameters["amount"], sum([coin.amount for coin in expected_coins]))
+
+        sign_transaction_tree(initial_tx.output_utxos[0], parameters)
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(initial_tx, parameters=parameters)
+
+        # Same as a vault that had every coin from the start.
+        self.assertEqual(self.get_txids(initial_tx.output_utxos[0]), self.get_txids(expected_coins[0]))
+
+    def test_top_up(self):
+        self.check_top_up(reload=False)
+
+    def test_top_up_loaded_vault(self):
+        self.check_top_up(reload=True)
+
+    def test_top_up_with_saved_parameters(self):
+        (segwit_utxos, parameters) = make_multi_coin_vault(num_coins=1, num_shards=4, sharding_mode="hierarchical", shard_group_size=2, enable_burn_transactions=False)
+        initial_tx = from_dict(to_dict(segwit_utxos[0]))
+        (more_coins, more_parameters) = make_multi_coin_vault(num_coins=2)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "parameters.json")
+            save_parameters(parameters, filename=path)
+            with open(path, "r") as fd:
+                self.assertNotIn(PRIVATE_KEY, fd.read())
+
+            # The defaults have another shape.
+            with self.assertRaises(VaultException):
+                top_up_vault(initial_tx.output_utxos[0], self.make_new_coins(initial_tx, more_coins[1:]), parameters=make_parameters(PRIVATE_KEY, amount=parameters["amount"]))
+
+            initial_tx = from_dict(to_dict(segwit_utxos[0]))
+            saved_parameters = get_vault_parameters(PRIVATE_KEY, parameters["amount"], path=path)
+            self.assertEqual(saved_parameters["sharding_mode"], "hierarchical")
+            self.assertEqual(saved_parameters["user_key"]["public_key"], parameters["user_key"]["public_key"])
+            changed_count = top_up_vault(initial_tx.output_utxos[0], self.make_new_coins(initial_tx, more_coins[1:]), parameters=saved_parameters)
+            self.assertTrue(changed_count > 0)
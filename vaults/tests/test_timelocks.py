@@ -0,0 +1,118 @@
+import unittest
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+import bitcoin.core._bignum
+
+from vaults.exceptions import VaultException
+from vaults.timelocks import TimelockSchedule, SEQUENCE_LOCKTIME_TYPE_FLAG, get_script_timelocks
+from vaults.models.script_templates import ShardScriptTemplate, ColdStorageScriptTemplate
+from vaults.signing import sign_transaction_tree
+from vaults.bip119_ctv import make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY
+from vaults.validation import validate_transaction_tree
+from vaults.tests.test_signing import make_planned_vault
+
+class TimelockScheduleTests(unittest.TestCase):
+    def test_blocks(self):
+        schedule = TimelockSchedule()
+        self.assertEqual(schedule.encode(144, 3), 432)
+        self.assertEqual(schedule.get_max_multiplier(144), 455)
+        with self.assertRaises(VaultException):
+            schedule.encode(144, 456)
+
+        schedule = TimelockSchedule(base_interval=6)
+        self.assertEqual(schedule.encode(144, 3), 18)
+
+    def test_window(self):
+        # The base interval doesn't apply to windows.
+        schedule = TimelockSchedule(base_interval=1)
+        window_schedule = schedule.get_window_schedule()
+        self.assertEqual(window_schedule.encode(144, 1), 144)
+        self.assertEqual(window_schedule.get_shard_schedule(), schedule)
+        self.assertEqual(TimelockSchedule.from_dict(window_schedule.to_dict()), window_schedule)
+
+    def test_time(self):
+        schedule = TimelockSchedule(mode="time", base_interval=3600)
+        self.assertEqual(schedule.encode(144, 1), SEQUENCE_LOCKTIME_TYPE_FLAG | 8)
+        self.assertEqual(schedule.encode(144, 2), SEQUENCE_LOCKTIME_TYPE_FLAG | 15)
+        self.assertEqual(schedule.get_max_multiplier(144), 9320)
+
+class TimelockPlanningTests(unittest.TestCase):
+    def get_shard_names(self, segwit_utxo):
+        vault_initial_utxo = segwit_utxo.child_transactions[0].output_utxos[1]
+        sharding_transaction = [child for child in vault_initial_utxo.child_transactions if "stipend" in child.name][0]
+
+        names = []
+        while sharding_transaction != None:
+            names.extend([some_utxo.name for some_utxo in sharding_transaction.output_utxos if some_utxo.script_template == ShardScriptTemplate])
+            next_stages = [some_utxo for some_utxo in sharding_transaction.output_utxos if some_utxo.name == "next stage UTXO"]
+            sharding_transaction = None
+            if len(next_stages) > 0:
+                sharding_transaction = [child for child in next_stages[0].child_transactions if "stipend" in child.name][0]
+        return names
+
+    def test_too_many_shards(self):
+        with self.assertRaises(VaultException):
+            make_planned_vault(10, timelock_base_interval=10000)
+
+    def test_staged_schedule(self):
+        (segwit_utxo, parameters) = make_planned_vault(10, timelock_base_interval=10000, timelock_stage_size=4)
+
+        names = self.get_shard_names(segwit_utxo)
+        self.assertEqual(names, ["shard fragment UTXO {}/10".format(idx) for idx in range(1, 11)])
+
+        (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+        next_stage_utxos = [some_utxo for some_utxo in planned_utxos if some_utxo.name == "next stage UTXO"]
+        self.assertTrue(len(next_stage_utxos) > 0)
+        for next_stage_utxo in next_stage_utxos:
+            self.assertEqual(next_stage_utxo.timelock_multiplier, 4)
+            self.assertEqual(next_stage_utxo.child_transactions[0].inputs[0].relative_timelock, 40000)
+
+    def test_windows_keep_template_timelocks(self):
+        # A short base interval for many shards doesn't shorten the cold
+        # storage (burn) and presigned vault windows.
+        (segwit_utxo, parameters) = make_planned_vault(40, timelock_base_interval=1, sharding_mode="hierarchical", shard_group_size=8, timelock_stage_size=3)
+        (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+
+        cold_storage_utxos = [some_utxo for some_utxo in planned_utxos if some_utxo.script_template == ColdStorageScriptTemplate]
+        self.assertTrue(len(cold_storage_utxos) > 0)
+        for some_utxo in cold_storage_utxos:
+            self.assertEqual(get_script_timelocks(some_utxo), {"TIMELOCK1": 144})
+
+        vault_utxos = [some_utxo for some_utxo in planned_utxos if some_utxo.name.startswith("vault UTXO")]
+        self.assertTrue(len(vault_utxos) > 0)
+        for some_utxo in vault_utxos:
+            self.assertEqual(get_script_timelocks(some_utxo), {"TIMELOCK1": 144})
+
+        # The shards, stages and groups are on the shard schedule.
+        scheduled_utxos = [some_utxo for some_utxo in planned_utxos if some_utxo.script_template == ShardScriptTemplate or some_utxo.name == "next stage UTXO" or some_utxo.name.startswith("vault group UTXO")]
+        self.assertTrue(len(scheduled_utxos) > 0)
+        for some_utxo in scheduled_utxos:
+            self.assertEqual(get_script_timelocks(some_utxo), {"TIMELOCK1": some_utxo.timelock_multiplier})
+
+    def test_time_based_schedule(self):
+        (segwit_utxo, parameters) = make_planned_vault(3, timelock_mode="time", timelock_base_interval=3600)
+        sign_transaction_tree(segwit_utxo, parameters)
+
+        # The vault UTXO is spent with a time-based sequence lock, which
+        # satisfies the time-based OP_CHECKSEQUENCEVERIFY in its script. It's
+        # a window, so it is the script template's 144 blocks in seconds
+        # (rounded up), not the base interval.
+        vault_initial_utxo = segwit_utxo.child_transactions[0].output_utxos[1]
+        push_transaction = vault_initial_utxo.child_transactions[0]
+        self.assertEqual(push_transaction.bitcoin_transaction.vin[0].nSequence, SEQUENCE_LOCKTIME_TYPE_FLAG | 169)
+
+        failures = validate_transaction_tree(segwit_utxo, processes=1)
+        self.assertNotIn(str(push_transaction.internal_id), [failure["internal_id"] for failure in failures])
+
+        # The OP_CHECKTEMPLATEVERIFY version of the scripts uses the same
+        # schedule.
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(segwit_utxo.transaction, parameters=parameters)
+        schedule = TimelockSchedule(mode="time", base_interval=3600)
+        (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+        for some_utxo in planned_utxos:
+            if some_utxo.script_template == ShardScriptTemplate and some_utxo.timelock_multiplier > 0:
+                encoded = bitcoin.core._bignum.bn2vch(schedule.encode(144, some_utxo.timelock_multiplier))
+                self.assertIn(encoded, list(some_utxo.p2wsh_redeem_script))
+                self.assertIn(encoded, list(some_utxo.ctv_script))
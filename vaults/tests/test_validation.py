@@ -0,0 +1,170 @@
+import unittest
+
+from bitcoin import SelectParams
+SelectParams("regtest")
+
+from bitcoin.core import COIN, CTxIn, CTxOut, COutPoint, CMutableTransaction, CTxWitness, CTxInWitness, CScriptWitness
+from bitcoin.core.script import CScript, OP_0, OP_1, OP_NOP3, OP_NOP4, OP_DROP
+
+from bitcoin.wallet import CBitcoinSecret
+
+from vaults.helpers.formatting import lx
+from vaults.exceptions import VaultException
+from vaults.utils import sha256
+from vaults.signing import sign_transaction_tree, parameterize_witness_template_by_signing
+from vaults.models.plans import PlannedInput, PlannedTransaction
+from vaults.models.script_templates import ShardScriptTemplate
+from vaults.bip119_ctv import make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY
+from vaults.validation import (
+    ScriptValidationError,
+    verify_input,
+    get_standard_template_hash,
+    validate_transaction_tree,
+    check_ctv_transaction_tree,
+)
+from vaults.tests.test_signing import make_planned_vault
+
+def make_distinct_key_parameters(parameters):
+    """
+    Give every key role its own key, so that a witness can't satisfy a branch
+    that was meant for another key.
+    """
+    for some_name in ["ephemeral_key_1", "ephemeral_key_2", "cold_key1", "cold_key2", "hot_wallet_key"]:
+        private_key = CBitcoinSecret.from_secret_bytes(sha256(some_name.encode("utf-8")))
+        parameters[some_name] = {"private_key": private_key, "public_key": private_key.pub}
+
+def make_spending_transaction(witness_script, witness_stack=[], nSequence=0xffffffff, amount=COIN):
+    """
+    Make a transaction that spends a P2WSH output with the given script.
+    """
+    txin = CTxIn(COutPoint(lx("cf600e3cfc2cdc01be7563334b33f304ab6466b976e17f66c15228bd81f80007"), 0), nSequence=nSequence)
+    txout = CTxOut(amount - 1000, CScript([OP_1]))
+    transaction = CMutableTransaction([txin], [txout], nLockTime=0, nVersion=2)
+    transaction.wit = CTxWitness([CTxInWitness(CScriptWitness(list(witness_stack) + [witness_script]))])
+    scriptpubkey = CScript([OP_0, sha256(witness_script)])
+    return (transaction, scriptpubkey)
+
+class ScriptInterpreterTests(unittest.TestCase):
+    def test_check_sequence_verify(self):
+        witness_script = CScript([144, OP_NOP3, OP_DROP, OP_1])
+
+        (transaction, scriptpubkey) = make_spending_transaction(witness_script, nSequence=144)
+        verify_input(transaction, 0, scriptpubkey, COIN)
+
+        (transaction, scriptpubkey) = make_spending_transaction(witness_script, nSequence=143)
+        with self.assertRaises(ScriptValidationError):
+            verify_input(transaction, 0, scriptpubkey, COIN)
+
+    def test_check_template_verify(self):
+        (transaction, scriptpubkey) = make_spending_transaction(CScript([OP_1]))
+        template_hash = get_standard_template_hash(transaction, 0)
+
+        witness_script = CScript([template_hash, OP_NOP4])
+        (transaction, scriptpubkey) = make_spending_transaction(witness_script)
+        verify_input(transaction, 0, scriptpubkey, COIN)
+
+        # Any change to the outputs changes the standard template hash.
+        (transaction, scriptpubkey) = make_spending_transaction(witness_script, amount=2 * COIN)
+        with self.assertRaises(ScriptValidationError):
+            verify_input(transaction, 0, scriptpubkey, COIN)
+
+    def test_wrong_witness_script(self):
+        (transaction, scriptpubkey) = make_spending_transaction(CScript([OP_1]))
+        (other_transaction, other_scriptpubkey) = make_spending_transaction(CScript([OP_1, OP_1, OP_DROP]))
+        verify_input(transaction, 0, scriptpubkey, COIN)
+        with self.assertRaises(ScriptValidationError):
+            verify_input(transaction, 0, other_scriptpubkey, COIN)
+
+class TreeValidationTests(unittest.TestCase):
+    def test_tampered_signature(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        sign_transaction_tree(segwit_utxo, parameters)
+
+        failures = validate_transaction_tree(segwit_utxo, processes=1)
+        self.assertEqual(failures, [])
+
+        # The user's own P2WPKH spend is checked too.
+        funding_transaction = segwit_utxo.child_transactions[0]
+
+        witness = funding_transaction.bitcoin_transaction.wit.vtxinwit[0].scriptWitness
+        signature = bytearray(witness.stack[0])
+        signature[10] ^= 0x01
+        funding_transaction.bitcoin_transaction.wit = CTxWitness([CTxInWitness(CScriptWitness([bytes(signature)] + list(witness.stack[1:])))])
+
+        failures = validate_transaction_tree(segwit_utxo, processes=1)
+        self.assertIn(str(funding_transaction.internal_id), [failure["internal_id"] for failure in failures])
+
+    def test_distinct_keys(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        make_distinct_key_parameters(parameters)
+        sign_transaction_tree(segwit_utxo, parameters)
+        self.assertEqual(validate_transaction_tree(segwit_utxo, processes=1), [])
+
+        # The hot wallet can spend a shard after its timelock.
+        (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+        shard_utxo = [some_utxo for some_utxo in planned_utxos if some_utxo.script_template == ShardScriptTemplate and some_utxo.timelock_multiplier > 0][0]
+
+        hot_wallet_transaction = PlannedTransaction(name="hot wallet spend", enable_cpfp_hook=False)
+        planned_input = PlannedInput(utxo=shard_utxo, witness_template_selection="hot-wallet", transaction=hot_wallet_transaction)
+        hot_wallet_transaction.inputs = [planned_input]
+
+        txin = CTxIn(COutPoint(shard_utxo.txid, shard_utxo.vout), nSequence=planned_input.relative_timelock)
+        txout = CTxOut(shard_utxo.amount - 1000, CScript([OP_1]))
+        bitcoin_transaction = CMutableTransaction([txin], [txout], nLockTime=0, nVersion=2)
+        hot_wallet_transaction.bitcoin_transaction = bitcoin_transaction
+
+        witness = parameterize_witness_template_by_signing(planned_input, parameters)
+        bitcoin_transaction.wit = CTxWitness([CTxInWitness(CScriptWitness(witness))])
+        verify_input(bitcoin_transaction, 0, shard_utxo.scriptpubkey, shard_utxo.amount)
+
+        # Without the empty signature, the hot wallet key has no signature.
+        bitcoin_transaction.wit = CTxWitness([CTxInWitness(CScriptWitness(witness[:1] + witness[2:]))])
+        with self.assertRaises(ScriptValidationError):
+            verify_input(bitcoin_transaction, 0, shard_utxo.scriptpubkey, shard_utxo.amount)
+
+    def test_process_pool(self):
+        (segwit_utxo, parameters) = make_planned_vault()
+        sign_transaction_tree(segwit_utxo, parameters)
+
+        serial_failures = validate_transaction_tree(segwit_utxo, processes=1)
+        parallel_failures = validate_transaction_tree(segwit_utxo, processes=2, chunksize=4)
+
+        key = lambda failure: (failure["internal_id"], failure["input"])
+        self.assertEqual(sorted(serial_failures, key=key), sorted(parallel_failures, key=key))
+
+    def test_ctv_tree_with_sweeps(self):
+        (segwit_utxo, parameters) = make_planned_vault(4, enable_sweeps=True)
+        sign_transaction_tree(segwit_utxo, parameters)
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(segwit_utxo.transaction, parameters=parameters)
+
+        # Each shard's script commits to the sweep transaction's template
+        # for the input that spends that shard.
+        (planned_utxos, planned_transactions) = segwit_utxo.crawl()
+        sweep_transactions = [some_transaction for some_transaction in planned_transactions if some_transaction.name == "Sharded UTXO sweep transaction"]
+        self.assertTrue(any([len(sweep_transaction.inputs) > 1 for sweep_transaction in sweep_transactions]))
+
+        known_failures = check_ctv_transaction_tree(segwit_utxo, processes=1)
+        funding_transaction = segwit_utxo.child_transactions[0]
+        self.assertEqual([failure["internal_id"] for failure in known_failures], [str(funding_transaction.internal_id)])
+
+    def test_ctv_tree(self):
+        (segwit_utxo, parameters) = make_planned_vault(4)
+        sign_transaction_tree(segwit_utxo, parameters)
+        make_planned_transaction_tree_using_bip119_OP_CHECKTEMPLATEVERIFY(segwit_utxo.transaction, parameters=parameters)
+
+        # Every OP_CHECKTEMPLATEVERIFY spend selects the right template. The
+        # funding transaction still has the user's signature for the presigned
+        # version of the tree.
+        failures = validate_transaction_tree(segwit_utxo, ctv=True, processes=1)
+        funding_transaction = segwit_utxo.child_transactions[0]
+        self.assertEqual([failure["internal_id"] for failure in failures], [str(funding_transaction.internal_id)])
+        known_failures = check_ctv_transaction_tree(segwit_utxo, processes=1)
+        self.assertEqual([failure["internal_id"] for failure in known_failures], [str(funding_transaction.internal_id)])
+
+        # Any other failure is an error.
+        vault_initial_utxo = funding_transaction.output_utxos[1]
+        some_transaction = vault_initial_utxo.child_transactions[0]
+        some_output = some_transaction.ctv_bitcoin_transaction.vout[0]
+        some_transaction.ctv_bitcoin_transaction.vout[0] = CTxOut(some_output.nValue - 1, some_output.scriptPubKey)
+        with self.assertRaisesRegex(VaultException, str(some_transaction.internal_id)):
+            check_ctv_transaction_tree(segwit_utxo, processes=1)
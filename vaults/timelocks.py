@@ -0,0 +1,195 @@
+"""
+Relative timelock schedules.
+
+Script templates specify a base relative timelock (like 144 blocks) and each
+planned UTXO has a timelock_multiplier, which gives the sharded UTXOs their
+monotonically increasing timelocks. A TimelockSchedule turns the two into the
+value that goes into the OP_CHECKSEQUENCEVERIFY argument and into the
+nSequence field of the spending input (bip68/bip112).
+
+Modes:
+
+    blocks: the timelock is counted in blocks, up to 0xffff blocks.
+
+    time: the timelock is counted in units of 512 seconds (bip68 type flag),
+    up to 0xffff units (a little over a year).
+
+The interval between shards can be changed with the "timelock_base_interval"
+parameter, in blocks or in seconds depending on the mode. Otherwise the base
+value from the script template is used. The base interval only applies to
+the shard schedule: the shard UTXOs, and the stage and group UTXOs that the
+planner puts on the same schedule. The other timelocks are windows (like the
+time to burn or claw back a cold storage UTXO, or to push a presigned vault
+UTXO to cold storage) and keep the script template's value, see
+TimelockSchedule.get_window_schedule.
+
+Staging ("timelock_stage_size") is handled by the planner: a sharding
+transaction only makes that many shards, plus a UTXO that unlocks the next
+stage of shards. Each stage's timelocks are relative to the confirmation of
+that stage, so no single timelock has to cover the whole schedule.
+"""
+
+from vaults.exceptions import VaultException
+
+# bip68
+SEQUENCE_LOCKTIME_TYPE_FLAG = 1 << 22
+SEQUENCE_LOCKTIME_MASK = 0x0000ffff
+SEQUENCE_LOCKTIME_GRANULARITY = 512
+
+# Script template timelocks are written in blocks. Used for converting them
+# into seconds for time-based timelocks.
+SECONDS_PER_BLOCK = 600
+
+TIMELOCK_MODES = ["blocks", "time"]
+
+class TimelockSchedule(object):
+    """
+    Converts a script template's base timelock and a timelock multiplier into
+    an encoded relative timelock.
+
+    A window schedule ignores the base interval, see get_window_schedule.
+    """
+
+    __slots__ = ("mode", "base_interval", "stage_size", "window")
+
+    def __init__(self, mode="blocks", base_interval=None, stage_size=None, window=False):
+        if mode not in TIMELOCK_MODES:
+            raise VaultException("Unknown timelock mode {}".format(mode))
+        if base_interval != None and base_interval <= 0:
+            raise VaultException("Timelock base interval must be positive")
+        if stage_size != None and stage_size < 1:
+            raise VaultException("Timelock stage size must be at least 1")
+
+        self.mode = mode
+        self.base_interval = base_interval
+        self.stage_size = stage_size
+        self.window = window
+
+    def __eq__(self, other):
+        return isinstance(other, TimelockSchedule) and self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        return hash((self.mode, self.base_interval, self.stage_size, self.window))
+
+    @property
+    def is_default(self):
+        """
+        Whether the schedule encodes every timelock like the default
+        schedule (so it doesn't have to be saved).
+        """
+        return self.mode == "blocks" and self.base_interval == None and self.stage_size == None
+
+    def get_window_schedule(self):
+        """
+        The schedule for the timelocks that aren't part of the shard schedule.
+        It has the same mode, but the script template's value is used instead
+        of the base interval.
+        """
+        if self.window:
+            return self
+        return TimelockSchedule(mode=self.mode, base_interval=self.base_interval, stage_size=self.stage_size, window=True)
+
+    def get_shard_schedule(self):
+        """
+        The schedule for the timelocks of the shard schedule, which use the
+        base interval.
+        """
+        if not self.window:
+            return self
+        return TimelockSchedule(mode=self.mode, base_interval=self.base_interval, stage_size=self.stage_size)
+
+    def get_interval(self, template_value):
+        """
+        The interval that the timelock multiplier is multiplied with, in
+        blocks or in seconds depending on the mode.
+        """
+        if self.base_interval != None and not self.window:
+            return self.base_interval
+        elif self.mode == "time":
+            return template_value * SECONDS_PER_BLOCK
+        return template_value
+
+    def encode(self, template_value, multiplier=1):
+        """
+        Compute the relative timelock value (for both OP_CHECKSEQUENCEVERIFY
+        and nSequence). template_value is the script template's base timelock,
+        in blocks.
+        """
+        interval = self.get_interval(template_value)
+        if self.mode == "blocks":
+            value = interval * multiplier
+            if value > SEQUENCE_LOCKTIME_MASK:
+                raise VaultException("Timelock of {} blocks exceeds max timelock {}".format(value, SEQUENCE_LOCKTIME_MASK))
+            return value
+
+        elif self.mode == "time":
+            seconds = interval * multiplier
+            # round up, so that the timelock is never shorter than requested
+            units = -(-seconds // SEQUENCE_LOCKTIME_GRANULARITY)
+            if units > SEQUENCE_LOCKTIME_MASK:
+                raise VaultException("Timelock of {} seconds exceeds max timelock {}".format(seconds, SEQUENCE_LOCKTIME_MASK * SEQUENCE_LOCKTIME_GRANULARITY))
+            return SEQUENCE_LOCKTIME_TYPE_FLAG | units
+
+    def get_max_multiplier(self, template_value):
+        """
+        The largest timelock multiplier that can still be encoded.
+        """
+        interval = self.get_interval(template_value)
+        if self.mode == "blocks":
+            return SEQUENCE_LOCKTIME_MASK // interval
+        elif self.mode == "time":
+            return (SEQUENCE_LOCKTIME_MASK * SEQUENCE_LOCKTIME_GRANULARITY) // interval
+
+    def to_dict(self):
+        return {
+            "mode": self.mode,
+            "base_interval": self.base_interval,
+            "stage_size": self.stage_size,
+            "window": self.window,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(mode=data["mode"], base_interval=data["base_interval"], stage_size=data["stage_size"], window=data.get("window", False))
+
+DEFAULT_TIMELOCK_SCHEDULE = TimelockSchedule()
+
+def get_timelock_schedule(parameters):
+    """
+    Make a TimelockSchedule from the vault parameters.
+    """
+    if parameters == None:
+        return DEFAULT_TIMELOCK_SCHEDULE
+
+    return TimelockSchedule(
+        mode=parameters.get("timelock_mode", "blocks"),
+        base_interval=parameters.get("timelock_base_interval", None),
+        stage_size=parameters.get("timelock_stage_size", None),
+    )
+
+def get_relative_timelock(planned_utxo, witness_template_selection):
+    """
+    Get the encoded relative timelock for spending the given UTXO with the
+    given witness template, or None if that spending path isn't timelocked.
+    """
+    timelock_data = planned_utxo.script_template.relative_timelocks
+    if timelock_data in [None, {}]:
+        return None
+    elif witness_template_selection not in timelock_data["selections"].keys():
+        return None
+
+    var_name = timelock_data["selections"][witness_template_selection]
+    template_value = timelock_data["replacements"][var_name]
+    return planned_utxo.get_timelock_schedule().encode(template_value, planned_utxo.timelock_multiplier)
+
+def get_script_timelocks(planned_utxo):
+    """
+    Get the encoded value for each of the timelock placeholders in the UTXO's
+    script template.
+    """
+    timelock_data = planned_utxo.script_template.relative_timelocks
+    if timelock_data in [None, {}]:
+        return {}
+
+    schedule = planned_utxo.get_timelock_schedule()
+    return dict([(name, schedule.encode(value, planned_utxo.timelock_multiplier)) for (name, value) in timelock_data["replacements"].items()])
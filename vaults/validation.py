@@ -0,0 +1,596 @@
+"""
+Offline script validation for the planned transaction tree.
+
+python-bitcoinlib's VerifyScript doesn't know about segwit, so nothing else
+checks that the presigned witnesses (or the OP_CHECKTEMPLATEVERIFY witnesses
+made in bip119_ctv.py) actually satisfy the scripts of the outputs that they
+spend. This module checks every input of every transaction in the tree
+against its parent output, ideally before the ephemeral keys are deleted.
+
+When libbitcoinconsensus can be found, it is used for anything that it knows
+how to evaluate. Otherwise, and for any script that uses
+OP_CHECKTEMPLATEVERIFY (which libbitcoinconsensus treats as OP_NOP4), a small
+built-in segwit v0 script interpreter is used instead. The interpreter only
+implements the opcodes that the vault script templates use.
+
+Transactions are validated in a process pool. Each failure is reported with
+the planned transaction and input that failed.
+
+entrypoint: validate_transaction_tree
+"""
+
+import struct
+import ctypes
+import ctypes.util
+import hashlib
+import multiprocessing
+
+import bitcoin.core._bignum
+from bitcoin.core import CTransaction
+from bitcoin.core.key import CPubKey
+from bitcoin.core.script import (
+    CScript,
+    SignatureHash,
+    SIGVERSION_WITNESS_V0,
+    OP_0,
+    OP_PUSHDATA4,
+    OP_1NEGATE,
+    OP_1,
+    OP_16,
+    OP_NOP,
+    OP_IF,
+    OP_NOTIF,
+    OP_ELSE,
+    OP_ENDIF,
+    OP_VERIFY,
+    OP_RETURN,
+    OP_DROP,
+    OP_2DROP,
+    OP_DUP,
+    OP_SWAP,
+    OP_PICK,
+    OP_ROLL,
+    OP_EQUAL,
+    OP_EQUALVERIFY,
+    OP_SHA256,
+    OP_HASH160,
+    OP_CHECKSIG,
+    OP_CHECKSIGVERIFY,
+    OP_NOP1,
+    OP_NOP3,
+    OP_NOP4,
+    OP_NOP5,
+    OP_NOP10,
+)
+
+from vaults.exceptions import VaultException
+from vaults.loggingconfig import logger
+from vaults.utils import sha256, ser_string
+from vaults.models.script_templates import UserScriptTemplate
+from vaults.models.plans import InitialTransaction
+
+# Script verification flags, with the same values as bitcoin's
+# script/interpreter.h and the libbitcoinconsensus API.
+SCRIPT_VERIFY_P2SH = 1 << 0
+SCRIPT_VERIFY_DERSIG = 1 << 2
+SCRIPT_VERIFY_NULLDUMMY = 1 << 4
+SCRIPT_VERIFY_MINIMALIF = 1 << 13
+SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY = 1 << 9
+SCRIPT_VERIFY_CHECKSEQUENCEVERIFY = 1 << 10
+SCRIPT_VERIFY_WITNESS = 1 << 11
+
+# libbitcoinconsensus refuses any flags that it doesn't know about, so
+# policy-only flags like MINIMALIF are only used by the built-in interpreter.
+LIBBITCOINCONSENSUS_FLAGS = (
+    SCRIPT_VERIFY_P2SH
+    | SCRIPT_VERIFY_DERSIG
+    | SCRIPT_VERIFY_NULLDUMMY
+    | SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY
+    | SCRIPT_VERIFY_CHECKSEQUENCEVERIFY
+    | SCRIPT_VERIFY_WITNESS
+)
+
+DEFAULT_VALIDATION_FLAGS = LIBBITCOINCONSENSUS_FLAGS
+
+# consensus limits for segwit v0
+MAX_SCRIPT_ELEMENT_SIZE = 520
+MAX_WITNESS_SCRIPT_SIZE = 10000
+MAX_OPS_PER_SCRIPT = 201
+MAX_STACK_SIZE = 1000
+
+# bip68/bip112 relative locktime fields
+SEQUENCE_LOCKTIME_DISABLE_FLAG = 1 << 31
+SEQUENCE_LOCKTIME_TYPE_FLAG = 1 << 22
+SEQUENCE_LOCKTIME_MASK = 0x0000ffff
+
+class ScriptValidationError(VaultException):
+    """
+    A witness does not satisfy the script of the output that it spends.
+    """
+    pass
+
+# ----
+#
+# libbitcoinconsensus
+
+# None means "not loaded yet", False means "not available".
+_libbitcoinconsensus = None
+
+def load_libbitcoinconsensus():
+    """
+    Find and load libbitcoinconsensus, if it is installed. Returns None when
+    the library can't be found.
+    """
+    global _libbitcoinconsensus
+
+    if _libbitcoinconsensus == None:
+        _libbitcoinconsensus = False
+
+        path = ctypes.util.find_library("bitcoinconsensus")
+        if path != None:
+            try:
+                library = ctypes.cdll.LoadLibrary(path)
+                function = library.bitcoinconsensus_verify_script_with_amount
+            except (OSError, AttributeError):
+                logger.warning("Found libbitcoinconsensus at {} but couldn't load it".format(path))
+            else:
+                function.argtypes = [
+                    ctypes.c_char_p, ctypes.c_uint, ctypes.c_int64,
+                    ctypes.c_char_p, ctypes.c_uint, ctypes.c_uint,
+                    ctypes.c_uint, ctypes.POINTER(ctypes.c_int),
+                ]
+                function.restype = ctypes.c_int
+                _libbitcoinconsensus = library
+
+    if _libbitcoinconsensus == False:
+        return None
+    return _libbitcoinconsensus
+
+def verify_input_with_libbitcoinconsensus(library, tx_bytes, nIn, scriptpubkey, amount, flags):
+    """
+    Verify one input with libbitcoinconsensus. Raises ScriptValidationError
+    on failure.
+    """
+    error = ctypes.c_int(0)
+    result = library.bitcoinconsensus_verify_script_with_amount(
+        bytes(scriptpubkey), len(scriptpubkey), amount,
+        tx_bytes, len(tx_bytes), nIn,
+        flags & LIBBITCOINCONSENSUS_FLAGS, ctypes.byref(error),
+    )
+    if result != 1:
+        raise ScriptValidationError("libbitcoinconsensus rejected the input (error code {})".format(error.value))
+
+# ----
+#
+# built-in segwit v0 interpreter
+
+def decode_script_number(data, max_size=4):
+    """
+    Decode a CScriptNum from a stack element.
+    """
+    if len(data) > max_size:
+        raise ScriptValidationError("script number overflow")
+    if len(data) == 0:
+        return 0
+    value = int.from_bytes(data, byteorder="little")
+    if data[-1] & 0x80:
+        return -(value & ~(0x80 << (8 * (len(data) - 1))))
+    return value
+
+def encode_script_number(value):
+    """
+    Encode an integer as a CScriptNum stack element.
+    """
+    if value == 0:
+        return b""
+    result = bytearray(bitcoin.core._bignum.bn2vch(abs(value)))
+    if value < 0:
+        if result[-1] & 0x80:
+            result.append(0x80)
+        else:
+            result[-1] |= 0x80
+    return bytes(result)
+
+def cast_to_bool(data):
+    """
+    Interpret a stack element as a boolean. Negative zero is false.
+    """
+    for (idx, byte) in enumerate(data):
+        if byte != 0:
+            if idx == len(data) - 1 and byte == 0x80:
+                return False
+            return True
+    return False
+
+def get_standard_template_hash(bitcoin_transaction, nIn):
+    """
+    Compute the bip119 StandardTemplateHash of a bitcoin transaction, for the
+    input at index nIn. bip119_ctv uses this too when it builds the
+    templates, so the builder and the validator can't disagree.
+
+    pulled from bitcoin/test/functional/test_framework/messages.py get_standard_template_hash
+    """
+    r = b""
+    r += struct.pack("<i", bitcoin_transaction.nVersion)
+    r += struct.pack("<I", bitcoin_transaction.nLockTime)
+    if any(inp.scriptSig for inp in bitcoin_transaction.vin):
+        r += sha256(b"".join(ser_string(inp.scriptSig) for inp in bitcoin_transaction.vin))
+    r += struct.pack("<I", len(bitcoin_transaction.vin))
+    r += sha256(b"".join(struct.pack("<I", inp.nSequence) for inp in bitcoin_transaction.vin))
+    r += struct.pack("<I", len(bitcoin_transaction.vout))
+    r += sha256(b"".join(out.serialize() for out in bitcoin_transaction.vout))
+    r += struct.pack("<I", nIn)
+    return sha256(r)
+
+def check_sequence(bitcoin_transaction, nIn, locktime):
+    """
+    bip112 OP_CHECKSEQUENCEVERIFY rules for the spending input.
+    """
+    nSequence = bitcoin_transaction.vin[nIn].nSequence
+
+    if bitcoin_transaction.nVersion < 2:
+        raise ScriptValidationError("OP_CHECKSEQUENCEVERIFY requires transaction version 2")
+    if nSequence & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+        raise ScriptValidationError("OP_CHECKSEQUENCEVERIFY but the input has relative locktimes disabled")
+
+    mask = SEQUENCE_LOCKTIME_TYPE_FLAG | SEQUENCE_LOCKTIME_MASK
+    locktime_masked = locktime & mask
+    sequence_masked = nSequence & mask
+
+    # Block heights can't be compared with time intervals.
+    if (locktime_masked < SEQUENCE_LOCKTIME_TYPE_FLAG) != (sequence_masked < SEQUENCE_LOCKTIME_TYPE_FLAG):
+        raise ScriptValidationError("OP_CHECKSEQUENCEVERIFY locktime type mismatch")
+    if locktime_masked > sequence_masked:
+        raise ScriptValidationError("OP_CHECKSEQUENCEVERIFY relative locktime {} not satisfied by nSequence {}".format(locktime_masked, sequence_masked))
+
+def check_signature(signature, public_key, script_code, bitcoin_transaction, nIn, amount):
+    """
+    Check a segwit v0 (bip143) signature. Returns False for an empty or
+    invalid signature.
+    """
+    if len(signature) == 0:
+        return False
+    hashtype = signature[-1]
+    sighash = SignatureHash(script_code, bitcoin_transaction, nIn, hashtype, amount=amount, sigversion=SIGVERSION_WITNESS_V0)
+    try:
+        return CPubKey(public_key).verify(sighash, signature[:-1])
+    except Exception:
+        return False
+
+def evaluate_script(script, stack, bitcoin_transaction, nIn, amount, flags=DEFAULT_VALIDATION_FLAGS):
+    """
+    Execute a segwit v0 witness script against the given stack. Raises
+    ScriptValidationError when the script fails.
+    """
+    condition_stack = []
+    op_count = 0
+
+    def pop():
+        if len(stack) == 0:
+            raise ScriptValidationError("stack underflow")
+        return stack.pop()
+
+    def top():
+        if len(stack) == 0:
+            raise ScriptValidationError("stack underflow")
+        return stack[-1]
+
+    try:
+        operations = list(script.raw_iter())
+    except Exception as exc:
+        raise ScriptValidationError("script is not parseable: {}".format(exc))
+
+    for (opcode, data, sop_idx) in operations:
+        executing = False not in condition_stack
+
+        if data != None and len(data) > MAX_SCRIPT_ELEMENT_SIZE:
+            raise ScriptValidationError("push size limit exceeded")
+
+        if opcode > OP_16:
+            op_count += 1
+            if op_count > MAX_OPS_PER_SCRIPT:
+                raise ScriptValidationError("operation limit exceeded")
+
+        if opcode <= OP_PUSHDATA4:
+            if executing:
+                stack.append(data)
+
+        elif opcode in [OP_IF, OP_NOTIF]:
+            value = False
+            if executing:
+                element = pop()
+                if flags & SCRIPT_VERIFY_MINIMALIF and element not in [b"", b"\x01"]:
+                    raise ScriptValidationError("OP_IF argument must be minimal")
+                value = cast_to_bool(element)
+                if opcode == OP_NOTIF:
+                    value = not value
+            condition_stack.append(value)
+
+        elif opcode == OP_ELSE:
+            if len(condition_stack) == 0:
+                raise ScriptValidationError("unbalanced conditional")
+            condition_stack[-1] = not condition_stack[-1]
+
+        elif opcode == OP_ENDIF:
+            if len(condition_stack) == 0:
+                raise ScriptValidationError("unbalanced conditional")
+            condition_stack.pop()
+
+        elif not executing:
+            continue
+
+        elif opcode == OP_1NEGATE or OP_1 <= opcode <= OP_16:
+            stack.append(encode_script_number(opcode - (OP_1 - 1)))
+
+        elif opcode in [OP_NOP, OP_NOP1] or OP_NOP5 <= opcode <= OP_NOP10:
+            pass
+
+        elif opcode == OP_NOP3:
+            # OP_CHECKSEQUENCEVERIFY
+            if flags & SCRIPT_VERIFY_CHECKSEQUENCEVERIFY:
+                locktime = decode_script_number(top(), max_size=5)
+                if locktime < 0:
+                    raise ScriptValidationError("negative OP_CHECKSEQUENCEVERIFY locktime")
+                if not locktime & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+                    check_sequence(bitcoin_transaction, nIn, locktime)
+
+        elif opcode == OP_NOP4:
+            # OP_CHECKTEMPLATEVERIFY. Anything other than a 32 byte argument
+            # is left as a NOP for future upgrades.
+            if len(top()) == 32:
+                if top() != get_standard_template_hash(bitcoin_transaction, nIn):
+                    raise ScriptValidationError("OP_CHECKTEMPLATEVERIFY standard template hash mismatch")
+
+        elif opcode == OP_VERIFY:
+            if not cast_to_bool(pop()):
+                raise ScriptValidationError("OP_VERIFY failed")
+
+        elif opcode == OP_RETURN:
+            raise ScriptValidationError("OP_RETURN")
+
+        elif opcode == OP_DROP:
+            pop()
+
+        elif opcode == OP_2DROP:
+            pop()
+            pop()
+
+        elif opcode == OP_DUP:
+            stack.append(top())
+
+        elif opcode == OP_SWAP:
+            (a, b) = (pop(), pop())
+            stack.extend([a, b])
+
+        elif opcode in [OP_PICK, OP_ROLL]:
+            n = decode_script_number(pop())
+            if n < 0 or n >= len(stack):
+                raise ScriptValidationError("invalid stack operation")
+            element = stack[-n - 1]
+            if opcode == OP_ROLL:
+                del stack[-n - 1]
+            stack.append(element)
+
+        elif opcode in [OP_EQUAL, OP_EQUALVERIFY]:
+            equal = pop() == pop()
+            if opcode == OP_EQUALVERIFY:
+                if not equal:
+                    raise ScriptValidationError("OP_EQUALVERIFY failed")
+            else:
+                stack.append(b"\x01" if equal else b"")
+
+        elif opcode == OP_SHA256:
+            stack.append(sha256(pop()))
+
+        elif opcode == OP_HASH160:
+            stack.append(hashlib.new("ripemd160", sha256(pop())).digest())
+
+        elif opcode in [OP_CHECKSIG, OP_CHECKSIGVERIFY]:
+            public_key = pop()
+            signature = pop()
+            valid = check_signature(signature, public_key, script, bitcoin_transaction, nIn, amount)
+            if opcode == OP_CHECKSIGVERIFY:
+                if not valid:
+                    raise ScriptValidationError("OP_CHECKSIGVERIFY failed")
+            else:
+                stack.append(b"\x01" if valid else b"")
+
+        else:
+            raise ScriptValidationError("unsupported opcode {}".format(CScript([opcode])))
+
+        if len(stack) > MAX_STACK_SIZE:
+            raise ScriptValidationError("stack size limit exceeded")
+
+    if len(condition_stack) != 0:
+        raise ScriptValidationError("unbalanced conditional")
+
+    return stack
+
+def verify_input(bitcoin_transaction, nIn, scriptpubkey, amount, flags=DEFAULT_VALIDATION_FLAGS):
+    """
+    Verify one input of a transaction against the native segwit v0 output
+    (P2WSH or P2WPKH) that it spends. Raises ScriptValidationError on
+    failure.
+    """
+    scriptpubkey = bytes(scriptpubkey)
+
+    if len(bitcoin_transaction.vin[nIn].scriptSig) != 0:
+        raise ScriptValidationError("native segwit inputs must have an empty scriptSig")
+
+    witness_stack = []
+    if nIn < len(bitcoin_transaction.wit.vtxinwit):
+        witness_stack = list(bitcoin_transaction.wit.vtxinwit[nIn].scriptWitness.stack)
+
+    if len(scriptpubkey) == 34 and scriptpubkey[0] == OP_0 and scriptpubkey[1] == 32:
+        if len(witness_stack) == 0:
+            raise ScriptValidationError("empty witness")
+        witness_script = bytes(witness_stack[-1])
+        if len(witness_script) > MAX_WITNESS_SCRIPT_SIZE:
+            raise ScriptValidationError("witness script size limit exceeded")
+        if sha256(witness_script) != scriptpubkey[2:]:
+            raise ScriptValidationError("witness script does not match the P2WSH scriptpubkey")
+        script = CScript(witness_script)
+        stack = [bytes(item) for item in witness_stack[:-1]]
+    elif len(scriptpubkey) == 22 and scriptpubkey[0] == OP_0 and scriptpubkey[1] == 20:
+        if len(witness_stack) != 2:
+            raise ScriptValidationError("P2WPKH witness must have two items")
+        script = CScript([OP_DUP, OP_HASH160, scriptpubkey[2:], OP_EQUALVERIFY, OP_CHECKSIG])
+        stack = [bytes(item) for item in witness_stack]
+    else:
+        raise ScriptValidationError("unsupported scriptpubkey {}".format(scriptpubkey.hex()))
+
+    for item in stack:
+        if len(item) > MAX_SCRIPT_ELEMENT_SIZE:
+            raise ScriptValidationError("witness element size limit exceeded")
+
+    stack = evaluate_script(script, stack, bitcoin_transaction, nIn, amount, flags=flags)
+
+    # segwit v0 enforces cleanstack.
+    if len(stack) != 1:
+        raise ScriptValidationError("script left {} elements on the stack instead of 1".format(len(stack)))
+    if not cast_to_bool(stack[-1]):
+        raise ScriptValidationError("script evaluated to false")
+
+# ----
+#
+# tree validation
+
+def get_spent_scriptpubkey(planned_utxo, ctv=False):
+    """
+    Get the scriptpubkey that the given planned UTXO has on chain.
+    """
+    if planned_utxo.script_template == UserScriptTemplate:
+        # The user's coin is a plain P2WPKH output; the planned "script" is
+        # just the hash160 of the user's public key.
+        user_key_hash160 = list(planned_utxo.p2wsh_redeem_script)[0]
+        return CScript([OP_0, user_key_hash160])
+    elif ctv and not planned_utxo.ctv_bypass:
+        return planned_utxo.ctv_scriptpubkey
+    else:
+        return planned_utxo.scriptpubkey
+
+def make_validation_tasks(planned_transactions, ctv=False):
+    """
+    Turn each planned transaction into a picklable task: the serialized
+    transaction plus the scriptpubkey and amount of each spent output.
+    """
+    tasks = []
+    for planned_transaction in planned_transactions:
+        if planned_transaction.__class__ == InitialTransaction:
+            continue
+
+        if ctv:
+            bitcoin_transaction = planned_transaction.ctv_bitcoin_transaction
+        else:
+            bitcoin_transaction = planned_transaction.bitcoin_transaction
+
+        if bitcoin_transaction == None:
+            raise VaultException("Transaction {} ({}) hasn't been built yet".format(planned_transaction.internal_id, planned_transaction.name))
+
+        spent_outputs = []
+        for some_input in planned_transaction.inputs:
+            scriptpubkey = get_spent_scriptpubkey(some_input.utxo, ctv=ctv)
+            spent_outputs.append((bytes(scriptpubkey), some_input.utxo.amount))
+
+        label = (str(planned_transaction.internal_id), planned_transaction.name)
+        tasks.append((label, bitcoin_transaction.serialize(), spent_outputs))
+
+    return tasks
+
+def validate_transaction_task(task, flags=DEFAULT_VALIDATION_FLAGS):
+    """
+    Validate every input of a single serialized transaction. Returns a list of
+    failures. This runs in the worker processes.
+    """
+    (label, tx_bytes, spent_outputs) = task
+    (internal_id, name) = label
+
+    failures = []
+
+    def fail(nIn, error):
+        failures.append({"internal_id": internal_id, "name": name, "input": nIn, "error": str(error)})
+
+    try:
+        bitcoin_transaction = CTransaction.deserialize(tx_bytes)
+    except Exception as exc:
+        fail(None, "can't deserialize transaction: {}".format(exc))
+        return failures
+
+    if len(spent_outputs) != len(bitcoin_transaction.vin):
+        fail(None, "transaction has {} inputs but {} spent outputs".format(len(bitcoin_transaction.vin), len(spent_outputs)))
+        return failures
+
+    library = load_libbitcoinconsensus()
+
+    for (nIn, (scriptpubkey, amount)) in enumerate(spent_outputs):
+        try:
+            # libbitcoinconsensus doesn't know about OP_CHECKTEMPLATEVERIFY
+            # and would skip it as OP_NOP4.
+            witness = []
+            if nIn < len(bitcoin_transaction.wit.vtxinwit):
+                witness = bitcoin_transaction.wit.vtxinwit[nIn].scriptWitness.stack
+            uses_ctv = len(witness) > 0 and OP_NOP4 in bytes(witness[-1])
+
+            if library != None and not uses_ctv:
+                verify_input_with_libbitcoinconsensus(library, tx_bytes, nIn, scriptpubkey, amount, flags)
+            else:
+                verify_input(bitcoin_transaction, nIn, scriptpubkey, amount, flags=flags)
+        except ScriptValidationError as exc:
+            fail(nIn, exc)
+        except Exception as exc:
+            fail(nIn, "unexpected error: {}".format(exc))
+
+    return failures
+
+def validate_transaction_tree(initial_utxo, ctv=False, processes=None, chunksize=16):
+    """
+    Check every input of every transaction in the planned transaction tree
+    against the output that it spends. Set ctv=True to check the
+    OP_CHECKTEMPLATEVERIFY version of the tree instead of the presigned
+    transactions.
+
+    Returns a list of failures, one dict per failing input, and an empty list
+    if the whole tree is valid. Use processes=1 to skip the process pool.
+    """
+    (planned_utxos, planned_transactions) = initial_utxo.crawl()
+    tasks = make_validation_tasks(planned_transactions, ctv=ctv)
+
+    if processes == None:
+        processes = min(multiprocessing.cpu_count(), max(1, len(tasks) // 64))
+
+    if processes <= 1:
+        results = map(validate_transaction_task, tasks)
+        failures = [failure for result in results for failure in result]
+    else:
+        with multiprocessing.Pool(processes=processes) as pool:
+            results = pool.imap_unordered(validate_transaction_task, tasks, chunksize=chunksize)
+            failures = [failure for result in results for failure in result]
+
+    input_count = sum([len(task[2]) for task in tasks])
+    logger.info("Validated {} inputs in {} transactions ({} failures)".format(input_count, len(tasks), len(failures)))
+
+    for failure in failures:
+        logger.error("Transaction {} ({}) input {} failed validation: {}".format(failure["internal_id"], failure["name"], failure["input"], failure["error"]))
+
+    return failures
+
+def check_ctv_transaction_tree(initial_utxo, processes=None):
+    """
+    Validate the OP_CHECKTEMPLATEVERIFY version of the tree, and raise a
+    VaultException when an input fails. The funding commitment transaction
+    (the first child transaction of initial_utxo) is left out: it keeps the
+    witness of the presigned version (see bip119_ctv.bake_ctv_transaction),
+    which signs other outputs, so it can't validate yet. Returns the
+    failures of the funding commitment transaction.
+    """
+    failures = validate_transaction_tree(initial_utxo, ctv=True, processes=processes)
+
+    funding_transaction_id = str(initial_utxo.child_transactions[0].internal_id)
+    known_failures = [failure for failure in failures if failure["internal_id"] == funding_transaction_id]
+    failures = [failure for failure in failures if failure not in known_failures]
+
+    if len(failures) > 0:
+        failure = failures[0]
+        raise VaultException("{} inputs in the OP_CHECKTEMPLATEVERIFY transaction tree failed validation, like transaction {} ({}) input {}: {}".format(len(failures), failure["internal_id"], failure["name"], failure["input"], failure["error"]))
+
+    return known_failures
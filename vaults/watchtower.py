@@ -75,7 +75,9 @@ class WatchtowerServer(object):
     def get_vault_state(self, vault):
         """
         Reconcile the given vault against the blockchain. Determine where in
-        the vault transaction tree the latest current transaction is.
+        the vault transaction tree the latest current transaction is. Lazy
+        re-vault subtrees have to be planned as the vault reaches them, see
+        bip119_ctv.materialize_revault_stub.
         """
         raise NotImplementedError
 